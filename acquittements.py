@@ -0,0 +1,64 @@
+"""
+Acquittement groupé des alertes : une seule requête UPDATE par demande, quel que soit le nombre d'alertes
+"""
+import logging
+from sqlalchemy import select, update
+from app import db
+from models import Alerte, Equipement
+from cache_equipements import cache_equipements
+
+logger = logging.getLogger(__name__)
+
+# Nombre maximal d'identifiants acceptés dans une demande
+MAX_IDS_PAR_DEMANDE = 1000
+
+# Au-delà, l'événement 'alerte_lue' ne donne que le nombre d'alertes, pas leurs identifiants
+MAX_IDS_PAR_EVENEMENT = 100
+
+
+def marquer_alertes_lues(portee_client_id=None, ids=None, equipement_id=None, client_id=None, avant=None,
+                         type_alerte=None, depuis=None):
+    """Marque comme lues les alertes non lues qui vérifient tous les critères donnés
+
+    `portee_client_id` limite l'opération aux équipements d'un client (utilisateur
+    non administrateur) ; `depuis` et `avant` sont en UTC naïf. Retourne (nombre
+    d'alertes modifiées, événements 'alerte_lue' à publier après le commit, un
+    par client).
+    """
+    requete = update(Alerte).where(Alerte.lue == False)
+
+    if ids is not None:
+        requete = requete.where(Alerte.id.in_(ids))
+    if equipement_id is not None:
+        requete = requete.where(Alerte.equipement_id == equipement_id)
+    if type_alerte is not None:
+        requete = requete.where(Alerte.type_alerte == type_alerte)
+    if depuis is not None:
+        requete = requete.where(Alerte.timestamp >= depuis)
+    if avant is not None:
+        requete = requete.where(Alerte.timestamp < avant)
+    for portee in {portee_client_id, client_id} - {None}:
+        requete = requete.where(Alerte.equipement_id.in_(
+            select(Equipement.id).where(Equipement.client_id == portee)
+        ))
+
+    lignes = db.session.execute(
+        requete.values(lue=True).returning(Alerte.id, Alerte.equipement_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    # Regroupement par client pour les événements des tableaux de bord
+    par_client = {}
+    for alerte_id, alerte_equipement_id in lignes:
+        equipement = cache_equipements.par_id(alerte_equipement_id)
+        if equipement is not None:
+            par_client.setdefault(equipement.client_id, []).append(alerte_id)
+
+    evenements = [('alerte_lue', alerte_client_id, {
+        'nombre': len(alerte_ids),
+        'ids': alerte_ids if len(alerte_ids) <= MAX_IDS_PAR_EVENEMENT else None,
+    }) for alerte_client_id, alerte_ids in par_client.items()]
+
+    if lignes:
+        logger.info(f"{len(lignes)} alertes marquées comme lues")
+    return len(lignes), evenements
@@ -0,0 +1,279 @@
+"""
+Agrégats horaires et journaliers de disponibilité et de temps de réponse par équipement
+"""
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, or_, select
+from app import db
+from models import AgregatHoraire, AgregatJournalier, Equipement, PositionAgregats, SketchLatence
+from partitions_historique import entite_historique
+from sketch_latence import DDSketch, fusionner_sketches
+
+logger = logging.getLogger(__name__)
+
+# Un équipement est en ligne pendant les 2 minutes qui suivent un ping (comme est_en_ligne)
+DELAI_EN_LIGNE = timedelta(minutes=2)
+
+# Au premier calcul, les heures sont rattrapées sur la durée de conservation de l'historique
+JOURS_RATTRAPAGE = 30
+
+# Au-delà de cette durée, les lectures utilisent les agrégats journaliers
+SEUIL_JOURNALIER = timedelta(days=7)
+
+
+def debut_heure(date):
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+class _Accumulateur:
+    """Agrégat d'un équipement sur une heure, alimenté par ses pings dans l'ordre chronologique"""
+
+    def __init__(self, heure):
+        self.heure = heure
+        self.fin = heure + timedelta(hours=1)
+        self.nb_pings = 0
+        self.reponse_min = None
+        self.reponse_max = None
+        self.reponse_somme = 0
+        self.nb_reponses = 0
+        self.secondes_en_ligne = 0.0
+        self.sketch = DDSketch()
+        self._couvert_jusqua = heure
+
+    def ajouter(self, timestamp, reponse_ms):
+        # Intervalle [ping, ping + délai] réuni aux précédents et limité à l'heure
+        debut = max(timestamp, self._couvert_jusqua)
+        fin = min(timestamp + DELAI_EN_LIGNE, self.fin)
+        if fin > debut:
+            self.secondes_en_ligne += (fin - debut).total_seconds()
+        self._couvert_jusqua = max(self._couvert_jusqua, timestamp + DELAI_EN_LIGNE)
+
+        # Les pings de l'heure précédente ne servent qu'à la disponibilité du début d'heure
+        if timestamp < self.heure:
+            return
+
+        self.nb_pings += 1
+        if reponse_ms is not None:
+            self.reponse_min = reponse_ms if self.reponse_min is None else min(self.reponse_min, reponse_ms)
+            self.reponse_max = reponse_ms if self.reponse_max is None else max(self.reponse_max, reponse_ms)
+            self.reponse_somme += reponse_ms
+            self.nb_reponses += 1
+            self.sketch.ajouter(reponse_ms)
+
+
+def calculer_heure(heure, intervalle_attendu=60):
+    """Calcule (ou recalcule) les agrégats de tous les équipements actifs pour une heure révolue
+
+    Les pings de l'heure sont lus en un seul parcours trié par équipement ;
+    un équipement sans ping reçoit un agrégat à zéro pour que ses heures
+    d'absence comptent dans la disponibilité.
+    """
+    fin = heure + timedelta(hours=1)
+
+    equipements = db.session.query(Equipement.id, Equipement.date_creation).filter(
+        Equipement.actif == True,
+        or_(Equipement.date_creation == None, Equipement.date_creation < fin)
+    ).all()
+    if not equipements:
+        return 0
+
+    accumulateurs = {equipement.id: _Accumulateur(heure) for equipement in equipements}
+
+    Historique = entite_historique(depuis=heure - DELAI_EN_LIGNE, jusqua=fin)
+    pings = db.session.query(
+        Historique.equipement_id,
+        Historique.timestamp,
+        Historique.reponse_ms
+    ).filter(
+        Historique.timestamp >= heure - DELAI_EN_LIGNE,
+        Historique.timestamp < fin,
+        Historique.statut == 'success'
+    ).order_by(Historique.equipement_id, Historique.timestamp).yield_per(5000)
+
+    for equipement_id, timestamp, reponse_ms in pings:
+        accumulateur = accumulateurs.get(equipement_id)
+        if accumulateur is not None:
+            accumulateur.ajouter(timestamp, reponse_ms)
+
+    # Sketches écrits au fil des pings ; à défaut (pings antérieurs, écriture perdue), sketch recalculé ici
+    partiels = _sketches_partiels(SketchLatence.heure == heure)
+
+    lignes = []
+    for equipement in equipements:
+        accumulateur = accumulateurs[equipement.id]
+        sketch = partiels.get(equipement.id) or (accumulateur.sketch if accumulateur.nb_reponses else None)
+        debut_attendu = max(heure, equipement.date_creation or heure)
+        lignes.append({
+            'equipement_id': equipement.id,
+            'heure': heure,
+            'nb_pings': accumulateur.nb_pings,
+            'nb_attendus': int((fin - debut_attendu).total_seconds() // intervalle_attendu),
+            'reponse_min': accumulateur.reponse_min,
+            'reponse_max': accumulateur.reponse_max,
+            'reponse_somme': accumulateur.reponse_somme,
+            'nb_reponses': accumulateur.nb_reponses,
+            'secondes_en_ligne': int(accumulateur.secondes_en_ligne),
+            'sketch_reponse': sketch.serialiser() if sketch else None,
+        })
+
+    db.session.execute(delete(AgregatHoraire).where(AgregatHoraire.heure == heure))
+    db.session.execute(insert(AgregatHoraire), lignes)
+    db.session.execute(delete(SketchLatence).where(SketchLatence.heure == heure))
+    return len(lignes)
+
+
+def _sketches_partiels(*filtres):
+    """Fusionne par équipement les sketches partiels qui vérifient `filtres`"""
+    partiels = {}
+    for equipement_id, texte in db.session.query(SketchLatence.equipement_id, SketchLatence.sketch).filter(*filtres):
+        sketch = DDSketch.charger(texte)
+        if equipement_id in partiels:
+            partiels[equipement_id].fusionner(sketch)
+        else:
+            partiels[equipement_id] = sketch
+    return partiels
+
+
+def consolider_sketches_tardifs(derniere_calculee):
+    """Ajoute aux agrégats horaires déjà calculés les sketches partiels écrits après coup
+
+    Retourne les journées dont l'agrégat doit être recalculé.
+    """
+    heures = [heure for heure, in db.session.query(SketchLatence.heure).filter(
+        SketchLatence.heure <= derniere_calculee
+    ).distinct()]
+
+    for heure in heures:
+        partiels = _sketches_partiels(SketchLatence.heure == heure)
+        agregats = {agregat.equipement_id: agregat for agregat in AgregatHoraire.query.filter(
+            AgregatHoraire.heure == heure,
+            AgregatHoraire.equipement_id.in_(list(partiels))
+        )}
+        for equipement_id, sketch in partiels.items():
+            agregat = agregats.get(equipement_id)
+            if agregat is not None:
+                agregat.sketch_reponse = sketch.fusionner(DDSketch.charger(agregat.sketch_reponse)).serialiser()
+        db.session.execute(delete(SketchLatence).where(SketchLatence.heure == heure))
+
+    return {heure.date() for heure in heures}
+
+
+def calculer_jour(jour):
+    """Recalcule les agrégats d'une journée à partir de ses agrégats horaires"""
+    debut = datetime(jour.year, jour.month, jour.day)
+
+    sommes = db.session.query(
+        AgregatHoraire.equipement_id,
+        func.sum(AgregatHoraire.nb_pings),
+        func.sum(AgregatHoraire.nb_attendus),
+        func.min(AgregatHoraire.reponse_min),
+        func.max(AgregatHoraire.reponse_max),
+        func.sum(AgregatHoraire.reponse_somme),
+        func.sum(AgregatHoraire.nb_reponses),
+        func.sum(AgregatHoraire.secondes_en_ligne)
+    ).filter(
+        AgregatHoraire.heure >= debut,
+        AgregatHoraire.heure < debut + timedelta(days=1)
+    ).group_by(AgregatHoraire.equipement_id).all()
+
+    sketches = {}
+    for equipement_id, sketch in db.session.query(
+        AgregatHoraire.equipement_id,
+        AgregatHoraire.sketch_reponse
+    ).filter(
+        AgregatHoraire.heure >= debut,
+        AgregatHoraire.heure < debut + timedelta(days=1),
+        AgregatHoraire.sketch_reponse != None
+    ):
+        sketches.setdefault(equipement_id, []).append(sketch)
+
+    db.session.execute(delete(AgregatJournalier).where(AgregatJournalier.jour == jour))
+    if sommes:
+        db.session.execute(insert(AgregatJournalier), [{
+            'equipement_id': equipement_id,
+            'jour': jour,
+            'nb_pings': nb_pings,
+            'nb_attendus': nb_attendus,
+            'reponse_min': reponse_min,
+            'reponse_max': reponse_max,
+            'reponse_somme': reponse_somme,
+            'nb_reponses': nb_reponses,
+            'secondes_en_ligne': secondes_en_ligne,
+            'sketch_reponse': fusionner_sketches(sketches[equipement_id]).serialiser()
+            if equipement_id in sketches else None,
+        } for equipement_id, nb_pings, nb_attendus, reponse_min, reponse_max,
+            reponse_somme, nb_reponses, secondes_en_ligne in sommes])
+
+
+def calculer_agregats(maintenant=None, intervalle_attendu=60, heures_max=24):
+    """Calcule les heures révolues pas encore agrégées (au plus `heures_max` par appel)
+
+    Chaque heure est validée séparément avec la position du calcul, qui
+    avance même quand l'heure n'a produit aucun agrégat ; les journées
+    concernées sont ensuite recalculées. Retourne le nombre d'heures traitées.
+    """
+    maintenant = maintenant or datetime.utcnow()
+    derniere_revolue = debut_heure(maintenant) - timedelta(hours=1)
+
+    position = db.session.get(PositionAgregats, 'horaire')
+    if position is not None:
+        derniere_calculee = position.heure
+    else:
+        # Base antérieure à la position : reprise après le dernier agrégat écrit
+        derniere_calculee = db.session.query(func.max(AgregatHoraire.heure)).scalar()
+    if derniere_calculee is not None:
+        heure = derniere_calculee + timedelta(hours=1)
+    else:
+        Historique = entite_historique()
+        premier_ping = db.session.query(func.min(Historique.timestamp)).scalar()
+        if premier_ping is None:
+            return 0
+        heure = max(debut_heure(premier_ping), derniere_revolue - timedelta(days=JOURS_RATTRAPAGE))
+
+    jours = consolider_sketches_tardifs(derniere_calculee) if derniere_calculee is not None else set()
+    heures = 0
+    while heure <= derniere_revolue and heures < heures_max:
+        calculer_heure(heure, intervalle_attendu)
+        if position is None:
+            position = PositionAgregats(calcul='horaire')
+            db.session.add(position)
+        position.heure = heure
+        position.date_maj = datetime.utcnow()
+        db.session.commit()
+        jours.add(heure.date())
+        heure += timedelta(hours=1)
+        heures += 1
+
+    for jour in sorted(jours):
+        calculer_jour(jour)
+    db.session.commit()
+
+    if heures:
+        logger.info(f"Agrégats calculés pour {heures} heures ({len(jours)} journées mises à jour)")
+    return heures
+
+
+def lire_agregats(equipement_id, debut, fin):
+    """Retourne les agrégats d'un équipement entre deux dates, journaliers au-delà de SEUIL_JOURNALIER"""
+    if fin - debut > SEUIL_JOURNALIER:
+        Agregat, periode = AgregatJournalier, AgregatJournalier.jour
+        filtres = [periode >= debut.date(), periode <= fin.date()]
+    else:
+        Agregat, periode = AgregatHoraire, AgregatHoraire.heure
+        filtres = [periode >= debut_heure(debut), periode < fin]
+
+    agregats = db.session.scalars(
+        select(Agregat)
+        .where(Agregat.equipement_id == equipement_id, *filtres)
+        .order_by(periode)
+    ).all()
+
+    return [{
+        'periode': (agregat.jour if Agregat is AgregatJournalier else agregat.heure).isoformat(),
+        'nb_pings': agregat.nb_pings,
+        'nb_attendus': agregat.nb_attendus,
+        'reponse_min': agregat.reponse_min,
+        'reponse_moyenne': agregat.reponse_moyenne,
+        'reponse_max': agregat.reponse_max,
+        'secondes_en_ligne': agregat.secondes_en_ligne,
+    } for agregat in agregats]
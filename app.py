@@ -11,6 +11,8 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
+logger = logging.getLogger(__name__)
+
 db = SQLAlchemy()
 
 # Create the app
@@ -30,6 +32,59 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 }
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Écriture différée de l'historique des pings (taille de file, taille de lot, intervalle en secondes)
+app.config["HISTORIQUE_TAMPON_ACTIF"] = os.environ.get("HISTORIQUE_TAMPON_ACTIF", "1") == "1"
+app.config["HISTORIQUE_TAMPON_CAPACITE"] = int(os.environ.get("HISTORIQUE_TAMPON_CAPACITE", "10000"))
+app.config["HISTORIQUE_TAMPON_LOT"] = int(os.environ.get("HISTORIQUE_TAMPON_LOT", "500"))
+app.config["HISTORIQUE_TAMPON_INTERVALLE"] = float(os.environ.get("HISTORIQUE_TAMPON_INTERVALLE", "1.0"))
+
+# Remplissage du tampon d'historique (0 à 1) à partir duquel les pings sont refusés (503 + Retry-After)
+app.config["PING_SEUIL_SATURATION"] = float(os.environ.get("PING_SEUIL_SATURATION", "0.9"))
+
+# File d'envoi des emails ('sendgrid', ou 'stub' pour un expéditeur local sans envoi réel)
+app.config["EMAIL_BACKEND"] = os.environ.get("EMAIL_BACKEND", "sendgrid")
+app.config["EMAIL_OUTBOX_CONCURRENCE"] = int(os.environ.get("EMAIL_OUTBOX_CONCURRENCE", "4"))
+app.config["EMAIL_OUTBOX_TENTATIVES"] = int(os.environ.get("EMAIL_OUTBOX_TENTATIVES", "5"))
+
+# Fenêtre (secondes) de regroupement des alertes hors ligne en un seul email par client
+app.config["ALERTE_DIGEST_FENETRE"] = int(os.environ.get("ALERTE_DIGEST_FENETRE", "300"))
+
+# Cache des statistiques du tableau de bord (URL Redis pour le partager entre workers,
+# nécessite le paquet optionnel redis : pip install .[redis])
+app.config["STATS_CACHE_TTL"] = float(os.environ.get("STATS_CACHE_TTL", "5"))
+app.config["STATS_CACHE_URL"] = os.environ.get("STATS_CACHE_URL")
+
+# Flux SSE du tableau de bord : URL Redis pour relayer les événements entre workers, nombre
+# maximal de connexions par processus et durée (secondes) d'une connexion avant reconnexion.
+# Chaque connexion occupe un thread du worker (gunicorn --worker-class gthread --threads 32) :
+# le maximum reste en dessous du nombre de threads pour laisser passer les pings et les pages
+app.config["EVENEMENTS_URL"] = os.environ.get("EVENEMENTS_URL", app.config["STATS_CACHE_URL"])
+app.config["EVENEMENTS_ABONNES_MAX"] = int(os.environ.get("EVENEMENTS_ABONNES_MAX", "16"))
+app.config["EVENEMENTS_DUREE_FLUX"] = int(os.environ.get("EVENEMENTS_DUREE_FLUX", "300"))
+
+# Détection hors ligne à l'échéance exacte de chaque équipement ; le balayage complet (secondes)
+# ne sert plus alors qu'au rattrapage (alertes répétées, équipements jamais vus, autres processus)
+app.config["DETECTEUR_HORS_LIGNE_ACTIF"] = os.environ.get("DETECTEUR_HORS_LIGNE_ACTIF", "1") == "1"
+app.config["HORS_LIGNE_BALAYAGE"] = int(os.environ.get(
+    "HORS_LIGNE_BALAYAGE", "600" if app.config["DETECTEUR_HORS_LIGNE_ACTIF"] else "60"
+))
+
+# Écouteur UDP des battements (ecouteur_udp.py) : adresse, taille de lot, intervalle d'écriture
+# en secondes et nombre maximal de battements en attente d'écriture
+app.config["UDP_BATTEMENTS_HOTE"] = os.environ.get("UDP_BATTEMENTS_HOTE", "0.0.0.0")
+app.config["UDP_BATTEMENTS_PORT"] = int(os.environ.get("UDP_BATTEMENTS_PORT", "5001"))
+app.config["UDP_BATTEMENTS_LOT"] = int(os.environ.get("UDP_BATTEMENTS_LOT", "5000"))
+app.config["UDP_BATTEMENTS_INTERVALLE"] = float(os.environ.get("UDP_BATTEMENTS_INTERVALLE", "0.2"))
+app.config["UDP_BATTEMENTS_EN_ATTENTE_MAX"] = int(os.environ.get("UDP_BATTEMENTS_EN_ATTENTE_MAX", "50000"))
+
+# Intervalle (secondes) entre deux pings d'un équipement, base du nombre de pings attendus par heure
+app.config["PING_INTERVALLE_ATTENDU"] = int(os.environ.get("PING_INTERVALLE_ATTENDU", "60"))
+
+# Purge par lots des données expirées (taille d'un lot, pause entre lots et budget par passe en secondes)
+app.config["RETENTION_LOT"] = int(os.environ.get("RETENTION_LOT", "1000"))
+app.config["RETENTION_PAUSE"] = float(os.environ.get("RETENTION_PAUSE", "0.1"))
+app.config["RETENTION_BUDGET"] = int(os.environ.get("RETENTION_BUDGET", "300"))
+
 # Initialize the app with the extension
 db.init_app(app)
 
@@ -49,16 +104,40 @@ def load_user(user_id):
     from models import User
     return User.query.get(int(user_id))
 
+def init_connexions():
+    """Configure le cache des statistiques et le bus d'événements, sans tâche d'arrière-plan
+
+    Suffit aux processus annexes (écouteur UDP) qui écrivent des pings dans
+    une base déjà initialisée par le serveur web.
+    """
+    with app.app_context():
+        from statistiques import cache_statistiques
+        cache_statistiques.configurer(app)
+        from evenements import bus_evenements
+        bus_evenements.configurer(app)
+
 # Initialize database and scheduler in a function
 def init_app():
     with app.app_context():
         db.create_all()
+        from migrations import appliquer_migrations
+        appliquer_migrations()
+    init_connexions()
+    with app.app_context():
+        if app.config["HISTORIQUE_TAMPON_ACTIF"]:
+            from tampon_historique import tampon_historique
+            tampon_historique.demarrer(app)
+        from email_outbox import email_outbox
+        email_outbox.demarrer(app)
+        if app.config["DETECTEUR_HORS_LIGNE_ACTIF"]:
+            from detecteur_hors_ligne import detecteur_hors_ligne
+            from scheduler import verifier_equipements_hors_ligne
+            detecteur_hors_ligne.demarrer(app, verifier_equipements_hors_ligne)
         from scheduler import init_scheduler
         init_scheduler(app)
 
-# Only initialize if this is the main execution
-if __name__ != '__main__':
+# Only initialize if this is the main execution (APP_INIT=0 : processus annexe qui appelle init_connexions)
+if __name__ != '__main__' and os.environ.get("APP_INIT", "1") == "1":
     init_app()
 
-logger = logging.getLogger(__name__)
 logger.info("Application initialized successfully")
@@ -0,0 +1,116 @@
+"""
+Index en mémoire des équipements pour résoudre les pings sans aller-retour en base
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from app import db
+from models import Equipement
+
+logger = logging.getLogger(__name__)
+
+EquipementInfo = namedtuple('EquipementInfo', ['id', 'nom', 'adresse_ip', 'client_id', 'actif'])
+
+# Plus grand ID représentable par la colonne Equipement.id (INTEGER 32 bits signé)
+ID_MAX = 2 ** 31 - 1
+
+COLONNES = (Equipement.id, Equipement.nom, Equipement.adresse_ip, Equipement.client_id, Equipement.actif)
+
+
+class CacheEquipements:
+    """Index par ID et par IP de l'identité des équipements, propre au processus
+
+    L'index est invalidé explicitement par les routes qui modifient les
+    équipements. La durée de vie borne le décalage entre processus (workers
+    gunicorn) puisque chaque processus ne voit que ses propres invalidations ;
+    l'ingestion relit de toute façon `actif` en base avant d'écrire et retire
+    de l'index un équipement supprimé ou désactivé entre-temps.
+    """
+
+    def __init__(self, duree_vie=300):
+        self.duree_vie = duree_vie
+        self._lock = threading.Lock()
+        self._par_id = None
+        self._par_ip = None
+        self._charge_le = 0
+
+    def _charger(self):
+        par_id = {}
+        par_ip = {}
+        for ligne in db.session.query(*COLONNES).order_by(Equipement.id):
+            info = EquipementInfo(*ligne)
+            par_id[info.id] = info
+            if info.actif:
+                par_ip.setdefault(info.adresse_ip, info)
+
+        self._par_id = par_id
+        self._par_ip = par_ip
+        self._charge_le = time.monotonic()
+        logger.debug(f"Cache des équipements chargé: {len(par_id)} équipements")
+
+    def _index(self):
+        with self._lock:
+            if self._par_id is None or time.monotonic() - self._charge_le > self.duree_vie:
+                self._charger()
+            return self._par_id, self._par_ip
+
+    def _ajouter(self, ligne):
+        info = EquipementInfo(*ligne)
+        with self._lock:
+            if self._par_id is not None:
+                self._par_id[info.id] = info
+                if info.actif:
+                    self._par_ip.setdefault(info.adresse_ip, info)
+        return info
+
+    def par_id(self, equipement_id):
+        """Retourne l'équipement correspondant à l'ID (actif ou non), ou None"""
+        try:
+            equipement_id = int(equipement_id)
+        except (TypeError, ValueError):
+            return None
+        # Hors de la plage de la colonne, la requête échouerait au lieu de ne rien trouver
+        if not 0 < equipement_id <= ID_MAX:
+            return None
+
+        par_id, _ = self._index()
+        info = par_id.get(equipement_id)
+        if info is None:
+            # Équipement créé par un autre processus depuis le chargement
+            ligne = db.session.query(*COLONNES).filter(Equipement.id == equipement_id).first()
+            if ligne:
+                info = self._ajouter(ligne)
+        return info
+
+    def par_ip(self, adresse_ip):
+        """Retourne l'équipement actif correspondant à l'adresse IP, ou None"""
+        _, par_ip = self._index()
+        info = par_ip.get(adresse_ip)
+        if info is None:
+            ligne = db.session.query(*COLONNES).filter(
+                Equipement.adresse_ip == adresse_ip,
+                Equipement.actif == True
+            ).order_by(Equipement.id).first()
+            if ligne:
+                info = self._ajouter(ligne)
+        return info
+
+    def oublier(self, equipement_id):
+        """Retire un équipement de l'index (supprimé ou désactivé, éventuellement par un autre processus)"""
+        with self._lock:
+            if self._par_id is None:
+                return
+            info = self._par_id.pop(equipement_id, None)
+            if info is not None and self._par_ip.get(info.adresse_ip) == info:
+                del self._par_ip[info.adresse_ip]
+
+    def invalider(self):
+        """Force le rechargement de l'index au prochain accès"""
+        with self._lock:
+            self._par_id = None
+            self._par_ip = None
+
+
+# Instance globale du cache des équipements
+cache_equipements = CacheEquipements()
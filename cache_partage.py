@@ -0,0 +1,94 @@
+"""
+Backends de cache à durée de vie courte : mémoire du processus ou serveur compatible Redis
+"""
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CacheMemoire:
+    """Cache propre au processus, suffisant avec un seul worker"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._valeurs = {}
+        self._generation = 0
+
+    def generation(self):
+        return self._generation
+
+    def incrementer_generation(self):
+        with self._lock:
+            self._generation += 1
+            self._valeurs.clear()
+
+    def lire(self, cle):
+        with self._lock:
+            entree = self._valeurs.get(cle)
+            if entree is None:
+                return None
+            valeur, expiration = entree
+            if expiration < time.monotonic():
+                del self._valeurs[cle]
+                return None
+            return valeur
+
+    def ecrire(self, cle, valeur, ttl):
+        with self._lock:
+            self._valeurs[cle] = (valeur, time.monotonic() + ttl)
+
+    def reserver(self, cle, ttl):
+        """Un seul processus : le verrou local de l'appelant suffit"""
+        return True
+
+    def liberer(self, cle):
+        pass
+
+
+class CacheRedis:
+    """Cache partagé entre workers sur un serveur compatible Redis (Redis, Valkey, KeyDB...)
+
+    Nécessite le paquet optionnel redis (pip install .[redis]).
+    """
+
+    def __init__(self, url, prefixe='camera-monitor'):
+        import redis
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self._prefixe = prefixe
+        self._client.ping()
+
+    def _cle(self, cle):
+        return f'{self._prefixe}:{cle}'
+
+    def generation(self):
+        return int(self._client.get(self._cle('generation')) or 0)
+
+    def incrementer_generation(self):
+        self._client.incr(self._cle('generation'))
+
+    def lire(self, cle):
+        valeur = self._client.get(self._cle(cle))
+        return json.loads(valeur) if valeur is not None else None
+
+    def ecrire(self, cle, valeur, ttl):
+        self._client.set(self._cle(cle), json.dumps(valeur), px=int(ttl * 1000))
+
+    def reserver(self, cle, ttl):
+        """Réserve le calcul d'une clé pour tous les workers, au plus `ttl` secondes"""
+        return bool(self._client.set(self._cle(f'calcul:{cle}'), 1, nx=True, px=int(ttl * 1000)))
+
+    def liberer(self, cle):
+        self._client.delete(self._cle(f'calcul:{cle}'))
+
+
+def creer_backend(url=None):
+    """Crée le backend Redis si une URL est configurée et joignable, sinon le cache mémoire"""
+    if url:
+        try:
+            return CacheRedis(url)
+        except Exception as e:
+            logger.warning(f"Cache partagé indisponible ({url}): {e}. Utilisation du cache mémoire.")
+    return CacheMemoire()
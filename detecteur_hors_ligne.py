@@ -0,0 +1,138 @@
+"""
+Détection des équipements hors ligne à leur échéance exacte, par un tas d'échéances en mémoire
+"""
+import atexit
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+from app import db
+from models import Equipement
+
+logger = logging.getLogger(__name__)
+
+
+class DetecteurHorsLigne:
+    """Tas binaire (heapq) des échéances de passage hors ligne, une entrée par équipement
+
+    Un ping repousse l'échéance de son équipement dans un dictionnaire, en
+    O(1) ; l'entrée du tas n'est pas déplacée. Quand une entrée est atteinte
+    alors que l'échéance a été repoussée, elle est réinsérée à la nouvelle
+    échéance (suppression paresseuse). Un thread dort jusqu'à la prochaine
+    échéance et fait vérifier en base les équipements échus : la base reste
+    la référence quand plusieurs processus reçoivent les pings.
+    """
+
+    def __init__(self, delai=timedelta(minutes=2)):
+        self.delai = delai
+        self._tas = []
+        self._echeances = {}
+        self._condition = threading.Condition()
+        self._arret = False
+        self._thread = None
+        self._app = None
+        self._verifier = None
+
+    @property
+    def actif(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def demarrer(self, app, verifier):
+        """Démarre le thread puis charge l'échéance de chaque équipement actif pas encore hors ligne
+
+        `verifier(equipement_ids)` passe hors ligne ceux dont le dernier ping a
+        effectivement expiré.
+        """
+        if self._thread is not None:
+            return
+
+        self._app = app
+        self._verifier = verifier
+        self._thread = threading.Thread(target=self._boucle, name='detecteur-hors-ligne', daemon=True)
+        self._thread.start()
+        atexit.register(self.arreter)
+
+        with app.app_context():
+            self._armer(db.session.query(Equipement.id, Equipement.dernier_ping).filter(
+                Equipement.actif == True,
+                Equipement.etat != 'hors_ligne',
+                Equipement.dernier_ping != None
+            ).all())
+
+        logger.info(f"Détecteur hors ligne démarré ({len(self._echeances)} échéances)")
+
+    def arreter(self):
+        with self._condition:
+            self._arret = True
+            self._condition.notify()
+
+    def signaler(self, equipement_id, dernier_ping):
+        """Repousse l'échéance d'un équipement à dernier_ping + délai"""
+        if self._thread is None:
+            return
+
+        echeance = dernier_ping + self.delai
+        with self._condition:
+            actuelle = self._echeances.get(equipement_id)
+            if actuelle is not None and actuelle >= echeance:
+                return
+            self._echeances[equipement_id] = echeance
+            if actuelle is None:
+                heapq.heappush(self._tas, (echeance, equipement_id))
+                # Nouvelle première échéance : réveiller le thread pour qu'il raccourcisse son attente
+                if self._tas[0][1] == equipement_id:
+                    self._condition.notify()
+
+    def _armer(self, lignes):
+        for equipement_id, dernier_ping in lignes:
+            self.signaler(equipement_id, dernier_ping)
+
+    def _extraire_echus(self, maintenant):
+        echus = []
+        while self._tas and self._tas[0][0] <= maintenant:
+            echeance, equipement_id = heapq.heappop(self._tas)
+            actuelle = self._echeances.get(equipement_id)
+            if actuelle is None:
+                continue
+            if actuelle > echeance:
+                heapq.heappush(self._tas, (actuelle, equipement_id))
+            else:
+                del self._echeances[equipement_id]
+                echus.append(equipement_id)
+        return echus
+
+    def _boucle(self):
+        while True:
+            with self._condition:
+                while not self._arret:
+                    maintenant = datetime.utcnow()
+                    if self._tas and self._tas[0][0] <= maintenant:
+                        break
+                    attente = (self._tas[0][0] - maintenant).total_seconds() if self._tas else None
+                    self._condition.wait(attente)
+                if self._arret:
+                    return
+                echus = self._extraire_echus(datetime.utcnow())
+
+            if echus:
+                self._traiter(echus)
+
+    def _traiter(self, equipement_ids):
+        self._verifier(equipement_ids)
+
+        # Équipements qui ont reçu un ping entre-temps (éventuellement par un autre processus) : réarmés
+        with self._app.app_context():
+            try:
+                self._armer(db.session.query(Equipement.id, Equipement.dernier_ping).filter(
+                    Equipement.id.in_(equipement_ids),
+                    Equipement.actif == True,
+                    Equipement.etat != 'hors_ligne',
+                    Equipement.dernier_ping > datetime.utcnow() - self.delai
+                ).all())
+            except Exception as e:
+                logger.error(f"Erreur lors du réarmement des échéances: {e}")
+                db.session.rollback()
+
+
+# Instance globale du détecteur
+detecteur_hors_ligne = DetecteurHorsLigne()
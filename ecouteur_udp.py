@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Écouteur UDP des battements de cœur des équipements, à lancer dans un processus séparé
+Usage: python ecouteur_udp.py
+
+Un battement tient dans un datagramme, sous l'une des deux formes :
+- binaire (13 octets) : version 1 (uint8), ID d'équipement (uint32), numéro
+  de séquence (uint32), temps de réponse en ms (float32, NaN si inconnu),
+  en ordre réseau ;
+- texte ASCII : "<id> <séquence> [<temps de réponse ms>]" (espaces ou virgules).
+
+Les battements sont enregistrés par lots avec traiter_lot_pings, comme les
+pings reçus par HTTP. Les événements temps réel et l'invalidation du cache des
+statistiques n'atteignent les workers web que si EVENEMENTS_URL et
+STATS_CACHE_URL désignent un Redis partagé.
+"""
+import asyncio
+import logging
+import math
+import os
+import signal
+import socket
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+VERSION_BINAIRE = 1
+FORMAT_BINAIRE = struct.Struct('!BIIf')
+
+# Identifiants et numéros de séquence tiennent sur 32 bits non signés, comme dans la forme binaire
+ENTIER_MAX = 0xFFFFFFFF
+
+# Un numéro de séquence en retard de moins de FENETRE_SEQUENCE est un doublon ou un datagramme désordonné ;
+# au-delà, l'équipement est considéré comme redémarré et sa séquence repart de zéro
+FENETRE_SEQUENCE = 64
+
+# Tampon de réception du socket, pour absorber les rafales pendant l'écriture d'un lot
+TAILLE_TAMPON_SOCKET = 4 * 1024 * 1024
+
+# Intervalle (secondes) entre deux journalisations des compteurs
+INTERVALLE_COMPTEURS = 60
+
+# Intervalle (secondes) entre deux écritures des sketches de latence (fait par le planificateur côté web)
+INTERVALLE_SKETCHES = 60
+
+
+def encoder_battement(equipement_id, sequence, reponse_ms=None):
+    """Datagramme binaire d'un battement (côté équipement)"""
+    return FORMAT_BINAIRE.pack(VERSION_BINAIRE, equipement_id, sequence & ENTIER_MAX,
+                               math.nan if reponse_ms is None else reponse_ms)
+
+
+def decoder_battement(donnees):
+    """Retourne (equipement_id, sequence, reponse_ms) ou None si le datagramme est invalide"""
+    if donnees[:1] == bytes([VERSION_BINAIRE]):
+        if len(donnees) != FORMAT_BINAIRE.size:
+            return None
+        _, equipement_id, sequence, reponse_ms = FORMAT_BINAIRE.unpack(donnees)
+        if equipement_id == 0:
+            return None
+        return equipement_id, sequence, None if math.isnan(reponse_ms) else round(reponse_ms, 1)
+
+    try:
+        champs = donnees.decode('ascii').replace(',', ' ').split()
+        if len(champs) not in (2, 3):
+            return None
+        reponse_ms = float(champs[2]) if len(champs) == 3 else None
+        if reponse_ms is not None and not math.isfinite(reponse_ms):
+            return None
+        equipement_id, sequence = int(champs[0]), int(champs[1])
+        if not (0 < equipement_id <= ENTIER_MAX and 0 <= sequence <= ENTIER_MAX):
+            return None
+        return equipement_id, sequence, reponse_ms
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+class EcouteurUDP(asyncio.DatagramProtocol):
+    """Reçoit les battements et les passe par lots à traiter_lot_pings dans un thread dédié
+
+    Un seul lot est écrit à la fois ; les battements reçus pendant l'écriture
+    forment le lot suivant. Au-delà de `en_attente_max` battements en attente,
+    les nouveaux sont abandonnés (l'équipement en enverra un autre). Les
+    numéros de séquence ne sont suivis que pour les équipements dont un
+    battement a été accepté.
+    """
+
+    def __init__(self, app, taille_lot=5000, intervalle=0.2, en_attente_max=50000):
+        self.app = app
+        self.taille_lot = taille_lot
+        self.intervalle = intervalle
+        self.en_attente_max = en_attente_max
+        self._en_attente = []
+        self._sequences = {}
+        self._executeur = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ecouteur-udp')
+        self._ecriture = None
+        self._arrete = False
+        self._compteurs = {
+            'recus': 0,
+            'invalides': 0,
+            'doublons': 0,
+            'abandonnes': 0,
+            'enregistres': 0,
+            'refuses': 0,
+        }
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info('socket')
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TAILLE_TAMPON_SOCKET)
+        except OSError as e:
+            logger.warning(f"Tampon de réception UDP non agrandi: {e}")
+
+    def datagram_received(self, donnees, adresse):
+        self._compteurs['recus'] += 1
+        battement = decoder_battement(donnees)
+        if battement is None:
+            self._compteurs['invalides'] += 1
+            return
+
+        equipement_id, sequence, reponse_ms = battement
+        if equipement_id in self._sequences and not self._nouvelle_sequence(equipement_id, sequence):
+            self._compteurs['doublons'] += 1
+            return
+        if len(self._en_attente) >= self.en_attente_max:
+            self._compteurs['abandonnes'] += 1
+            return
+
+        self._en_attente.append({
+            'equipement_id': equipement_id,
+            'sequence': sequence,
+            'response_time': reponse_ms,
+            'message': 'Battement UDP',
+        })
+        if len(self._en_attente) >= self.taille_lot:
+            self._vider()
+
+    def _nouvelle_sequence(self, equipement_id, sequence):
+        precedente = self._sequences.get(equipement_id)
+        if precedente is not None and (precedente - sequence) & ENTIER_MAX < FENETRE_SEQUENCE:
+            return False
+        self._sequences[equipement_id] = sequence
+        return True
+
+    def _vider(self):
+        """Lance l'écriture du prochain lot si aucune n'est en cours"""
+        if not self._en_attente or (self._ecriture is not None and not self._ecriture.done()):
+            return
+
+        lot = self._en_attente[:self.taille_lot]
+        del self._en_attente[:self.taille_lot]
+        self._ecriture = asyncio.get_running_loop().run_in_executor(self._executeur, self._enregistrer, lot)
+        self._ecriture.add_done_callback(lambda ecriture: self._lot_termine(lot, ecriture))
+
+    def _lot_termine(self, lot, ecriture):
+        if not ecriture.cancelled() and ecriture.exception() is None:
+            self._compter_lot(lot, ecriture.result())
+        # Battements arrivés pendant l'écriture
+        if not self._arrete:
+            self._vider()
+
+    def _compter_lot(self, lot, acceptes):
+        for battement, accepte in zip(lot, acceptes):
+            if accepte:
+                self._compteurs['enregistres'] += 1
+                self._sequences.setdefault(battement['equipement_id'], battement['sequence'])
+            else:
+                self._compteurs['refuses'] += 1
+                # Équipement inconnu ou supprimé : sa séquence n'est plus conservée
+                self._sequences.pop(battement['equipement_id'], None)
+
+    def _enregistrer(self, lot):
+        """Enregistre un lot et retourne, pour chaque battement, s'il a été accepté"""
+        from app import db
+        from ingestion import traiter_lot_pings
+
+        with self.app.app_context():
+            try:
+                return [resultat['status'] == 'success' for resultat in traiter_lot_pings(lot)]
+            except Exception as e:
+                logger.error(f"Erreur lors de l'enregistrement d'un lot de {len(lot)} battements UDP: {e}")
+                db.session.rollback()
+                if len(lot) == 1 or not self._base_joignable():
+                    return [False] * len(lot)
+
+        # Base joignable : une ligne fautive ne doit pas faire perdre le lot, chaque moitié est réessayée
+        milieu = len(lot) // 2
+        return self._enregistrer(lot[:milieu]) + self._enregistrer(lot[milieu:])
+
+    def _base_joignable(self):
+        from sqlalchemy import text
+        from app import db
+
+        try:
+            db.session.execute(text('SELECT 1'))
+            return True
+        except Exception:
+            db.session.rollback()
+            return False
+
+    def _enregistrer_sketches(self):
+        from app import db
+        from sketch_latence import sketches_latence
+
+        with self.app.app_context():
+            try:
+                sketches_latence.enregistrer()
+            except Exception as e:
+                logger.error(f"Erreur lors de l'écriture des sketches de latence: {e}")
+                db.session.rollback()
+
+    async def executer(self, arret):
+        """Vide les battements toutes les `intervalle` secondes jusqu'à l'arrêt, puis écrit les derniers"""
+        loop = asyncio.get_running_loop()
+        prochains_compteurs = loop.time() + INTERVALLE_COMPTEURS
+        prochains_sketches = loop.time() + INTERVALLE_SKETCHES
+
+        while not arret.is_set():
+            try:
+                await asyncio.wait_for(arret.wait(), self.intervalle)
+            except asyncio.TimeoutError:
+                pass
+            self._vider()
+
+            if loop.time() >= prochains_compteurs:
+                logger.info(f"Battements UDP: {self._compteurs}, {len(self._en_attente)} en attente")
+                prochains_compteurs = loop.time() + INTERVALLE_COMPTEURS
+
+            if loop.time() >= prochains_sketches:
+                loop.run_in_executor(self._executeur, self._enregistrer_sketches)
+                prochains_sketches = loop.time() + INTERVALLE_SKETCHES
+
+        self._arrete = True
+        if self._ecriture is not None:
+            await self._ecriture
+        while self._en_attente:
+            lot = self._en_attente[:self.taille_lot]
+            del self._en_attente[:self.taille_lot]
+            self._compter_lot(lot, await loop.run_in_executor(self._executeur, self._enregistrer, lot))
+        await loop.run_in_executor(self._executeur, self._enregistrer_sketches)
+        self._executeur.shutdown()
+        logger.info(f"Écouteur UDP arrêté: {self._compteurs}")
+
+
+async def ecouter(app):
+    """Ouvre le socket UDP et traite les battements jusqu'à SIGINT/SIGTERM"""
+    loop = asyncio.get_running_loop()
+    hote = app.config['UDP_BATTEMENTS_HOTE']
+    port = app.config['UDP_BATTEMENTS_PORT']
+
+    transport, ecouteur = await loop.create_datagram_endpoint(
+        lambda: EcouteurUDP(
+            app,
+            taille_lot=app.config['UDP_BATTEMENTS_LOT'],
+            intervalle=app.config['UDP_BATTEMENTS_INTERVALLE'],
+            en_attente_max=app.config['UDP_BATTEMENTS_EN_ATTENTE_MAX']
+        ),
+        local_addr=(hote, port)
+    )
+    logger.info(f"Écouteur UDP des battements démarré sur {hote}:{port}")
+
+    arret = asyncio.Event()
+    for signal_arret in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_arret, arret.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows : Ctrl+C interrompt asyncio.run
+            pass
+
+    try:
+        await ecouteur.executer(arret)
+    finally:
+        transport.close()
+
+
+def main():
+    # Ni planificateur, ni tampon d'historique, ni file d'emails : ils tournent dans le serveur web
+    os.environ['APP_INIT'] = '0'
+    from app import app, init_connexions
+    init_connexions()
+    asyncio.run(ecouter(app))
+
+
+if __name__ == '__main__':
+    main()
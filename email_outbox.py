@@ -0,0 +1,207 @@
+"""
+File d'envoi des emails (outbox) traitée par un pool de threads
+"""
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from sqlalchemy import update, or_
+from app import db
+from models import EmailSortant
+from email_service import email_service
+
+logger = logging.getLogger(__name__)
+
+
+class ExpediteurStub:
+    """Expéditeur local qui conserve les emails au lieu de les envoyer (tests, développement)
+
+    `echecs` permet de simuler un nombre d'échecs avant le premier envoi réussi.
+    """
+
+    def __init__(self, echecs=0):
+        self.echecs = echecs
+        self.envoyes = []
+        self._lock = threading.Lock()
+
+    def __call__(self, destinataire, sujet, contenu_html):
+        with self._lock:
+            if self.echecs > 0:
+                self.echecs -= 1
+                raise RuntimeError("Échec simulé par l'expéditeur local")
+            self.envoyes.append({
+                'destinataire': destinataire,
+                'sujet': sujet,
+                'contenu_html': contenu_html,
+                'date': datetime.utcnow(),
+            })
+        logger.info(f"Email (stub) pour {destinataire}: {sujet}")
+
+
+class OutboxEmail:
+    """Envoie les emails de la table emails_sortants avec une concurrence bornée
+
+    Chaque email est réservé par un UPDATE conditionnel avant l'envoi, ce qui
+    permet à plusieurs processus de partager la file. La réservation expire
+    après `duree_reservation` pour reprendre les envois interrompus par un
+    arrêt brutal. Les échecs sont retentés avec un délai exponentiel.
+    """
+
+    def __init__(self, concurrence=4, tentatives_max=5, delai_base=30, delai_max=3600,
+                 intervalle=5.0, taille_lot=50, duree_reservation=600):
+        self.concurrence = concurrence
+        self.tentatives_max = tentatives_max
+        self.delai_base = delai_base
+        self.delai_max = delai_max
+        self.intervalle = intervalle
+        self.taille_lot = taille_lot
+        self.duree_reservation = duree_reservation
+        self.expediteur = None
+        self._app = None
+        self._pool = None
+        self._thread = None
+        self._arret = threading.Event()
+        self._reveil = threading.Event()
+
+    def demarrer(self, app, expediteur=None):
+        """Démarre le thread de distribution et son pool d'envoi
+
+        Sans expéditeur explicite, EMAIL_BACKEND choisit entre SendGrid et
+        l'expéditeur local ('stub').
+        """
+        if self._thread is not None:
+            return
+
+        if expediteur is None:
+            expediteur = ExpediteurStub() if app.config.get('EMAIL_BACKEND') == 'stub' else email_service.deliver
+
+        self._app = app
+        self.expediteur = expediteur
+        self.concurrence = app.config.get('EMAIL_OUTBOX_CONCURRENCE', self.concurrence)
+        self.tentatives_max = app.config.get('EMAIL_OUTBOX_TENTATIVES', self.tentatives_max)
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrence, thread_name_prefix='outbox-email')
+        self._thread = threading.Thread(target=self._boucle, name='outbox-email', daemon=True)
+        self._thread.start()
+        atexit.register(self.arreter)
+
+        logger.info(f"File d'envoi des emails démarrée ({self.concurrence} envois simultanés)")
+
+    def arreter(self, timeout=30):
+        """Arrête la distribution après les envois en cours"""
+        if self._thread is None:
+            return
+
+        self._arret.set()
+        self._reveil.set()
+        self._thread.join(timeout)
+        self._pool.shutdown(wait=True)
+        self._thread = None
+        logger.info("File d'envoi des emails arrêtée")
+
+    def reveiller(self):
+        """Déclenche un passage immédiat, par exemple après un commit contenant des emails"""
+        self._reveil.set()
+
+    def _boucle(self):
+        while not self._arret.is_set():
+            try:
+                while self.traiter_lot() and not self._arret.is_set():
+                    pass
+            except Exception as e:
+                logger.error(f"Erreur dans la file d'envoi des emails: {e}")
+
+            self._reveil.wait(self.intervalle)
+            self._reveil.clear()
+
+    def _reserver(self, maintenant):
+        """Réserve les emails dus et retourne leurs données"""
+        echeance = or_(
+            EmailSortant.statut == 'en_attente',
+            EmailSortant.statut == 'en_cours'
+        )
+        candidats = db.session.query(EmailSortant.id).filter(
+            echeance,
+            EmailSortant.prochaine_tentative <= maintenant
+        ).order_by(EmailSortant.id).limit(self.taille_lot).all()
+
+        reserves = []
+        for (email_id,) in candidats:
+            resultat = db.session.execute(
+                update(EmailSortant)
+                .where(
+                    EmailSortant.id == email_id,
+                    echeance,
+                    EmailSortant.prochaine_tentative <= maintenant
+                )
+                .values(statut='en_cours', prochaine_tentative=maintenant + timedelta(seconds=self.duree_reservation))
+                .execution_options(synchronize_session=False)
+            )
+            if resultat.rowcount == 1:
+                reserves.append(email_id)
+        db.session.commit()
+
+        if not reserves:
+            return []
+
+        return db.session.query(
+            EmailSortant.id,
+            EmailSortant.destinataire,
+            EmailSortant.sujet,
+            EmailSortant.contenu_html,
+            EmailSortant.tentatives
+        ).filter(EmailSortant.id.in_(reserves)).all()
+
+    def traiter_lot(self):
+        """Envoie un lot d'emails dus, retourne le nombre d'emails traités"""
+        with self._app.app_context():
+            emails = self._reserver(datetime.utcnow())
+
+        if not emails:
+            return 0
+
+        futures = [self._pool.submit(self._envoyer, email) for email in emails]
+        wait(futures)
+        return len(emails)
+
+    def _envoyer(self, email):
+        erreur = None
+        try:
+            self.expediteur(email.destinataire, email.sujet, email.contenu_html)
+        except Exception as e:
+            erreur = str(e) or e.__class__.__name__
+
+        maintenant = datetime.utcnow()
+        tentatives = (email.tentatives or 0) + 1
+
+        if erreur is None:
+            valeurs = {'statut': 'envoye', 'tentatives': tentatives, 'date_envoi': maintenant, 'derniere_erreur': None}
+        elif tentatives >= self.tentatives_max:
+            valeurs = {'statut': 'echec', 'tentatives': tentatives, 'derniere_erreur': erreur}
+            logger.error(f"Abandon de l'email {email.id} pour {email.destinataire} après {tentatives} tentatives: {erreur}")
+        else:
+            delai = min(self.delai_base * 2 ** (tentatives - 1), self.delai_max)
+            valeurs = {
+                'statut': 'en_attente',
+                'tentatives': tentatives,
+                'derniere_erreur': erreur,
+                'prochaine_tentative': maintenant + timedelta(seconds=delai)
+            }
+            logger.warning(f"Échec de l'envoi de l'email {email.id} à {email.destinataire}, nouvel essai dans {delai}s: {erreur}")
+
+        with self._app.app_context():
+            try:
+                db.session.execute(
+                    update(EmailSortant)
+                    .where(EmailSortant.id == email.id)
+                    .values(**valeurs)
+                    .execution_options(synchronize_session=False)
+                )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Erreur lors de la mise à jour du statut de l'email {email.id}: {e}")
+
+
+# Instance globale de la file d'envoi
+email_outbox = OutboxEmail()
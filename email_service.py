@@ -3,8 +3,11 @@ Service d'envoi d'emails avec SendGrid
 """
 import os
 import logging
+from datetime import datetime
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, Email, To, Content
+from app import db
+from models import EmailSortant
 
 logger = logging.getLogger(__name__)
 
@@ -46,8 +49,44 @@ class EmailService:
             logger.error(f"Erreur lors de l'envoi de l'email à {to_email}: {e}")
             return False
     
+    def deliver(self, to_email, subject, html_content):
+        """Envoie un email HTML et lève une exception en cas d'échec (utilisé par la file d'envoi)"""
+        if not self.sg:
+            raise RuntimeError("Service email non configuré")
+        
+        message = Mail(
+            from_email=Email(self.from_email),
+            to_emails=To(to_email),
+            subject=subject
+        )
+        message.content = Content("text/html", html_content)
+        
+        response = self.sg.send(message)
+        if response.status_code >= 400:
+            raise RuntimeError(f"Réponse SendGrid inattendue: {response.status_code}")
+        logger.info(f"Email envoyé avec succès à {to_email}. Status: {response.status_code}")
+    
+    def queue_email(self, to_email, subject, html_content):
+        """Ajoute un email à la file d'envoi, enregistré avec le commit de l'appelant"""
+        email = EmailSortant()
+        email.destinataire = to_email
+        email.sujet = subject
+        email.contenu_html = html_content
+        db.session.add(email)
+        return email
+    
     def send_equipment_offline_alert(self, client_email, client_name, equipment_name, equipment_type, equipment_ip):
         """Envoie une alerte d'équipement hors ligne"""
+        subject, html_content = self.equipment_offline_alert_content(client_name, equipment_name, equipment_type, equipment_ip)
+        return self.send_email(client_email, subject, html_content=html_content)
+    
+    def queue_equipment_offline_alert(self, client_email, client_name, equipment_name, equipment_type, equipment_ip):
+        """Ajoute une alerte d'équipement hors ligne à la file d'envoi"""
+        subject, html_content = self.equipment_offline_alert_content(client_name, equipment_name, equipment_type, equipment_ip)
+        return self.queue_email(client_email, subject, html_content)
+    
+    def equipment_offline_alert_content(self, client_name, equipment_name, equipment_type, equipment_ip):
+        """Construit le sujet et le contenu HTML d'une alerte d'équipement hors ligne"""
         subject = f"🚨 Alerte Équipement Hors Ligne - {equipment_name}"
         
         html_content = f"""
@@ -107,10 +146,166 @@ class EmailService:
         </html>
         """
         
-        return self.send_email(client_email, subject, html_content=html_content)
+        return subject, html_content
+    
+    def queue_equipment_offline_digest(self, client_email, client_name, equipments):
+        """Ajoute un récapitulatif des équipements hors ligne d'un client à la file d'envoi"""
+        subject, html_content = self.equipment_offline_digest_content(client_name, equipments)
+        return self.queue_email(client_email, subject, html_content)
+    
+    def equipment_offline_digest_content(self, client_name, equipments):
+        """Construit un email unique listant plusieurs équipements hors ligne d'un même client
+
+        `equipments` est une liste de dictionnaires avec les clés name, type, ip et since.
+        """
+        subject = f"🚨 Alerte : {len(equipments)} équipements hors ligne - {client_name}"
+        
+        rows = "".join(f"""
+                            <tr>
+                                <td style="padding: 8px; border-bottom: 1px solid #dee2e6;">{equipment['name']}</td>
+                                <td style="padding: 8px; border-bottom: 1px solid #dee2e6;">{equipment['type']}</td>
+                                <td style="padding: 8px; border-bottom: 1px solid #dee2e6;">{equipment['ip']}</td>
+                                <td style="padding: 8px; border-bottom: 1px solid #dee2e6;">{equipment['since'].strftime('%d/%m/%Y %H:%M')} UTC</td>
+                            </tr>""" for equipment in equipments)
+        
+        html_content = f"""
+        <html>
+        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
+            <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
+                <div style="background: linear-gradient(135deg, #dc3545, #c82333); color: white; padding: 20px; text-align: center; border-radius: 8px 8px 0 0;">
+                    <h1 style="margin: 0; font-size: 24px;">⚠️ Alerte Équipements</h1>
+                    <p style="margin: 5px 0 0 0; opacity: 0.9;">Système de Surveillance Caméras</p>
+                </div>
+                
+                <div style="background: #f8f9fa; padding: 30px; border-radius: 0 0 8px 8px; border: 1px solid #dee2e6;">
+                    <h2 style="color: #dc3545; margin-top: 0;">{len(equipments)} Équipements Déconnectés</h2>
+                    
+                    <p>Bonjour <strong>{client_name}</strong>,</p>
+                    
+                    <p>Nous vous informons que plusieurs de vos équipements de surveillance se sont déconnectés :</p>
+                    
+                    <div style="background: white; padding: 20px; border-radius: 6px; border-left: 4px solid #dc3545; margin: 20px 0;">
+                        <table style="width: 100%; border-collapse: collapse;">
+                            <tr>
+                                <th style="padding: 8px; text-align: left; border-bottom: 2px solid #dee2e6;">Nom</th>
+                                <th style="padding: 8px; text-align: left; border-bottom: 2px solid #dee2e6;">Type</th>
+                                <th style="padding: 8px; text-align: left; border-bottom: 2px solid #dee2e6;">Adresse IP</th>
+                                <th style="padding: 8px; text-align: left; border-bottom: 2px solid #dee2e6;">Détecté le</th>
+                            </tr>{rows}
+                        </table>
+                    </div>
+                    
+                    <h3>Actions Recommandées :</h3>
+                    <ul style="color: #495057;">
+                        <li>Une coupure simultanée indique souvent un problème d'alimentation ou de réseau sur le site</li>
+                        <li>Vérifiez le routeur et les switchs du site</li>
+                        <li>Redémarrez les équipements si nécessaire</li>
+                        <li>Contactez le support technique si le problème persiste</li>
+                    </ul>
+                    
+                    <div style="margin-top: 30px; padding: 15px; background: #e9ecef; border-radius: 6px; text-align: center;">
+                        <p style="margin: 0; color: #6c757d; font-size: 14px;">
+                            Cet email a été envoyé automatiquement par le système de surveillance.<br>
+                            Pour plus d'informations, connectez-vous à votre interface de monitoring.
+                        </p>
+                    </div>
+                </div>
+            </div>
+        </body>
+        </html>
+        """
+        
+        return subject, html_content
+    
+    def queue_availability_report(self, client_email, client_name, rapport):
+        """Ajoute le rapport de disponibilité d'un client à la file d'envoi"""
+        subject, html_content = self.availability_report_content(client_name, rapport)
+        return self.queue_email(client_email, subject, html_content)
+    
+    def availability_report_content(self, client_name, rapport):
+        """Construit l'email du rapport de disponibilité produit par rapports.rapport_disponibilite"""
+        synthese = rapport['synthese']
+        debut = datetime.fromisoformat(rapport['debut'])
+        fin = datetime.fromisoformat(rapport['fin'])
+        subject = f"📊 Rapport de disponibilité du {debut.strftime('%d/%m/%Y')} au {fin.strftime('%d/%m/%Y')} - {client_name}"
+        
+        def pourcentage(valeur):
+            return f"{valeur:.2f} %" if valeur is not None else "-"
+        
+        def duree(secondes):
+            return f"{round(secondes / 60)} min" if secondes is not None else "-"
+        
+        def latence(valeur):
+            return f"{valeur} ms" if valeur is not None else "-"
+        
+        rows = "".join(f"""
+                            <tr>
+                                <td style="padding: 8px; border-bottom: 1px solid #dee2e6;">{equipment['nom']}</td>
+                                <td style="padding: 8px; border-bottom: 1px solid #dee2e6;">{pourcentage(equipment['disponibilite_pct'])}</td>
+                                <td style="padding: 8px; border-bottom: 1px solid #dee2e6;">{equipment['nb_incidents']}</td>
+                                <td style="padding: 8px; border-bottom: 1px solid #dee2e6;">{duree(equipment['mttr_secondes'])}</td>
+                                <td style="padding: 8px; border-bottom: 1px solid #dee2e6;">{latence(equipment['latence_ms']['p95'])}</td>
+                            </tr>""" for equipment in rapport['equipements'])
+        
+        html_content = f"""
+        <html>
+        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
+            <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
+                <div style="background: linear-gradient(135deg, #0d6efd, #0a58ca); color: white; padding: 20px; text-align: center; border-radius: 8px 8px 0 0;">
+                    <h1 style="margin: 0; font-size: 24px;">📊 Rapport de Disponibilité</h1>
+                    <p style="margin: 5px 0 0 0; opacity: 0.9;">Système de Surveillance Caméras</p>
+                </div>
+                
+                <div style="background: #f8f9fa; padding: 30px; border-radius: 0 0 8px 8px; border: 1px solid #dee2e6;">
+                    <p>Bonjour <strong>{client_name}</strong>,</p>
+                    
+                    <p>Voici la disponibilité de vos {synthese['nb_equipements']} équipements du {debut.strftime('%d/%m/%Y')} au {fin.strftime('%d/%m/%Y')} (UTC) :</p>
+                    
+                    <div style="background: white; padding: 20px; border-radius: 6px; border-left: 4px solid #0d6efd; margin: 20px 0;">
+                        <p style="margin: 5px 0;"><strong>Disponibilité :</strong> {pourcentage(synthese['disponibilite_pct'])}</p>
+                        <p style="margin: 5px 0;"><strong>Incidents :</strong> {synthese['nb_incidents']}</p>
+                        <p style="margin: 5px 0;"><strong>Durée moyenne de rétablissement :</strong> {duree(synthese['mttr_secondes'])}</p>
+                        <p style="margin: 5px 0;"><strong>Temps de réponse (p50 / p95 / p99) :</strong> {latence(synthese['latence_ms']['p50'])} / {latence(synthese['latence_ms']['p95'])} / {latence(synthese['latence_ms']['p99'])}</p>
+                    </div>
+                    
+                    <div style="background: white; padding: 20px; border-radius: 6px; margin: 20px 0;">
+                        <table style="width: 100%; border-collapse: collapse;">
+                            <tr>
+                                <th style="padding: 8px; text-align: left; border-bottom: 2px solid #dee2e6;">Équipement</th>
+                                <th style="padding: 8px; text-align: left; border-bottom: 2px solid #dee2e6;">Disponibilité</th>
+                                <th style="padding: 8px; text-align: left; border-bottom: 2px solid #dee2e6;">Incidents</th>
+                                <th style="padding: 8px; text-align: left; border-bottom: 2px solid #dee2e6;">MTTR</th>
+                                <th style="padding: 8px; text-align: left; border-bottom: 2px solid #dee2e6;">p95</th>
+                            </tr>{rows}
+                        </table>
+                    </div>
+                    
+                    <div style="margin-top: 30px; padding: 15px; background: #e9ecef; border-radius: 6px; text-align: center;">
+                        <p style="margin: 0; color: #6c757d; font-size: 14px;">
+                            Cet email a été envoyé automatiquement par le système de surveillance.<br>
+                            Pour plus d'informations, connectez-vous à votre interface de monitoring.
+                        </p>
+                    </div>
+                </div>
+            </div>
+        </body>
+        </html>
+        """
+        
+        return subject, html_content
     
     def send_account_approval_notification(self, user_email, user_name, approved=True):
         """Envoie une notification d'approbation/refus de compte"""
+        subject, html_content = self.account_approval_content(user_name, approved)
+        return self.send_email(user_email, subject, html_content=html_content)
+    
+    def queue_account_approval_notification(self, user_email, user_name, approved=True):
+        """Ajoute une notification d'approbation/refus de compte à la file d'envoi"""
+        subject, html_content = self.account_approval_content(user_name, approved)
+        return self.queue_email(user_email, subject, html_content)
+    
+    def account_approval_content(self, user_name, approved=True):
+        """Construit le sujet et le contenu HTML d'une notification d'approbation/refus"""
         if approved:
             subject = "✅ Votre compte a été approuvé - Camera Monitor"
             html_content = f"""
@@ -172,7 +367,7 @@ class EmailService:
             </html>
             """
         
-        return self.send_email(user_email, subject, html_content=html_content)
+        return subject, html_content
 
 # Instance globale du service email
 email_service = EmailService()
\ No newline at end of file
@@ -0,0 +1,203 @@
+"""
+Bus des événements temps réel (changements d'état, alertes) diffusés aux tableaux de bord en Server-Sent Events
+"""
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Canal Redis qui relaie les événements entre les workers
+CANAL = 'camera-monitor:evenements'
+
+
+def _format_sse(identifiant, type_evenement, donnees):
+    lignes = []
+    if identifiant:
+        lignes.append(f'id: {identifiant}')
+    lignes.append(f'event: {type_evenement}')
+    lignes.append(f'data: {json.dumps(donnees, default=str)}')
+    return '\n'.join(lignes) + '\n\n'
+
+
+class Abonne:
+    """Connexion SSE : file bornée des événements de son client (de tous les clients pour un administrateur)"""
+
+    def __init__(self, client_id, capacite):
+        self.client_id = client_id
+        self.file = queue.Queue(maxsize=capacite)
+        self.deborde = False
+        self.rattrapage = []
+        self.instantane = None
+        self.depuis = None
+
+    def recevoir(self, evenement, tous=False):
+        if not tous and self.client_id is not None and evenement[1]['client_id'] != self.client_id:
+            return
+        try:
+            self.file.put_nowait(evenement)
+        except queue.Full:
+            # Lecteur trop lent : la page sera rechargée plutôt que de garder des événements sans limite
+            self.deborde = True
+
+
+class BusEvenements:
+    """Diffuse les transitions d'état des équipements, les nouvelles alertes et les alertes lues
+
+    Les événements sont publiés après le commit qui les produit. Les derniers
+    sont conservés pour qu'une connexion rétablie reprenne après son dernier
+    identifiant (Last-Event-ID). Si ce n'est pas possible (identifiant d'un
+    autre worker, trop ancien), la connexion commence par un 'instantane' de
+    l'état courant préparé par la route ; à défaut, le navigateur reçoit
+    'resynchroniser' et recharge la page une fois. Avec une URL Redis,
+    les événements passent par un canal pub/sub pour atteindre les connexions
+    de tous les workers.
+    """
+
+    def __init__(self, capacite_abonne=100, historique=1000, abonnes_max=16):
+        self.capacite_abonne = capacite_abonne
+        self.abonnes_max = abonnes_max
+        self.instance = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._abonnes = set()
+        self._recents = deque(maxlen=historique)
+        self._sequence = itertools.count(1)
+        self._redis = None
+        self._thread = None
+
+    def configurer(self, app):
+        """Lit la configuration et, si une URL Redis est joignable, démarre le relais entre workers"""
+        self.abonnes_max = app.config.get('EVENEMENTS_ABONNES_MAX', self.abonnes_max)
+        url = app.config.get('EVENEMENTS_URL')
+        if not url or self._thread is not None:
+            return
+
+        try:
+            import redis
+            self._redis = redis.Redis.from_url(url)
+            self._redis.ping()
+        except Exception as e:
+            self._redis = None
+            logger.warning(f"Relais des événements indisponible ({url}): {e}. Diffusion limitée au processus.")
+            return
+
+        self._thread = threading.Thread(target=self._ecouter, name='relais-evenements', daemon=True)
+        self._thread.start()
+        logger.info("Relais Redis des événements démarré")
+
+    def publier(self, type_evenement, client_id, donnees):
+        message = {'type': type_evenement, 'client_id': client_id, 'donnees': donnees}
+        if self._redis is not None:
+            try:
+                self._redis.publish(CANAL, json.dumps(message, default=str))
+                return
+            except Exception as e:
+                logger.warning(f"Publication Redis impossible, diffusion locale: {e}")
+        self._diffuser(message)
+
+    def publier_lot(self, evenements):
+        """Publie des (type, client_id, données) dans l'ordre"""
+        for type_evenement, client_id, donnees in evenements:
+            self.publier(type_evenement, client_id, donnees)
+
+    def _ecouter(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CANAL)
+                for message in pubsub.listen():
+                    self._diffuser(json.loads(message['data']))
+            except Exception as e:
+                logger.error(f"Relais des événements interrompu: {e}")
+                # Des événements ont pu être perdus pendant la coupure
+                self._diffuser({'type': 'resynchroniser', 'client_id': None, 'donnees': {}}, tous=True)
+                time.sleep(5)
+
+    def _diffuser(self, message, tous=False):
+        with self._lock:
+            evenement = (f'{self.instance}-{next(self._sequence)}', message)
+            self._recents.append(evenement)
+            abonnes = list(self._abonnes)
+
+        for abonne in abonnes:
+            abonne.recevoir(evenement, tous)
+
+    def dernier_id(self):
+        """Identifiant du dernier événement diffusé, à transmettre à la connexion ouverte par une page"""
+        with self._lock:
+            return self._recents[-1][0] if self._recents else f'{self.instance}-0'
+
+    def abonner(self, client_id, dernier_id=None):
+        """Enregistre une connexion et prépare les événements manqués depuis `dernier_id`
+
+        Retourne None si le nombre maximal de connexions est atteint.
+        `rattrapage` vaut None quand les événements manqués ne sont plus connus ;
+        `depuis` est alors l'identifiant du dernier événement diffusé avant
+        l'abonnement, à donner à l'instantané qui les remplace.
+        """
+        abonne = Abonne(client_id, self.capacite_abonne)
+        with self._lock:
+            if len(self._abonnes) >= self.abonnes_max:
+                return None
+            self._abonnes.add(abonne)
+            abonne.depuis = self._recents[-1][0] if self._recents else f'{self.instance}-0'
+
+            if dernier_id:
+                instance, _, sequence = dernier_id.partition('-')
+                premier = int(self._recents[0][0].partition('-')[2]) if self._recents else None
+                if instance != self.instance or not sequence.isdigit():
+                    abonne.rattrapage = None
+                elif premier is not None and int(sequence) < premier - 1:
+                    abonne.rattrapage = None
+                else:
+                    abonne.rattrapage = [
+                        evenement for evenement in self._recents
+                        if int(evenement[0].partition('-')[2]) > int(sequence)
+                        and (client_id is None or evenement[1]['client_id'] == client_id)
+                    ]
+        return abonne
+
+    def desabonner(self, abonne):
+        with self._lock:
+            self._abonnes.discard(abonne)
+
+    def flux_sse(self, abonne, duree_max=300, battement=15):
+        """Générateur du flux SSE d'un abonné, fermé après `duree_max` secondes (le navigateur se reconnecte)"""
+        try:
+            yield 'retry: 3000\n\n'
+            if abonne.rattrapage is not None:
+                for identifiant, message in abonne.rattrapage:
+                    yield _format_sse(identifiant, message['type'], message['donnees'])
+            elif abonne.instantane is not None:
+                # Identifiant de ce worker : une reconnexion au même worker reprendra après l'instantané
+                yield _format_sse(abonne.depuis, 'instantane', abonne.instantane)
+            else:
+                yield _format_sse(None, 'resynchroniser', {})
+                return
+
+            fin = time.monotonic() + duree_max
+            while True:
+                restant = fin - time.monotonic()
+                if restant <= 0:
+                    return
+                try:
+                    identifiant, message = abonne.file.get(timeout=min(battement, restant))
+                except queue.Empty:
+                    yield ': battement\n\n'
+                    continue
+
+                if abonne.deborde or message['type'] == 'resynchroniser':
+                    yield _format_sse(None, 'resynchroniser', {})
+                    return
+                yield _format_sse(identifiant, message['type'], message['donnees'])
+        finally:
+            self.desabonner(abonne)
+
+
+# Instance globale du bus d'événements
+bus_evenements = BusEvenements()
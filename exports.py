@@ -0,0 +1,157 @@
+"""
+Export en flux (CSV ou NDJSON, éventuellement gzip) de l'historique des pings et des alertes
+"""
+import csv
+import io
+import json
+import logging
+import zlib
+from app import db
+from models import Alerte, Equipement
+from partitions_historique import entite_historique
+
+logger = logging.getLogger(__name__)
+
+# Lignes lues par aller-retour avec la base (curseur côté serveur sur PostgreSQL)
+LIGNES_PAR_LOT = 2000
+
+# Taille visée des morceaux envoyés au client
+TAILLE_MORCEAU = 64 * 1024
+
+COLONNES_HISTORIQUE = ['id', 'timestamp', 'equipement_id', 'equipement_nom', 'adresse_ip',
+                       'client_id', 'statut', 'reponse_ms', 'message']
+COLONNES_ALERTES = ['id', 'timestamp', 'equipement_id', 'equipement_nom', 'adresse_ip',
+                    'client_id', 'type_alerte', 'message', 'lue']
+
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+
+def lignes_historique(client_id=None, equipement_id=None, debut=None, fin=None):
+    """Pings de [debut, fin) dans l'ordre chronologique, lus par lots de LIGNES_PAR_LOT"""
+    Historique = entite_historique(depuis=debut, jusqua=fin)
+    requete = db.session.query(
+        Historique.id,
+        Historique.timestamp,
+        Historique.equipement_id,
+        Equipement.nom,
+        Equipement.adresse_ip,
+        Equipement.client_id,
+        Historique.statut,
+        Historique.reponse_ms,
+        Historique.message
+    ).join(Equipement, Historique.equipement_id == Equipement.id)
+
+    if client_id is not None:
+        requete = requete.filter(Equipement.client_id == client_id)
+    if equipement_id is not None:
+        requete = requete.filter(Historique.equipement_id == equipement_id)
+    if debut is not None:
+        requete = requete.filter(Historique.timestamp >= debut)
+    if fin is not None:
+        requete = requete.filter(Historique.timestamp < fin)
+
+    return requete.order_by(Historique.timestamp, Historique.id).yield_per(LIGNES_PAR_LOT)
+
+
+def lignes_alertes(client_id=None, equipement_id=None, debut=None, fin=None):
+    """Alertes de [debut, fin) dans l'ordre chronologique, lues par lots de LIGNES_PAR_LOT"""
+    requete = db.session.query(
+        Alerte.id,
+        Alerte.timestamp,
+        Alerte.equipement_id,
+        Equipement.nom,
+        Equipement.adresse_ip,
+        Equipement.client_id,
+        Alerte.type_alerte,
+        Alerte.message,
+        Alerte.lue
+    ).join(Equipement, Alerte.equipement_id == Equipement.id)
+
+    if client_id is not None:
+        requete = requete.filter(Equipement.client_id == client_id)
+    if equipement_id is not None:
+        requete = requete.filter(Alerte.equipement_id == equipement_id)
+    if debut is not None:
+        requete = requete.filter(Alerte.timestamp >= debut)
+    if fin is not None:
+        requete = requete.filter(Alerte.timestamp < fin)
+
+    return requete.order_by(Alerte.timestamp, Alerte.id).yield_per(LIGNES_PAR_LOT)
+
+
+def _cellule_csv(valeur):
+    if valeur is None:
+        return ''
+    if hasattr(valeur, 'isoformat'):
+        return valeur.isoformat()
+    # Un texte commençant par =, +, - ou @ serait interprété comme une formule par un tableur
+    if isinstance(valeur, str) and valeur[:1] in ('=', '+', '-', '@'):
+        return "'" + valeur
+    return valeur
+
+
+def _valeur_json(valeur):
+    return valeur.isoformat() if hasattr(valeur, 'isoformat') else str(valeur)
+
+
+def formater_csv(colonnes, lignes):
+    """Morceaux de texte CSV (en-tête compris) d'environ TAILLE_MORCEAU caractères"""
+    tampon = io.StringIO()
+    ecrivain = csv.writer(tampon)
+    ecrivain.writerow(colonnes)
+
+    for ligne in lignes:
+        ecrivain.writerow([_cellule_csv(valeur) for valeur in ligne])
+        if tampon.tell() >= TAILLE_MORCEAU:
+            yield tampon.getvalue()
+            tampon.seek(0)
+            tampon.truncate()
+
+    yield tampon.getvalue()
+
+
+def formater_ndjson(colonnes, lignes):
+    """Morceaux NDJSON (un objet JSON par ligne) d'environ TAILLE_MORCEAU caractères"""
+    morceau = []
+    taille = 0
+
+    for ligne in lignes:
+        texte = json.dumps(dict(zip(colonnes, ligne)), default=_valeur_json, ensure_ascii=False) + '\n'
+        morceau.append(texte)
+        taille += len(texte)
+        if taille >= TAILLE_MORCEAU:
+            yield ''.join(morceau)
+            morceau = []
+            taille = 0
+
+    yield ''.join(morceau)
+
+
+def compresser_gzip(morceaux):
+    """Compresse au fil de l'eau des morceaux de texte en un flux gzip"""
+    compresseur = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for morceau in morceaux:
+        donnees = compresseur.compress(morceau.encode('utf-8'))
+        if donnees:
+            yield donnees
+    yield compresseur.flush()
+
+
+def generer_export(lignes, colonnes, format_export, gzip=False):
+    """Flux d'octets d'un export ; les erreurs en cours de route sont journalisées (l'en-tête est déjà parti)"""
+    formater = formater_csv if format_export == 'csv' else formater_ndjson
+    morceaux = formater(colonnes, lignes)
+
+    try:
+        if gzip:
+            yield from compresser_gzip(morceaux)
+        else:
+            for morceau in morceaux:
+                yield morceau.encode('utf-8')
+    except Exception as e:
+        logger.error(f"Export interrompu: {e}")
+        db.session.rollback()
+        raise
@@ -0,0 +1,397 @@
+"""
+Enregistrement des pings reçus des équipements et des passerelles de site
+"""
+import json
+import logging
+import math
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import insert, update
+from app import db
+from models import Equipement, HistoriquePing, Alerte, Incident
+from cache_equipements import cache_equipements, ID_MAX
+from tampon_historique import tampon_historique
+from statuts_clients import ajuster_statuts_clients
+from statistiques import cache_statistiques
+from sketch_latence import sketches_latence
+from evenements import bus_evenements
+from detecteur_hors_ligne import detecteur_hors_ligne
+
+logger = logging.getLogger(__name__)
+
+# Nombre maximum de pings acceptés dans un seul lot
+MAX_PINGS_PAR_LOT = 1000
+
+TYPES_NDJSON = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+# Intervalle recommandé au plus égal à cette fraction du délai hors ligne
+FRACTION_DELAI_MAX = 0.75
+
+# Gigue recommandée, en fraction de l'intervalle (tampon vide, puis tampon saturé)
+GIGUE_MIN = 0.05
+GIGUE_MAX = 0.2
+
+# Attente minimale (secondes) annoncée par Retry-After quand l'ingestion est saturée
+RETRY_AFTER_MIN = 5
+
+# Temps de réponse maximal accepté (ms), borne de la colonne INTEGER
+REPONSE_MS_MAX = 2 ** 31 - 1
+
+
+class EquipementInconnu(Exception):
+    """Équipement du cache supprimé ou désactivé en base depuis son chargement"""
+
+
+def normaliser_reponse_ms(valeur):
+    """Temps de réponse d'un ping converti en nombre (None s'il est absent), ValueError s'il est invalide"""
+    if valeur is None or valeur == '':
+        return None
+    if isinstance(valeur, bool) or not isinstance(valeur, (int, float, str)):
+        raise ValueError(f"Temps de réponse invalide: {valeur!r}")
+    try:
+        reponse_ms = float(valeur)
+    except ValueError:
+        raise ValueError(f"Temps de réponse invalide: {valeur!r}") from None
+    if not (math.isfinite(reponse_ms) and 0 <= reponse_ms <= REPONSE_MS_MAX):
+        raise ValueError(f"Temps de réponse invalide: {valeur!r}")
+    return int(reponse_ms) if reponse_ms.is_integer() else reponse_ms
+
+
+def normaliser_ping(data):
+    """Copie d'un ping dont les champs écrits en base sont vérifiés, ValueError avec le motif du refus
+
+    Appelé avant toute écriture : un champ invalide refuse ce ping seulement,
+    jamais le lot entier ni un ping déjà enregistré.
+    """
+    if data.get('ip') is not None and not isinstance(data['ip'], str):
+        raise ValueError("Adresse IP invalide")
+    if data.get('message') is not None and not isinstance(data['message'], str):
+        raise ValueError("Message invalide")
+    try:
+        reponse_ms = normaliser_reponse_ms(data.get('response_time'))
+    except ValueError:
+        raise ValueError("Temps de réponse invalide") from None
+    return dict(data, response_time=reponse_ms)
+
+
+def _resultat_erreur(index, message, code):
+    return {"index": index, "status": "error", "error": message, "code": code}
+
+
+def _evenement_etat(equipement, precedent, maintenant):
+    return {'equipement_id': equipement.id, 'client_id': equipement.client_id,
+            'etat': 'en_ligne', 'precedent': precedent, 'depuis': maintenant.isoformat()}
+
+
+def _evenement_alerte(equipement, type_alerte, message, maintenant):
+    return {'equipement_id': equipement.id, 'equipement_nom': equipement.nom,
+            'type_alerte': type_alerte, 'message': message, 'timestamp': maintenant.isoformat()}
+
+
+def _ligne_historique(equipement_id, data, maintenant):
+    return {
+        'equipement_id': equipement_id,
+        'timestamp': maintenant,
+        'statut': 'success',
+        'reponse_ms': data.get('response_time'),
+        'message': data.get('message', 'Ping reçu avec succès'),
+    }
+
+
+def consigne_ping(intervalle_attendu, seuil_saturation):
+    """Consigne donnée aux équipements pour leur prochain ping, selon le remplissage du tampon d'historique
+
+    L'intervalle recommandé va de `intervalle_attendu` (tampon vide) à
+    FRACTION_DELAI_MAX du délai hors ligne (tampon rempli à `seuil_saturation`),
+    pour qu'un équipement ralenti ne soit jamais déclaré hors ligne ; la gigue
+    augmente avec la charge pour étaler les pings après une coupure. Retourne
+    {'saturee', 'intervalle_recommande', 'gigue', 'retry_after'} (secondes).
+    """
+    metriques = tampon_historique.metriques()
+    charge = min(metriques['taux_remplissage'] / seuil_saturation, 1.0) if metriques['actif'] else 0.0
+
+    intervalle_max = max(intervalle_attendu, detecteur_hors_ligne.delai.total_seconds() * FRACTION_DELAI_MAX)
+    intervalle = intervalle_attendu + (intervalle_max - intervalle_attendu) * charge
+    gigue = intervalle * (GIGUE_MIN + (GIGUE_MAX - GIGUE_MIN) * charge)
+
+    return {
+        'saturee': charge >= 1.0,
+        'intervalle_recommande': round(intervalle),
+        'gigue': round(gigue),
+        # Tirée au hasard pour que les équipements refusés ne reviennent pas tous ensemble
+        'retry_after': random.randint(RETRY_AFTER_MIN, max(RETRY_AFTER_MIN, int(gigue))),
+    }
+
+
+def parser_lot_pings(corps, mimetype=None):
+    """Décode un lot de pings au format JSON (tableau ou {"pings": [...]}) ou NDJSON
+
+    Retourne une liste d'éléments : soit le dictionnaire du ping, soit une
+    chaîne décrivant l'erreur de décodage de la ligne correspondante.
+    """
+    if mimetype not in TYPES_NDJSON:
+        try:
+            donnees = json.loads(corps)
+        except ValueError:
+            donnees = None
+        else:
+            if isinstance(donnees, dict) and 'pings' in donnees:
+                donnees = donnees['pings']
+            if isinstance(donnees, list):
+                return donnees
+            if isinstance(donnees, dict):
+                return [donnees]
+
+    # NDJSON : un ping par ligne, les lignes vides sont ignorées
+    pings = []
+    for ligne in corps.splitlines():
+        ligne = ligne.strip()
+        if not ligne:
+            continue
+        try:
+            pings.append(json.loads(ligne))
+        except ValueError:
+            pings.append("Ligne JSON invalide")
+    return pings
+
+
+def fermer_incidents(equipement_ids, maintenant):
+    """Termine les incidents ouverts des équipements revenus en ligne"""
+    if not equipement_ids:
+        return
+    db.session.execute(
+        update(Incident)
+        .where(Incident.equipement_id.in_(equipement_ids), Incident.fin == None)
+        .values(fin=maintenant)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def enregistrer_ping(equipement, data):
+    """Enregistre le ping d'un équipement résolu par le cache, retourne True s'il revient en ligne
+
+    `data` a été vérifié par normaliser_ping. Lève
+    EquipementInconnu si l'équipement n'existe plus ou a été désactivé en base.
+    """
+    maintenant = datetime.utcnow()
+    timeout = maintenant - timedelta(minutes=2)
+
+    # L'UPDATE conditionnel n'aboutit que si l'équipement était déjà en ligne,
+    # ce qui évite de relire sa ligne dans le cas courant
+    resultat = db.session.execute(
+        update(Equipement)
+        .where(
+            Equipement.id == equipement.id,
+            Equipement.actif == True,
+            Equipement.etat == 'en_ligne',
+            Equipement.dernier_ping > timeout
+        )
+        .values(dernier_ping=maintenant)
+        .execution_options(synchronize_session=False)
+    )
+    etait_hors_ligne = False
+    precedent = None
+
+    if resultat.rowcount == 0:
+        # Transition d'état : relire l'état précédent avant de passer en ligne
+        precedent = db.session.query(Equipement.etat, Equipement.dernier_ping, Equipement.actif).filter(
+            Equipement.id == equipement.id
+        ).first()
+        if precedent is None or not precedent.actif:
+            db.session.rollback()
+            cache_equipements.oublier(equipement.id)
+            raise EquipementInconnu(equipement.id)
+        etait_hors_ligne = precedent.dernier_ping is None or precedent.dernier_ping <= timeout
+
+        db.session.execute(
+            update(Equipement)
+            .where(Equipement.id == equipement.id)
+            .values(dernier_ping=maintenant, etat='en_ligne', etat_depuis=maintenant)
+            .execution_options(synchronize_session=False)
+        )
+        if precedent.etat != 'en_ligne':
+            ajuster_statuts_clients({equipement.client_id: 1})
+        if precedent.etat == 'hors_ligne':
+            fermer_incidents([equipement.id], maintenant)
+
+    # Enregistrer dans l'historique, de façon différée si le tampon l'accepte
+    historique = _ligne_historique(equipement.id, data, maintenant)
+    if not tampon_historique.ajouter(historique):
+        db.session.execute(insert(HistoriquePing), [historique])
+
+    # Créer une alerte si l'équipement revient en ligne
+    if etait_hors_ligne:
+        alerte = Alerte()
+        alerte.equipement_id = equipement.id
+        alerte.type_alerte = 'retour_en_ligne'
+        alerte.message = f"L'équipement {equipement.nom} ({equipement.adresse_ip}) est revenu en ligne"
+        alerte.timestamp = maintenant
+        db.session.add(alerte)
+        evenement_alerte = _evenement_alerte(equipement, alerte.type_alerte, alerte.message, maintenant)
+        logger.info(f"Équipement {equipement.nom} revenu en ligne")
+
+    db.session.commit()
+
+    # Le ping est enregistré : le suivi en mémoire ne doit pas en faire une erreur (que l'équipement renverrait)
+    try:
+        sketches_latence.ajouter(equipement.id, maintenant, historique['reponse_ms'])
+        detecteur_hors_ligne.signaler(equipement.id, maintenant)
+
+        if resultat.rowcount == 0:
+            cache_statistiques.invalider()
+            if precedent.etat != 'en_ligne':
+                bus_evenements.publier('etat', equipement.client_id, _evenement_etat(equipement, precedent.etat, maintenant))
+            if etait_hors_ligne:
+                bus_evenements.publier('alerte', equipement.client_id, evenement_alerte)
+    except Exception as e:
+        logger.error(f"Erreur après l'enregistrement du ping de l'équipement {equipement.id}: {e}")
+
+    return etait_hors_ligne
+
+
+def traiter_lot_pings(pings):
+    """Enregistre un lot de pings avec une seule recherche, des insertions groupées et un seul commit
+
+    Retourne un résultat par ping, dans l'ordre du lot, pour que la passerelle
+    puisse renvoyer uniquement les pings en erreur.
+    """
+    maintenant = datetime.utcnow()
+    timeout = maintenant - timedelta(minutes=2)
+    resultats = [None] * len(pings)
+
+    # Validation des éléments du lot
+    valides = []
+    for index, data in enumerate(pings):
+        if isinstance(data, str):
+            resultats[index] = _resultat_erreur(index, data, 400)
+            continue
+        if not isinstance(data, dict):
+            resultats[index] = _resultat_erreur(index, "Objet JSON attendu", 400)
+            continue
+
+        try:
+            data = normaliser_ping(data)
+        except ValueError as e:
+            resultats[index] = _resultat_erreur(index, str(e), 400)
+            continue
+
+        adresse_ip = data.get('ip')
+        equipement_id = data.get('equipement_id')
+
+        if not adresse_ip and not equipement_id:
+            resultats[index] = _resultat_erreur(index, "IP ou ID d'équipement requis", 400)
+            continue
+
+        if equipement_id:
+            try:
+                equipement_id = int(equipement_id)
+            except (TypeError, ValueError):
+                resultats[index] = _resultat_erreur(index, "ID d'équipement invalide", 400)
+                continue
+            if not 0 < equipement_id <= ID_MAX:
+                resultats[index] = _resultat_erreur(index, "ID d'équipement invalide", 400)
+                continue
+
+        valides.append((index, equipement_id, adresse_ip, data))
+
+    if not valides:
+        return resultats
+
+    # Résolution par l'index en mémoire, puis une seule requête pour les derniers pings
+    equipements = {}
+    for index, equipement_id, adresse_ip, data in valides:
+        if equipement_id:
+            equipements[index] = cache_equipements.par_id(equipement_id)
+        else:
+            equipements[index] = cache_equipements.par_ip(adresse_ip)
+
+    ids_resolus = {equipement.id for equipement in equipements.values() if equipement}
+    etats_connus = {}
+    if ids_resolus:
+        etats_connus = {
+            ligne.id: ligne for ligne in db.session.query(
+                Equipement.id, Equipement.etat, Equipement.dernier_ping, Equipement.actif
+            ).filter(Equipement.id.in_(ids_resolus)).all()
+        }
+
+    historiques = []
+    alertes = []
+    mises_a_jour = {}
+    retours_par_client = {}
+    incidents_termines = []
+    evenements = []
+
+    for index, equipement_id, adresse_ip, data in valides:
+        equipement = equipements[index]
+        # Un équipement désactivé est refusé comme par le chemin par IP (il n'entre pas dans les compteurs)
+        if not equipement or not equipement.actif:
+            logger.warning(f"Équipement non trouvé pour IP: {adresse_ip}, ID: {equipement_id}")
+            resultats[index] = _resultat_erreur(index, "Équipement non trouvé", 404)
+            continue
+
+        # Le cache peut survivre à une suppression faite par un autre processus : la base fait foi
+        precedent = etats_connus.get(equipement.id)
+        if precedent is None or not precedent.actif:
+            cache_equipements.oublier(equipement.id)
+            logger.warning(f"Équipement supprimé ou désactivé: ID {equipement.id}")
+            resultats[index] = _resultat_erreur(index, "Équipement non trouvé", 404)
+            continue
+
+        # Un équipement peut apparaître plusieurs fois dans le même lot
+        if equipement.id not in mises_a_jour:
+            mise_a_jour = {'id': equipement.id, 'dernier_ping': maintenant, 'etat': 'en_ligne'}
+
+            if precedent.dernier_ping is None or precedent.dernier_ping <= timeout:
+                alertes.append({
+                    'equipement_id': equipement.id,
+                    'type_alerte': 'retour_en_ligne',
+                    'message': f"L'équipement {equipement.nom} ({equipement.adresse_ip}) est revenu en ligne",
+                    'timestamp': maintenant,
+                    'lue': False,
+                })
+                evenements.append(('alerte', equipement.client_id, _evenement_alerte(
+                    equipement, 'retour_en_ligne', alertes[-1]['message'], maintenant)))
+                mise_a_jour['etat_depuis'] = maintenant
+                logger.info(f"Équipement {equipement.nom} revenu en ligne")
+
+            if precedent.etat != 'en_ligne':
+                mise_a_jour['etat_depuis'] = maintenant
+                retours_par_client[equipement.client_id] = retours_par_client.get(equipement.client_id, 0) + 1
+                evenements.append(('etat', equipement.client_id, _evenement_etat(equipement, precedent.etat, maintenant)))
+            if precedent.etat == 'hors_ligne':
+                incidents_termines.append(equipement.id)
+
+            mises_a_jour[equipement.id] = mise_a_jour
+
+        historiques.append(_ligne_historique(equipement.id, data, maintenant))
+
+        resultats[index] = {"index": index, "status": "success", "equipement_id": equipement.id}
+
+    if historiques:
+        # Les lignes refusées par le tampon (plein ou inactif) sont écrites avec le lot
+        refusees = tampon_historique.ajouter_lot(historiques)
+        if refusees:
+            db.session.execute(insert(HistoriquePing), refusees)
+        db.session.execute(update(Equipement), list(mises_a_jour.values()))
+        if alertes:
+            db.session.execute(insert(Alerte), alertes)
+        ajuster_statuts_clients(retours_par_client)
+        fermer_incidents(incidents_termines, maintenant)
+        db.session.commit()
+
+        # Lot enregistré : une erreur du suivi en mémoire ne doit pas faire renvoyer les pings acceptés
+        try:
+            for historique in historiques:
+                sketches_latence.ajouter(historique['equipement_id'], maintenant, historique['reponse_ms'])
+            for equipement_id in mises_a_jour:
+                detecteur_hors_ligne.signaler(equipement_id, maintenant)
+
+            if alertes or retours_par_client:
+                cache_statistiques.invalider()
+            bus_evenements.publier_lot(evenements)
+        except Exception as e:
+            logger.error(f"Erreur après l'enregistrement d'un lot de {len(historiques)} pings: {e}")
+
+        logger.debug(f"Lot de {len(historiques)} pings enregistré pour {len(mises_a_jour)} équipements")
+
+    return resultats
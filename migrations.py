@@ -0,0 +1,161 @@
+"""
+Migrations versionnées du schéma, appliquées au démarrage sur les bases existantes
+"""
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import inspect, text
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Verrou consultatif PostgreSQL partagé par les workers qui démarrent en même temps
+VERROU_MIGRATIONS = 715301
+
+
+def creer_index(connexion, nom, table, colonnes, condition=None):
+    """Crée un index s'il n'existe pas, sans bloquer les écritures sur PostgreSQL
+
+    Sur PostgreSQL l'index est construit avec CONCURRENTLY (la connexion doit
+    être en autocommit). Un index laissé invalide par une construction
+    interrompue est supprimé puis reconstruit.
+    """
+    clause = f' WHERE {condition}' if condition else ''
+
+    if connexion.dialect.name == 'postgresql':
+        invalide = connexion.execute(text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :nom AND NOT i.indisvalid"
+        ), {'nom': nom}).first()
+        if invalide:
+            logger.warning(f"Index invalide supprimé avant reconstruction: {nom}")
+            connexion.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {nom}'))
+        connexion.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {nom} ON {table} ({colonnes}){clause}'))
+    else:
+        connexion.execute(text(f'CREATE INDEX IF NOT EXISTS {nom} ON {table} ({colonnes}){clause}'))
+
+    logger.info(f"Index vérifié: {nom}")
+
+
+def ajouter_colonne(connexion, table, colonne, definition):
+    """Ajoute une colonne à une table existante si elle n'y est pas encore
+
+    Retourne True si la colonne a été ajoutée. `definition` est une constante
+    SQL écrite dans la migration (type, NOT NULL, DEFAULT).
+    """
+    if colonne in {existante['name'] for existante in inspect(connexion).get_columns(table)}:
+        return False
+    connexion.execute(text(f'ALTER TABLE {table} ADD COLUMN {colonne} {definition}'))
+    logger.info(f"Colonne ajoutée: {table}.{colonne}")
+    return True
+
+
+def migration_0001_index_requetes_frequentes(connexion):
+    # Historique d'un équipement, nettoyage par date
+    creer_index(connexion, 'ix_historique_pings_equipement_timestamp', 'historique_pings', 'equipement_id, timestamp')
+    # Recherche d'une alerte récente par équipement et par type (vérification hors ligne)
+    creer_index(connexion, 'ix_alertes_equipement_type_timestamp', 'alertes', 'equipement_id, type_alerte, timestamp')
+    # Alertes non lues : index partiel, les alertes lues en sont exclues. La condition
+    # reprend celle générée par SQLAlchemy (SQLite stocke les booléens en entiers)
+    non_lue = 'lue = false' if connexion.dialect.name == 'postgresql' else 'lue = 0'
+    creer_index(connexion, 'ix_alertes_non_lues', 'alertes', 'equipement_id', condition=non_lue)
+    # Résolution d'un ping par adresse IP
+    creer_index(connexion, 'ix_equipements_adresse_ip_actif', 'equipements', 'adresse_ip, actif')
+
+
+def migration_0002_index_pagination_historique(connexion):
+    # Pagination par curseur de la page d'historique
+    creer_index(connexion, 'ix_historique_pings_timestamp_id', 'historique_pings', 'timestamp, id')
+
+
+def migration_0003_partitionnement_historique(connexion):
+    # PostgreSQL : historique_pings devient une table partitionnée par mois (SQLite : rien à faire,
+    # l'archivage mensuel est fait par maintenir_partitions). La conversion est transactionnelle.
+    from partitions_historique import convertir_en_table_partitionnee
+    if connexion.dialect.name == 'postgresql':
+        with db.engine.begin() as transaction:
+            convertir_en_table_partitionnee(transaction)
+
+
+def migration_0004_changements_equipements(connexion):
+    # Flux de changements de /api/equipements/status : les lignes existantes reçoivent
+    # leur date de dernier ping comme date de modification
+    ajouter_colonne(connexion, 'equipements', 'date_modification', 'TIMESTAMP')
+    connexion.execute(text(
+        'UPDATE equipements SET date_modification = COALESCE(dernier_ping, date_creation, CURRENT_TIMESTAMP) '
+        'WHERE date_modification IS NULL'
+    ))
+    creer_index(connexion, 'ix_equipements_date_modification_id', 'equipements', 'date_modification, id')
+
+
+def migration_0005_index_pagination_alertes(connexion):
+    # Pagination par curseur de la page des alertes, toutes ou non lues seulement
+    non_lue = 'lue = false' if connexion.dialect.name == 'postgresql' else 'lue = 0'
+    creer_index(connexion, 'ix_alertes_timestamp_id', 'alertes', 'timestamp, id')
+    creer_index(connexion, 'ix_alertes_non_lues_timestamp_id', 'alertes', 'timestamp, id', condition=non_lue)
+
+
+def migration_0006_etat_equipements(connexion):
+    # État persisté des équipements (compteurs par client, statistiques, vérification hors ligne) ;
+    # les lignes existantes reçoivent l'état déduit de leur dernier ping
+    if ajouter_colonne(connexion, 'equipements', 'etat', "VARCHAR(20) NOT NULL DEFAULT 'jamais_vu'"):
+        connexion.execute(text(
+            "UPDATE equipements SET etat = CASE "
+            "WHEN dernier_ping IS NULL THEN 'jamais_vu' "
+            "WHEN dernier_ping > :limite THEN 'en_ligne' "
+            "ELSE 'hors_ligne' END"
+        ), {'limite': datetime.utcnow() - timedelta(minutes=2)})
+    if ajouter_colonne(connexion, 'equipements', 'etat_depuis', 'TIMESTAMP'):
+        connexion.execute(text('UPDATE equipements SET etat_depuis = COALESCE(dernier_ping, date_creation)'))
+    creer_index(connexion, 'ix_equipements_etat', 'equipements', 'etat')
+
+    # Sketches de temps de réponse des agrégats (tables créées avant leur ajout)
+    ajouter_colonne(connexion, 'agregats_horaires', 'sketch_reponse', 'TEXT')
+    ajouter_colonne(connexion, 'agregats_journaliers', 'sketch_reponse', 'TEXT')
+
+
+# (version, description, fonction) dans l'ordre d'application
+MIGRATIONS = [
+    (1, "Index des requêtes fréquentes", migration_0001_index_requetes_frequentes),
+    (2, "Index de pagination de l'historique", migration_0002_index_pagination_historique),
+    (3, "Partitionnement mensuel de l'historique", migration_0003_partitionnement_historique),
+    (4, "Flux de changements des équipements", migration_0004_changements_equipements),
+    (5, "Index de pagination des alertes", migration_0005_index_pagination_alertes),
+    (6, "État persisté des équipements", migration_0006_etat_equipements),
+]
+
+
+def _versions_appliquees(connexion):
+    connexion.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_version ('
+        'version INTEGER PRIMARY KEY, '
+        'description VARCHAR(200), '
+        'date_application TIMESTAMP)'
+    ))
+    return {ligne[0] for ligne in connexion.execute(text('SELECT version FROM schema_version'))}
+
+
+def appliquer_migrations():
+    """Applique dans l'ordre les migrations absentes de la table schema_version"""
+    with db.engine.connect() as connexion:
+        connexion = connexion.execution_options(isolation_level='AUTOCOMMIT')
+        postgresql = connexion.dialect.name == 'postgresql'
+
+        if postgresql:
+            connexion.execute(text('SELECT pg_advisory_lock(:cle)'), {'cle': VERROU_MIGRATIONS})
+        try:
+            appliquees = _versions_appliquees(connexion)
+
+            for version, description, migration in MIGRATIONS:
+                if version in appliquees:
+                    continue
+
+                logger.info(f"Migration {version}: {description}")
+                migration(connexion)
+                connexion.execute(
+                    text('INSERT INTO schema_version (version, description, date_application) VALUES (:v, :d, :t)'),
+                    {'v': version, 'd': description, 't': datetime.utcnow()}
+                )
+        finally:
+            if postgresql:
+                connexion.execute(text('SELECT pg_advisory_unlock(:cle)'), {'cle': VERROU_MIGRATIONS})
+
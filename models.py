@@ -1,6 +1,6 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 from app import db
-from sqlalchemy import func
+from sqlalchemy import func, case
 from flask_login import UserMixin
 import hashlib
 
@@ -54,22 +54,51 @@ class Client(db.Model):
     # Relation avec les utilisateurs
     users = db.relationship('User', backref='client', lazy=True)
     
+    # Compteurs d'équipements maintenus par l'ingestion et la vérification hors ligne,
+    # chargés avec le client pour afficher une liste de clients en une seule requête
+    statut = db.relationship('StatutClient', uselist=False, lazy='joined', cascade='all, delete-orphan')
+    
     def __repr__(self):
         return f'<Client {self.nom}>'
     
+    def _compteurs(self):
+        if self.statut is not None:
+            return self.statut.nb_total, self.statut.nb_en_ligne
+        
+        # Client sans compteurs (créé depuis le dernier recalcul) : calcul direct
+        total, en_ligne = db.session.query(
+            func.count(Equipement.id),
+            func.sum(case((Equipement.etat == 'en_ligne', 1), else_=0))
+        ).filter(Equipement.client_id == self.id, Equipement.actif == True).one()
+        return total, en_ligne or 0
+    
     @property
     def nb_equipements_total(self):
-        return db.session.query(Equipement).filter_by(client_id=self.id, actif=True).count()
+        return self._compteurs()[0]
     
     @property
     def nb_equipements_en_ligne(self):
-        equipements = db.session.query(Equipement).filter_by(client_id=self.id, actif=True).all()
-        return len([eq for eq in equipements if eq.est_en_ligne])
+        return self._compteurs()[1]
     
     @property
     def nb_equipements_hors_ligne(self):
-        equipements = db.session.query(Equipement).filter_by(client_id=self.id, actif=True).all()
-        return len([eq for eq in equipements if not eq.est_en_ligne])
+        total, en_ligne = self._compteurs()
+        return total - en_ligne
+
+class StatutClient(db.Model):
+    __tablename__ = 'statuts_clients'
+    
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), primary_key=True)
+    nb_total = db.Column(db.Integer, nullable=False, default=0)
+    nb_en_ligne = db.Column(db.Integer, nullable=False, default=0)
+    date_maj = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @property
+    def nb_hors_ligne(self):
+        return self.nb_total - self.nb_en_ligne
+    
+    def __repr__(self):
+        return f'<StatutClient {self.client_id} - {self.nb_en_ligne}/{self.nb_total}>'
 
 class Equipement(db.Model):
     __tablename__ = 'equipements'
@@ -84,6 +113,13 @@ class Equipement(db.Model):
     date_creation = db.Column(db.DateTime, default=datetime.utcnow)
     actif = db.Column(db.Boolean, default=True)
     
+    # État persisté, mis à jour par l'ingestion des pings et la vérification hors ligne
+    etat = db.Column(db.String(20), nullable=False, default='jamais_vu', server_default='jamais_vu', index=True)  # 'jamais_vu', 'en_ligne', 'hors_ligne'
+    etat_depuis = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Dernière modification de la ligne (ping, changement d'état, édition) : curseur du flux de changements
+    date_modification = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
     # Relation avec l'historique des pings
     historique_pings = db.relationship('HistoriquePing', backref='equipement', lazy=True, cascade='all, delete-orphan')
     
@@ -92,12 +128,8 @@ class Equipement(db.Model):
     
     @property
     def est_en_ligne(self):
-        """Vérifie si l'équipement est considéré comme en ligne (ping < 2 minutes)"""
-        if not self.dernier_ping:
-            return False
-        
-        timeout = datetime.utcnow() - timedelta(minutes=2)
-        return self.dernier_ping > timeout
+        """Vérifie si l'équipement est en ligne, d'après l'état persisté (même source que les compteurs)"""
+        return self.etat == 'en_ligne'
     
     @property
     def statut_texte(self):
@@ -124,6 +156,8 @@ class Equipement(db.Model):
 
 class HistoriquePing(db.Model):
     __tablename__ = 'historique_pings'
+    # Sur SQLite les identifiants restent uniques après l'archivage mensuel de la table
+    __table_args__ = {'sqlite_autoincrement': True}
     
     id = db.Column(db.Integer, primary_key=True)
     equipement_id = db.Column(db.Integer, db.ForeignKey('equipements.id'), nullable=False)
@@ -150,3 +184,130 @@ class Alerte(db.Model):
     
     def __repr__(self):
         return f'<Alerte {self.type_alerte} - {self.equipement_id}>'
+
+class EmailSortant(db.Model):
+    __tablename__ = 'emails_sortants'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    destinataire = db.Column(db.String(120), nullable=False)
+    sujet = db.Column(db.String(200), nullable=False)
+    contenu_html = db.Column(db.Text, nullable=False)
+    statut = db.Column(db.String(20), default='en_attente', index=True)  # 'en_attente', 'en_cours', 'envoye', 'echec'
+    tentatives = db.Column(db.Integer, default=0)
+    prochaine_tentative = db.Column(db.DateTime, default=datetime.utcnow)
+    derniere_erreur = db.Column(db.Text)
+    date_creation = db.Column(db.DateTime, default=datetime.utcnow)
+    date_envoi = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<EmailSortant {self.destinataire} - {self.statut}>'
+
+# Événement hors ligne en attente d'être regroupé dans l'email récapitulatif du client
+class NotificationEnAttente(db.Model):
+    __tablename__ = 'notifications_en_attente'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=False, index=True)
+    equipement_id = db.Column(db.Integer, db.ForeignKey('equipements.id'), nullable=False)
+    date_creation = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<NotificationEnAttente {self.client_id} - {self.equipement_id}>'
+
+# Progression d'une purge par lots, pour la reprendre après une interruption
+class PointRepriseRetention(db.Model):
+    __tablename__ = 'points_reprise_retention'
+    
+    tache = db.Column(db.String(50), primary_key=True)
+    limite = db.Column(db.DateTime)  # Date limite de la passe en cours (conservée à la reprise)
+    dernier_id = db.Column(db.Integer, nullable=False, default=0)
+    supprimees = db.Column(db.Integer, nullable=False, default=0)
+    en_cours = db.Column(db.Boolean, nullable=False, default=False)
+    date_debut = db.Column(db.DateTime)
+    date_maj = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<PointRepriseRetention {self.tache} - {self.dernier_id}>'
+
+# Dernière heure agrégée, même quand elle n'a produit aucune ligne (aucun équipement actif)
+class PositionAgregats(db.Model):
+    __tablename__ = 'positions_agregats'
+    
+    calcul = db.Column(db.String(50), primary_key=True)
+    heure = db.Column(db.DateTime, nullable=False)
+    date_maj = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<PositionAgregats {self.calcul} - {self.heure}>'
+
+class AgregatHoraire(db.Model):
+    __tablename__ = 'agregats_horaires'
+    
+    equipement_id = db.Column(db.Integer, db.ForeignKey('equipements.id'), primary_key=True)
+    heure = db.Column(db.DateTime, primary_key=True)  # Début de l'heure (UTC)
+    nb_pings = db.Column(db.Integer, nullable=False, default=0)
+    nb_attendus = db.Column(db.Integer, nullable=False, default=0)
+    reponse_min = db.Column(db.Integer)
+    reponse_max = db.Column(db.Integer)
+    reponse_somme = db.Column(db.BigInteger, nullable=False, default=0)
+    nb_reponses = db.Column(db.Integer, nullable=False, default=0)
+    secondes_en_ligne = db.Column(db.Integer, nullable=False, default=0)
+    sketch_reponse = db.Column(db.Text)  # DDSketch sérialisé des temps de réponse
+    
+    @property
+    def reponse_moyenne(self):
+        return round(self.reponse_somme / self.nb_reponses, 1) if self.nb_reponses else None
+    
+    def __repr__(self):
+        return f'<AgregatHoraire {self.equipement_id} - {self.heure}>'
+
+class AgregatJournalier(db.Model):
+    __tablename__ = 'agregats_journaliers'
+    
+    equipement_id = db.Column(db.Integer, db.ForeignKey('equipements.id'), primary_key=True)
+    jour = db.Column(db.Date, primary_key=True)
+    nb_pings = db.Column(db.Integer, nullable=False, default=0)
+    nb_attendus = db.Column(db.Integer, nullable=False, default=0)
+    reponse_min = db.Column(db.Integer)
+    reponse_max = db.Column(db.Integer)
+    reponse_somme = db.Column(db.BigInteger, nullable=False, default=0)
+    nb_reponses = db.Column(db.Integer, nullable=False, default=0)
+    secondes_en_ligne = db.Column(db.Integer, nullable=False, default=0)
+    sketch_reponse = db.Column(db.Text)  # Fusion des sketches horaires de la journée
+    
+    @property
+    def reponse_moyenne(self):
+        return round(self.reponse_somme / self.nb_reponses, 1) if self.nb_reponses else None
+    
+    def __repr__(self):
+        return f'<AgregatJournalier {self.equipement_id} - {self.jour}>'
+
+# Sketch partiel des temps de réponse d'une heure, écrit par un processus puis consolidé dans agregats_horaires
+class SketchLatence(db.Model):
+    __tablename__ = 'sketches_latence'
+    __table_args__ = (db.Index('ix_sketches_latence_heure_equipement', 'heure', 'equipement_id'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    equipement_id = db.Column(db.Integer, db.ForeignKey('equipements.id'), nullable=False)
+    heure = db.Column(db.DateTime, nullable=False)
+    sketch = db.Column(db.Text, nullable=False)
+    date_creation = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SketchLatence {self.equipement_id} - {self.heure}>'
+
+# Période hors ligne d'un équipement, ouverte par la vérification hors ligne et fermée au retour en ligne
+class Incident(db.Model):
+    __tablename__ = 'incidents'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    equipement_id = db.Column(db.Integer, db.ForeignKey('equipements.id'), nullable=False, index=True)
+    debut = db.Column(db.DateTime, nullable=False, index=True)
+    fin = db.Column(db.DateTime)
+    
+    @property
+    def duree_secondes(self):
+        return (self.fin - self.debut).total_seconds() if self.fin else None
+    
+    def __repr__(self):
+        return f'<Incident {self.equipement_id} - {self.debut}>'
@@ -0,0 +1,100 @@
+"""
+Pagination par curseur (keyset) sur un couple (horodatage, id) trié du plus récent au plus ancien
+"""
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import func, select, tuple_
+
+# Au-delà, le total affiché est « plus de TOTAL_MAX »
+TOTAL_MAX = 10000
+
+
+class CurseurInvalide(ValueError):
+    pass
+
+
+def encoder_curseur(horodatage, identifiant, sens):
+    """Encode la position d'une ligne dans un jeton opaque utilisable dans une URL"""
+    donnees = json.dumps({'t': horodatage.isoformat(), 'i': identifiant, 's': sens}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(donnees.encode()).decode().rstrip('=')
+
+
+def decoder_curseur(jeton):
+    """Retourne (horodatage, id, sens) à partir d'un jeton produit par encoder_curseur"""
+    try:
+        donnees = json.loads(base64.urlsafe_b64decode(jeton + '=' * (-len(jeton) % 4)))
+        sens = donnees['s']
+        if sens not in ('suivant', 'precedent'):
+            raise ValueError(sens)
+        return datetime.fromisoformat(donnees['t']), int(donnees['i']), sens
+    except (ValueError, KeyError, TypeError) as e:
+        raise CurseurInvalide(f"Curseur de pagination invalide: {jeton}") from e
+
+
+class PageCurseur:
+    """Page de résultats avec les jetons des pages voisines et un total plafonné"""
+
+    def __init__(self, items, par_page, curseur_suivant, curseur_precedent, total, total_plafonne):
+        self.items = items
+        self.per_page = par_page
+        self.next_cursor = curseur_suivant
+        self.prev_cursor = curseur_precedent
+        self.has_next = curseur_suivant is not None
+        self.has_prev = curseur_precedent is not None
+        self.total = total
+        self.total_plafonne = total_plafonne
+
+
+def compter_plafonne(requete, colonne_id, plafond=TOTAL_MAX):
+    """Compte les lignes d'une requête sans en parcourir plus de plafond + 1"""
+    sous_requete = requete.order_by(None).with_entities(colonne_id).limit(plafond + 1).subquery()
+    total = requete.session.execute(select(func.count()).select_from(sous_requete)).scalar()
+    return min(total, plafond), total > plafond
+
+
+def paginer_par_curseur(requete, colonne_temps, colonne_id, par_page, jeton=None, avec_total=True):
+    """Retourne une PageCurseur de `requete` triée par (colonne_temps, colonne_id) décroissants
+
+    Chaque page est lue par l'index à partir de la position du curseur, son
+    coût ne dépend donc pas de sa profondeur.
+    """
+    cle = tuple_(colonne_temps, colonne_id)
+    sens = 'suivant'
+    requete_page = requete
+
+    if jeton:
+        horodatage, identifiant, sens = decoder_curseur(jeton)
+        if sens == 'suivant':
+            requete_page = requete.filter(cle < tuple_(horodatage, identifiant))
+        else:
+            requete_page = requete.filter(cle > tuple_(horodatage, identifiant))
+
+    if sens == 'suivant':
+        requete_page = requete_page.order_by(colonne_temps.desc(), colonne_id.desc())
+    else:
+        requete_page = requete_page.order_by(colonne_temps.asc(), colonne_id.asc())
+
+    lignes = requete_page.limit(par_page + 1).all()
+    encore = len(lignes) > par_page
+    lignes = lignes[:par_page]
+
+    if sens == 'precedent':
+        lignes.reverse()
+        a_suivant, a_precedent = True, encore
+    else:
+        a_suivant, a_precedent = encore, jeton is not None
+
+    curseur_suivant = curseur_precedent = None
+    if lignes:
+        nom_temps, nom_id = colonne_temps.key, colonne_id.key
+        if a_suivant:
+            derniere = lignes[-1]
+            curseur_suivant = encoder_curseur(getattr(derniere, nom_temps), getattr(derniere, nom_id), 'suivant')
+        if a_precedent:
+            premiere = lignes[0]
+            curseur_precedent = encoder_curseur(getattr(premiere, nom_temps), getattr(premiere, nom_id), 'precedent')
+
+    total, total_plafonne = compter_plafonne(requete, colonne_id) if avec_total else (None, False)
+
+    return PageCurseur(lignes, par_page, curseur_suivant, curseur_precedent, total, total_plafonne)
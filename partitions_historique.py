@@ -0,0 +1,316 @@
+"""
+Partitionnement mensuel de l'historique des pings
+
+Sur PostgreSQL, historique_pings est une table partitionnée par plage de
+timestamp (une partition par mois, plus une partition par défaut). Sur SQLite,
+la table historique_pings reçoit les pings du mois courant et est renommée en
+historique_pings_AAAA_MM au changement de mois. Dans les deux cas la rétention
+supprime des partitions entières au lieu de lignes.
+"""
+import logging
+import re
+import time
+from datetime import datetime
+from sqlalchemy import column, select, table, text, union_all
+from sqlalchemy.orm import aliased
+from app import db
+from models import HistoriquePing
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'historique_pings'
+PARTITION_DEFAUT = 'historique_pings_defaut'
+PARTITION_ANCIENNE = 'historique_pings_ancien'
+
+# Nombre de partitions mensuelles créées à l'avance (PostgreSQL)
+MOIS_ANTICIPES = 2
+
+_NOM_MENSUEL = re.compile(r'^historique_pings_(\d{4})_(\d{2})$')
+_BORNE_SUPERIEURE = re.compile(r"TO \('([^']+)'\)")
+
+
+def debut_mois(date):
+    return datetime(date.year, date.month, 1)
+
+
+def mois_suivant(date):
+    return datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+
+def mois_precedent(date):
+    return datetime(date.year - (date.month == 1), (date.month - 2) % 12 + 1, 1)
+
+
+def nom_partition(debut):
+    return f'{TABLE}_{debut.year:04d}_{debut.month:02d}'
+
+
+def _postgresql(connexion):
+    return connexion.dialect.name == 'postgresql'
+
+
+# --- PostgreSQL -------------------------------------------------------------
+
+def _est_partitionnee(connexion):
+    return connexion.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table"
+    ), {'table': TABLE}).first() is not None
+
+
+def convertir_en_table_partitionnee(connexion):
+    """Remplace historique_pings par une table partitionnée (migration, PostgreSQL seulement)
+
+    L'ancienne table devient la partition historique_pings_ancien qui couvre
+    tout jusqu'à la fin du mois courant, sans copie des lignes existantes.
+    """
+    if not _postgresql(connexion) or _est_partitionnee(connexion):
+        return
+
+    fin = mois_suivant(datetime.utcnow())
+
+    connexion.execute(text(f'ALTER TABLE {TABLE} RENAME TO {PARTITION_ANCIENNE}'))
+    for ancien_nom, in connexion.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE tablename = :table"
+    ), {'table': PARTITION_ANCIENNE}).all():
+        connexion.execute(text(
+            f'ALTER INDEX {ancien_nom} RENAME TO {ancien_nom.replace(TABLE, PARTITION_ANCIENNE, 1)}'
+        ))
+
+    # La clé de partitionnement doit faire partie de la clé primaire et ne peut pas être nulle
+    connexion.execute(text(f"UPDATE {PARTITION_ANCIENNE} SET timestamp = '1970-01-01' WHERE timestamp IS NULL"))
+    connexion.execute(text(f'ALTER TABLE {PARTITION_ANCIENNE} ALTER COLUMN timestamp SET NOT NULL'))
+
+    connexion.execute(text(f'''
+        CREATE TABLE {TABLE} (
+            id INTEGER NOT NULL DEFAULT nextval('{TABLE}_id_seq'::regclass),
+            equipement_id INTEGER NOT NULL REFERENCES equipements (id),
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            statut VARCHAR(20) NOT NULL,
+            reponse_ms INTEGER,
+            message TEXT,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    '''))
+    connexion.execute(text(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id'))
+    connexion.execute(text(f'ALTER TABLE {PARTITION_ANCIENNE} ALTER COLUMN id DROP DEFAULT'))
+    connexion.execute(text(
+        f"ALTER TABLE {TABLE} ATTACH PARTITION {PARTITION_ANCIENNE} FOR VALUES FROM (MINVALUE) TO ('{fin.isoformat()}')"
+    ))
+    connexion.execute(text(f'CREATE TABLE {PARTITION_DEFAUT} PARTITION OF {TABLE} DEFAULT'))
+
+    # Index déclarés sur la table mère : PostgreSQL rattache ceux qui existent déjà sur la partition
+    connexion.execute(text(
+        f'CREATE INDEX IF NOT EXISTS ix_historique_pings_equipement_timestamp ON {TABLE} (equipement_id, timestamp)'
+    ))
+    connexion.execute(text(f'CREATE INDEX IF NOT EXISTS ix_historique_pings_timestamp_id ON {TABLE} (timestamp, id)'))
+
+    logger.info(f"Table {TABLE} convertie en table partitionnée par mois")
+
+
+def _creer_partition_postgresql(connexion, debut):
+    """Crée la partition d'un mois en y déplaçant les lignes tombées dans la partition par défaut"""
+    nom = nom_partition(debut)
+    fin = mois_suivant(debut)
+
+    connexion.execute(text(f'CREATE TABLE {nom} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    connexion.execute(text(f'''
+        WITH deplacees AS (
+            DELETE FROM {PARTITION_DEFAUT} WHERE timestamp >= :debut AND timestamp < :fin RETURNING *
+        )
+        INSERT INTO {nom} SELECT * FROM deplacees
+    '''), {'debut': debut, 'fin': fin})
+    connexion.execute(text(
+        f"ALTER TABLE {TABLE} ATTACH PARTITION {nom} FOR VALUES FROM ('{debut.isoformat()}') TO ('{fin.isoformat()}')"
+    ))
+    logger.info(f"Partition créée: {nom}")
+
+
+def _partitions_postgresql(connexion):
+    """Retourne [(nom, borne supérieure)] des partitions bornées de historique_pings"""
+    lignes = connexion.execute(text('''
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table
+    '''), {'table': TABLE}).all()
+
+    partitions = []
+    for nom, borne in lignes:
+        correspondance = _BORNE_SUPERIEURE.search(borne or '')
+        if correspondance:
+            partitions.append((nom, datetime.fromisoformat(correspondance.group(1))))
+    return partitions
+
+
+def _maintenir_postgresql(connexion, maintenant):
+    bornes = {fin for _, fin in _partitions_postgresql(connexion)}
+    couvert = max(bornes, default=debut_mois(maintenant))
+
+    debut = debut_mois(maintenant)
+    for _ in range(MOIS_ANTICIPES + 1):
+        if debut >= couvert:
+            _creer_partition_postgresql(connexion, debut)
+        debut = mois_suivant(debut)
+
+
+# --- SQLite -----------------------------------------------------------------
+
+def _lire_horodatage(valeur):
+    return datetime.fromisoformat(valeur) if isinstance(valeur, str) else valeur
+
+
+def _archives_sqlite(connexion):
+    """Retourne [(nom, timestamp minimal, timestamp maximal)] des tables mensuelles archivées
+
+    Une archive peut contenir des lignes plus anciennes que son mois (pings
+    arrivés en retard, premier archivage) : ses bornes sont lues par l'index
+    sur timestamp plutôt que déduites de son nom.
+    """
+    noms = [nom for nom, in connexion.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'historique_pings_%'"
+    )) if _NOM_MENSUEL.match(nom)]
+
+    archives = []
+    for nom in sorted(noms):
+        minimum = connexion.execute(text(f'SELECT MIN(timestamp) FROM {nom}')).scalar()
+        maximum = connexion.execute(text(f'SELECT MAX(timestamp) FROM {nom}')).scalar()
+        archives.append((nom, _lire_horodatage(minimum), _lire_horodatage(maximum)))
+    return archives
+
+
+def _pivoter_sqlite(connexion, maintenant):
+    """Archive historique_pings sous le nom du mois précédent dès qu'elle contient un mois révolu"""
+    debut = debut_mois(maintenant)
+    plus_ancien = connexion.execute(text(f'SELECT MIN(timestamp) FROM {TABLE}')).scalar()
+    if plus_ancien is None or str(plus_ancien) >= debut.isoformat(sep=' '):
+        return
+
+    archive = nom_partition(mois_precedent(maintenant))
+    if connexion.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :nom"), {'nom': archive}).first():
+        # Déjà archivé ce mois-ci : seules quelques lignes en retard restent à déplacer
+        connexion.execute(text(f'INSERT INTO {archive} SELECT * FROM {TABLE} WHERE timestamp < :debut'), {'debut': debut.isoformat(sep=' ')})
+        connexion.execute(text(f'DELETE FROM {TABLE} WHERE timestamp < :debut'), {'debut': debut.isoformat(sep=' ')})
+        return
+
+    index = connexion.execute(text(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"
+    ), {'table': TABLE}).all()
+    dernier_id = connexion.execute(text(f'SELECT MAX(id) FROM {TABLE}')).scalar() or 0
+
+    connexion.execute(text(f'ALTER TABLE {TABLE} RENAME TO {archive}'))
+
+    # Les index suivent la table renommée : ils sont recréés sous un nom propre à l'archive
+    for nom, sql in index:
+        connexion.execute(text(f'DROP INDEX {nom}'))
+        sql_archive = re.sub(rf'\bON "?{TABLE}"?', f'ON {archive}', sql.replace(nom, nom.replace(TABLE, archive, 1), 1))
+        connexion.execute(text(sql_archive))
+
+    HistoriquePing.__table__.create(connexion)
+    for nom, sql in index:
+        connexion.execute(text(sql))
+
+    # Les identifiants continuent après ceux de l'archive (clé unique sur l'ensemble des tables)
+    connexion.execute(text('DELETE FROM sqlite_sequence WHERE name = :table'), {'table': TABLE})
+    connexion.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:table, :seq)'), {'table': TABLE, 'seq': dernier_id})
+
+    logger.info(f"Historique du mois archivé dans {archive}")
+
+
+# --- Interface commune ------------------------------------------------------
+
+def maintenir_partitions(maintenant=None):
+    """Crée les partitions à venir (PostgreSQL) ou archive le mois écoulé (SQLite)"""
+    maintenant = maintenant or datetime.utcnow()
+    with db.engine.begin() as connexion:
+        if _postgresql(connexion):
+            if _est_partitionnee(connexion):
+                _maintenir_postgresql(connexion, maintenant)
+        else:
+            _pivoter_sqlite(connexion, maintenant)
+
+
+def supprimer_partitions_expirees(limite):
+    """Supprime les partitions dont toutes les lignes sont antérieures à `limite`, retourne leurs noms"""
+    supprimees = []
+    with db.engine.begin() as connexion:
+        if _postgresql(connexion):
+            if not _est_partitionnee(connexion):
+                return supprimees
+            for nom, fin in _partitions_postgresql(connexion):
+                if fin <= limite:
+                    connexion.execute(text(f'ALTER TABLE {TABLE} DETACH PARTITION {nom}'))
+                    connexion.execute(text(f'DROP TABLE {nom}'))
+                    supprimees.append(nom)
+        else:
+            for nom, _, maximum in _archives_sqlite(connexion):
+                if maximum is None or maximum < limite:
+                    connexion.execute(text(f'DROP TABLE {nom}'))
+                    supprimees.append(nom)
+
+    for nom in supprimees:
+        logger.info(f"Partition d'historique supprimée: {nom}")
+    return supprimees
+
+
+def purger_archives_expirees(limite, taille_lot=1000, pause=0.1):
+    """SQLite : supprime par lots les lignes antérieures à `limite` des archives mensuelles conservées
+
+    Une archive n'est supprimée entière qu'une fois sa dernière ligne expirée ;
+    ses lignes plus anciennes sont supprimées ici pour que la rétention reste
+    celle configurée. Une passe interrompue est simplement refaite (les archives
+    ne reçoivent plus que de rares lignes en retard). Retourne le nombre de
+    lignes supprimées ; sans effet sur PostgreSQL, où la purge de la table
+    mère atteint toutes les partitions.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return 0
+
+    with db.engine.connect() as connexion:
+        archives = [nom for nom, minimum, _ in _archives_sqlite(connexion) if minimum is not None and minimum < limite]
+
+    supprimees = 0
+    for nom in archives:
+        while True:
+            with db.engine.begin() as connexion:
+                nombre = connexion.execute(text(
+                    f'DELETE FROM {nom} WHERE id IN '
+                    f'(SELECT id FROM {nom} WHERE timestamp < :limite ORDER BY timestamp LIMIT :lot)'
+                ), {'limite': limite.isoformat(sep=' '), 'lot': taille_lot}).rowcount
+            supprimees += nombre
+            if nombre < taille_lot:
+                break
+            # Laisser passer les écritures de l'ingestion entre deux lots
+            time.sleep(pause)
+
+    if supprimees:
+        logger.info(f"{supprimees} lignes expirées supprimées des archives d'historique")
+    return supprimees
+
+
+def entite_historique(depuis=None, jusqua=None):
+    """Entité à interroger pour lire l'historique entre `depuis` et `jusqua` (bornes incluses)
+
+    PostgreSQL élague lui-même les partitions : l'entité est HistoriquePing.
+    Sur SQLite, seules les archives mensuelles dont les lignes recoupent la
+    fenêtre sont réunies à la table courante (UNION ALL) ; une borne absente
+    n'élague rien de son côté.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return HistoriquePing
+
+    with db.engine.connect() as connexion:
+        archives = [nom for nom, minimum, maximum in _archives_sqlite(connexion)
+                    if maximum is not None
+                    and (depuis is None or maximum >= depuis)
+                    and (jusqua is None or minimum <= jusqua)]
+    if not archives:
+        return HistoriquePing
+
+    # La première branche est la table du modèle : les colonnes de la réunion lui correspondent
+    colonnes = HistoriquePing.__table__.columns
+    union = union_all(select(HistoriquePing.__table__), *[
+        select(table(nom, *[column(colonne.name, colonne.type) for colonne in colonnes]))
+        for nom in archives
+    ]).subquery('historique')
+    return aliased(HistoriquePing, union)
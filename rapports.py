@@ -0,0 +1,184 @@
+"""
+Rapports de disponibilité (SLA) par équipement et par client, calculés à partir des agrégats
+"""
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from app import db
+from models import AgregatHoraire, AgregatJournalier, Client, Equipement, Incident, SketchLatence
+from agregats import debut_heure
+from sketch_latence import DDSketch
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+
+
+def mois_precedent(maintenant=None):
+    """Retourne (début, fin) du mois civil précédent"""
+    maintenant = maintenant or datetime.utcnow()
+    fin = datetime(maintenant.year, maintenant.month, 1)
+    debut = datetime(fin.year - (fin.month == 1), (fin.month - 2) % 12 + 1, 1)
+    return debut, fin
+
+
+def _cumul_vide():
+    return {'nb_pings': 0, 'nb_attendus': 0, 'reponse_min': None, 'reponse_max': None,
+            'reponse_somme': 0, 'nb_reponses': 0, 'secondes_en_ligne': 0, 'sketch': DDSketch()}
+
+
+def _cumuler(cumul, nb_pings, nb_attendus, reponse_min, reponse_max,
+             reponse_somme, nb_reponses, secondes_en_ligne):
+    cumul['nb_pings'] += nb_pings or 0
+    cumul['nb_attendus'] += nb_attendus or 0
+    cumul['reponse_somme'] += reponse_somme or 0
+    cumul['nb_reponses'] += nb_reponses or 0
+    cumul['secondes_en_ligne'] += secondes_en_ligne or 0
+    if reponse_min is not None:
+        cumul['reponse_min'] = reponse_min if cumul['reponse_min'] is None else min(cumul['reponse_min'], reponse_min)
+    if reponse_max is not None:
+        cumul['reponse_max'] = reponse_max if cumul['reponse_max'] is None else max(cumul['reponse_max'], reponse_max)
+
+
+def _sommes_agregats(equipement_ids, debut, fin):
+    """Cumule par équipement les agrégats de [debut, fin) : journaliers pour les jours entiers, horaires aux bords"""
+    premier_jour = debut if debut == datetime(debut.year, debut.month, debut.day) else \
+        datetime(debut.year, debut.month, debut.day) + timedelta(days=1)
+    dernier_jour = datetime(fin.year, fin.month, fin.day)
+
+    tranches = []
+    if premier_jour < dernier_jour:
+        tranches.append((AgregatJournalier, AgregatJournalier.jour, premier_jour.date(), dernier_jour.date()))
+        tranches.append((AgregatHoraire, AgregatHoraire.heure, debut, premier_jour))
+        tranches.append((AgregatHoraire, AgregatHoraire.heure, dernier_jour, fin))
+    else:
+        tranches.append((AgregatHoraire, AgregatHoraire.heure, debut, fin))
+
+    cumuls = {}
+    for Agregat, periode, borne_basse, borne_haute in tranches:
+        if borne_basse >= borne_haute:
+            continue
+        filtres = [Agregat.equipement_id.in_(equipement_ids), periode >= borne_basse, periode < borne_haute]
+
+        for ligne in db.session.query(
+            Agregat.equipement_id,
+            func.sum(Agregat.nb_pings),
+            func.sum(Agregat.nb_attendus),
+            func.min(Agregat.reponse_min),
+            func.max(Agregat.reponse_max),
+            func.sum(Agregat.reponse_somme),
+            func.sum(Agregat.nb_reponses),
+            func.sum(Agregat.secondes_en_ligne)
+        ).filter(*filtres).group_by(Agregat.equipement_id):
+            _cumuler(cumuls.setdefault(ligne[0], _cumul_vide()), *ligne[1:])
+
+        for equipement_id, sketch in db.session.query(
+            Agregat.equipement_id,
+            Agregat.sketch_reponse
+        ).filter(*filtres, Agregat.sketch_reponse != None):
+            cumuls[equipement_id]['sketch'].fusionner(DDSketch.charger(sketch))
+
+    # Sketches partiels pas encore consolidés dans un agrégat horaire (heure en cours, écritures tardives)
+    for equipement_id, sketch in db.session.query(
+        SketchLatence.equipement_id,
+        SketchLatence.sketch
+    ).filter(
+        SketchLatence.equipement_id.in_(equipement_ids),
+        SketchLatence.heure >= debut,
+        SketchLatence.heure < fin
+    ):
+        cumuls.setdefault(equipement_id, _cumul_vide())['sketch'].fusionner(DDSketch.charger(sketch))
+    return cumuls
+
+
+def _incidents(equipement_ids, debut, fin):
+    """Retourne {equipement_id: (nombre d'incidents, durées des incidents terminés)} pour ceux commencés dans [debut, fin)"""
+    incidents = {}
+    for equipement_id, date_debut, date_fin in db.session.query(
+        Incident.equipement_id,
+        Incident.debut,
+        Incident.fin
+    ).filter(
+        Incident.equipement_id.in_(equipement_ids),
+        Incident.debut >= debut,
+        Incident.debut < fin
+    ):
+        nombre, durees = incidents.get(equipement_id, (0, []))
+        if date_fin is not None:
+            durees.append((date_fin - date_debut).total_seconds())
+        incidents[equipement_id] = (nombre + 1, durees)
+    return incidents
+
+
+def _indicateurs(cumul, nombre_incidents, durees, intervalle_attendu):
+    secondes_attendues = cumul['nb_attendus'] * intervalle_attendu
+
+    return {
+        'disponibilite_pct': round(min(100.0, 100.0 * cumul['secondes_en_ligne'] / secondes_attendues), 3)
+        if secondes_attendues else None,
+        'secondes_en_ligne': cumul['secondes_en_ligne'],
+        'nb_pings': cumul['nb_pings'],
+        'nb_attendus': cumul['nb_attendus'],
+        'nb_incidents': nombre_incidents,
+        'mttr_secondes': round(sum(durees) / len(durees)) if durees else None,
+        'latence_ms': {
+            'min': cumul['reponse_min'],
+            'moyenne': round(cumul['reponse_somme'] / cumul['nb_reponses'], 1) if cumul['nb_reponses'] else None,
+            'max': cumul['reponse_max'],
+            **{nom: cumul['sketch'].quantile(quantile) for nom, quantile in QUANTILES.items()}
+        }
+    }
+
+
+def rapport_disponibilite(client_id, debut, fin, intervalle_attendu=60):
+    """Rapport de disponibilité d'un client et de chacun de ses équipements sur [debut, fin), à l'heure près
+
+    Seuls les agrégats horaires et journaliers et la table des incidents sont
+    lus : le coût dépend du nombre d'équipements et de jours, pas du nombre de pings.
+    """
+    debut, fin = debut_heure(debut), debut_heure(fin)
+    client = db.session.get(Client, client_id)
+    if client is None:
+        return None
+
+    equipements = db.session.query(
+        Equipement.id,
+        Equipement.nom,
+        Equipement.type_equipement,
+        Equipement.adresse_ip
+    ).filter(Equipement.client_id == client_id, Equipement.actif == True).order_by(Equipement.nom).all()
+    ids = [equipement.id for equipement in equipements]
+
+    cumuls = _sommes_agregats(ids, debut, fin) if ids else {}
+    incidents = _incidents(ids, debut, fin) if ids else {}
+
+    lignes = []
+    for equipement in equipements:
+        nombre, durees = incidents.get(equipement.id, (0, []))
+        lignes.append({
+            'id': equipement.id,
+            'nom': equipement.nom,
+            'type': equipement.type_equipement,
+            'adresse_ip': equipement.adresse_ip,
+            **_indicateurs(cumuls.get(equipement.id) or _cumul_vide(), nombre, durees, intervalle_attendu)
+        })
+
+    # Synthèse client : sommes des cumuls et fusion des sketches de tous les équipements
+    total = _cumul_vide()
+    for cumul in cumuls.values():
+        _cumuler(total, *[cumul[cle] for cle in (
+            'nb_pings', 'nb_attendus', 'reponse_min', 'reponse_max',
+            'reponse_somme', 'nb_reponses', 'secondes_en_ligne')])
+        total['sketch'].fusionner(cumul['sketch'])
+    toutes_durees = [duree for _, durees in incidents.values() for duree in durees]
+
+    return {
+        'client': {'id': client.id, 'nom': client.nom},
+        'debut': debut.isoformat(),
+        'fin': fin.isoformat(),
+        'synthese': {
+            'nb_equipements': len(equipements),
+            **_indicateurs(total, sum(nombre for nombre, _ in incidents.values()), toutes_durees, intervalle_attendu)
+        },
+        'equipements': lignes
+    }
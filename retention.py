@@ -0,0 +1,75 @@
+"""
+Purge par lots des données expirées, bornée dans le temps et reprise après interruption
+"""
+import logging
+import time
+from datetime import datetime
+from sqlalchemy import delete, select
+from app import db
+from models import PointRepriseRetention
+
+logger = logging.getLogger(__name__)
+
+
+def purger_par_lots(tache, modele, filtres, limite, taille_lot=1000, pause=0.1, budget=300):
+    """Supprime par lots de clés primaires croissantes les lignes de `modele` qui vérifient `filtres(limite)`
+
+    Chaque lot est supprimé dans sa propre transaction avec la mise à jour du
+    point de reprise : après un arrêt ou un dépassement du budget (secondes),
+    la passe suivante repart du dernier id traité avec la même limite.
+    Retourne le nombre de lignes supprimées pendant cet appel.
+    """
+    point = db.session.get(PointRepriseRetention, tache)
+    if point is None:
+        point = PointRepriseRetention(tache=tache)
+        db.session.add(point)
+
+    if point.en_cours:
+        limite = point.limite
+        logger.info(f"Reprise de la purge {tache} après l'id {point.dernier_id}")
+    else:
+        point.limite = limite
+        point.dernier_id = 0
+        point.supprimees = 0
+        point.en_cours = True
+        point.date_debut = datetime.utcnow()
+    point.date_maj = datetime.utcnow()
+    db.session.commit()
+
+    debut = time.monotonic()
+    supprimees = 0
+
+    while True:
+        ids = db.session.scalars(
+            select(modele.id)
+            .where(modele.id > point.dernier_id, *filtres(limite))
+            .order_by(modele.id)
+            .limit(taille_lot)
+        ).all()
+
+        if ids:
+            resultat = db.session.execute(
+                delete(modele)
+                .where(modele.id.in_(ids))
+                .execution_options(synchronize_session=False)
+            )
+            supprimees += resultat.rowcount
+            point.dernier_id = ids[-1]
+            point.supprimees += resultat.rowcount
+
+        point.en_cours = len(ids) == taille_lot
+        point.date_maj = datetime.utcnow()
+        db.session.commit()
+
+        if not point.en_cours:
+            logger.info(f"Purge {tache} terminée: {point.supprimees} lignes supprimées")
+            break
+
+        if time.monotonic() - debut >= budget:
+            logger.info(f"Purge {tache} interrompue (budget de {budget}s atteint) après l'id {point.dernier_id}, reprise à la prochaine exécution")
+            break
+
+        # Laisser passer les écritures de l'ingestion entre deux lots
+        time.sleep(pause)
+
+    return supprimees
@@ -1,13 +1,44 @@
 import logging
-from datetime import datetime, timedelta
-from flask import render_template, request, jsonify, flash, redirect, url_for, session
+from datetime import datetime, timedelta, timezone
+from flask import render_template, request, jsonify, flash, redirect, url_for, session, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
+from sqlalchemy import and_, or_, tuple_
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
 from app import app, db
-from models import Client, Equipement, HistoriquePing, Alerte, User
+from models import Client, Equipement, HistoriquePing, Alerte, StatutClient, User
 from email_service import email_service
+from email_outbox import email_outbox
+from ingestion import (consigne_ping, enregistrer_ping, normaliser_ping, parser_lot_pings, traiter_lot_pings,
+                       EquipementInconnu, MAX_PINGS_PAR_LOT)
+from cache_equipements import cache_equipements
+from tampon_historique import tampon_historique
+from statuts_clients import recalculer_statuts_clients
+from statistiques import cache_statistiques, compter_alertes_non_lues
+from pagination import paginer_par_curseur, encoder_curseur, decoder_curseur, CurseurInvalide
+from partitions_historique import entite_historique
+from agregats import lire_agregats
+from rapports import mois_precedent, rapport_disponibilite
+from evenements import bus_evenements
+from acquittements import marquer_alertes_lues, MAX_IDS_PAR_DEMANDE
+from exports import lignes_historique, lignes_alertes, generer_export, COLONNES_HISTORIQUE, COLONNES_ALERTES, FORMATS
 
 logger = logging.getLogger(__name__)
 
+# Le flux de changements des équipements s'arrête à maintenant - MARGE_CHANGEMENTS : une mise à jour
+# datée avant la lecture mais validée juste après est ainsi livrée à l'appel suivant, pas perdue
+MARGE_CHANGEMENTS = timedelta(seconds=5)
+CHANGEMENTS_PAR_APPEL = 1000
+
+# Périodes proposées par le filtre de la page des alertes (None : depuis minuit)
+PERIODES_ALERTES = {'today': None, 'week': timedelta(days=7), 'month': timedelta(days=30)}
+
+def _date_utc(valeur):
+    """Date ISO 8601 en UTC naïf, comme les horodatages en base (une date sans fuseau est supposée UTC)"""
+    date = datetime.fromisoformat(valeur)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
 # Routes d'authentification
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -118,59 +149,34 @@ def register():
 def dashboard():
     """Page d'accueil avec vue d'ensemble du système"""
     try:
-        # Statistiques globales ou filtrées par client selon le rôle
-        if current_user.role == 'admin':
-            total_clients = Client.query.filter_by(actif=True).count()
-            total_equipements = Equipement.query.filter_by(actif=True).count()
-            equipements = Equipement.query.filter_by(actif=True).all()
-            clients = Client.query.filter_by(actif=True).all()
-        else:
-            # Pour les clients, afficher seulement leurs données
-            total_clients = 1 if current_user.client_id else 0
-            total_equipements = Equipement.query.filter_by(client_id=current_user.client_id, actif=True).count()
-            equipements = Equipement.query.filter_by(client_id=current_user.client_id, actif=True).all()
-            clients = [current_user.client] if current_user.client else []
-        
-        # Compter les équipements en ligne et hors ligne
-        equipements_en_ligne = 0
-        equipements_hors_ligne = 0
+        # Les événements postérieurs à ce rendu seront rejoués par le flux SSE de la page
+        dernier_evenement = bus_evenements.dernier_id()
+        rendu = datetime.utcnow()
         
-        for eq in equipements:
-            if eq.est_en_ligne:
-                equipements_en_ligne += 1
-            else:
-                equipements_hors_ligne += 1
+        # Statistiques globales ou filtrées par client selon le rôle
+        stats = cache_statistiques.obtenir(current_user.role == 'admin', current_user.client_id)
         
-        # Alertes non lues (filtrées par client si nécessaire)
         if current_user.role == 'admin':
-            alertes_non_lues = Alerte.query.filter_by(lue=False).count()
+            # Équipements de tous les clients chargés en une seconde requête (pastilles de la liste)
+            clients = Client.query.options(selectinload(Client.equipements)).filter_by(actif=True).all()
             dernieres_alertes = Alerte.query.order_by(Alerte.timestamp.desc()).limit(10).all()
         else:
-            # Pour les clients, ne montrer que leurs alertes
-            alertes_non_lues = db.session.query(Alerte).join(Equipement).filter(
-                Equipement.client_id == current_user.client_id,
-                Alerte.lue == False
-            ).count()
+            # Pour les clients, afficher seulement leurs données
+            clients = [current_user.client] if current_user.client else []
             dernieres_alertes = db.session.query(Alerte).join(Equipement).filter(
                 Equipement.client_id == current_user.client_id
             ).order_by(Alerte.timestamp.desc()).limit(10).all()
         
-        stats = {
-            'total_clients': total_clients,
-            'total_equipements': total_equipements,
-            'equipements_en_ligne': equipements_en_ligne,
-            'equipements_hors_ligne': equipements_hors_ligne,
-            'alertes_non_lues': alertes_non_lues
-        }
-        
         return render_template('dashboard.html', 
                              stats=stats, 
                              clients=clients,
-                             dernieres_alertes=dernieres_alertes)
+                             dernieres_alertes=dernieres_alertes,
+                             dernier_evenement=dernier_evenement,
+                             rendu=rendu.isoformat())
     except Exception as e:
         logger.error(f"Erreur dans dashboard: {e}")
         flash(f"Erreur lors du chargement du tableau de bord: {e}", "error")
-        return render_template('dashboard.html', stats={}, clients=[], dernieres_alertes=[])
+        return render_template('dashboard.html', stats={}, clients=[], dernieres_alertes=[], dernier_evenement=None, rendu=None)
 
 @app.route('/clients')
 @login_required
@@ -212,35 +218,36 @@ def equipements():
 def historique():
     """Page d'historique des pings"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = 50
+        # Le curseur borne la page d'un côté : seules les archives mensuelles (SQLite) de ce côté sont lues
+        fenetre = {}
+        jeton = request.args.get('curseur')
+        if jeton:
+            try:
+                horodatage, _, sens = decoder_curseur(jeton)
+            except CurseurInvalide:
+                return redirect(url_for('historique'))
+            fenetre = {'jusqua': horodatage} if sens == 'suivant' else {'depuis': horodatage}
         
-        if current_user.role == 'admin':
-            historique_query = HistoriquePing.query.order_by(HistoriquePing.timestamp.desc())
-        else:
+        # Table partitionnée (PostgreSQL) ou réunion des archives mensuelles (SQLite)
+        Historique = entite_historique(**fenetre)
+        historique_query = db.session.query(Historique)
+        if current_user.role != 'admin':
             # Pour les clients, filtrer par leurs équipements
-            historique_query = db.session.query(HistoriquePing).join(Equipement).filter(
+            historique_query = historique_query.join(Equipement, Historique.equipement_id == Equipement.id).filter(
                 Equipement.client_id == current_user.client_id
-            ).order_by(HistoriquePing.timestamp.desc())
-        
-        # Fallback pour SQLAlchemy avec pagination manuelle
-        from sqlalchemy import func
-        total = historique_query.count()
-        historique_items = historique_query.offset((page - 1) * per_page).limit(per_page).all()
-        
-        class MockPagination:
-            def __init__(self, items, page, per_page, total):
-                self.items = items
-                self.page = page
-                self.per_page = per_page
-                self.total = total
-                self.pages = (total + per_page - 1) // per_page if per_page > 0 else 1
-                self.has_prev = page > 1
-                self.has_next = page < self.pages
-                self.prev_num = page - 1 if self.has_prev else None
-                self.next_num = page + 1 if self.has_next else None
-        
-        historique_pagine = MockPagination(historique_items, page, per_page, total)
+            )
+        historique_query = historique_query.options(
+            joinedload(Historique.equipement).joinedload(Equipement.client)
+        )
+        
+        # Pagination par curseur sur (timestamp, id) : le coût d'une page ne dépend pas de sa profondeur
+        try:
+            historique_pagine = paginer_par_curseur(
+                historique_query, Historique.timestamp, Historique.id,
+                par_page=50, jeton=jeton
+            )
+        except CurseurInvalide:
+            return redirect(url_for('historique'))
         
         return render_template('history.html', historique=historique_pagine)
     except Exception as e:
@@ -251,75 +258,187 @@ def historique():
 @app.route('/alertes')
 @login_required
 def alertes():
-    """Page des alertes"""
+    """Page des alertes, filtrée et paginée par curseur côté serveur"""
+    filtres = {cle: request.args[cle] for cle in ('statut', 'type', 'periode', 'client_id', 'equipement_id')
+               if request.args.get(cle)}
+    clients = Client.query.filter_by(actif=True).order_by(Client.nom).all() if current_user.role == 'admin' else []
     try:
-        if current_user.role == 'admin':
-            alertes_list = Alerte.query.order_by(Alerte.timestamp.desc()).all()
-        else:
-            # Pour les clients, filtrer par leurs équipements
-            alertes_list = db.session.query(Alerte).join(Equipement).filter(
-                Equipement.client_id == current_user.client_id
-            ).order_by(Alerte.timestamp.desc()).all()
+        alertes_query = db.session.query(Alerte).join(Equipement, Alerte.equipement_id == Equipement.id)
+        
+        # Pour les clients, filtrer par leurs équipements
+        client_id = request.args.get('client_id', type=int) if current_user.role == 'admin' else current_user.client_id
+        if current_user.role != 'admin' or client_id:
+            alertes_query = alertes_query.filter(Equipement.client_id == client_id)
+        
+        equipement_id = request.args.get('equipement_id', type=int)
+        if equipement_id:
+            alertes_query = alertes_query.filter(Alerte.equipement_id == equipement_id)
+        if filtres.get('statut') in ('lue', 'non_lue'):
+            alertes_query = alertes_query.filter(Alerte.lue == (filtres['statut'] == 'lue'))
+        if filtres.get('type'):
+            alertes_query = alertes_query.filter(Alerte.type_alerte == filtres['type'])
+        debut = None
+        if filtres.get('periode') in PERIODES_ALERTES:
+            maintenant = datetime.utcnow()
+            duree = PERIODES_ALERTES[filtres['periode']]
+            debut = maintenant - duree if duree else maintenant.replace(hour=0, minute=0, second=0, microsecond=0)
+            alertes_query = alertes_query.filter(Alerte.timestamp >= debut)
+        
+        alertes_query = alertes_query.options(
+            contains_eager(Alerte.equipement).joinedload(Equipement.client)
+        )
+        
+        # Pagination par curseur sur (timestamp, id) : le coût d'une page ne dépend pas de sa profondeur
+        try:
+            alertes_pagine = paginer_par_curseur(
+                alertes_query, Alerte.timestamp, Alerte.id,
+                par_page=50, jeton=request.args.get('curseur')
+            )
+        except CurseurInvalide:
+            return redirect(url_for('alertes', **filtres))
         
-        return render_template('alerts.html', alertes=alertes_list)
+        # Compteurs des alertes non lues par type (index partiel), indépendants de la page affichée
+        non_lues = compter_alertes_non_lues(client_id if current_user.role != 'admin' or client_id else None)
+        
+        # Début de la période affichée : « tout marquer comme lu » reprend exactement la même fenêtre
+        return render_template('alerts.html', alertes=alertes_pagine, non_lues=non_lues,
+                               filtres=filtres, clients=clients, genere_le=datetime.utcnow().isoformat(),
+                               debut_periode=debut.isoformat() if debut else None)
     except Exception as e:
         logger.error(f"Erreur dans alertes: {e}")
         flash(f"Erreur lors du chargement des alertes: {e}", "error")
-        return render_template('alerts.html', alertes=[])
+        return render_template('alerts.html', alertes=None, non_lues={}, filtres=filtres, clients=clients,
+                               genere_le=datetime.utcnow().isoformat())
+
+@app.route('/api/alertes/marquer_lue/<int:alerte_id>', methods=['POST'])
+@login_required
+def api_marquer_alerte_lue(alerte_id):
+    """API pour marquer une alerte comme lue"""
+    try:
+        portee = None if current_user.role == 'admin' else current_user.client_id
+        nombre, evenements = marquer_alertes_lues(portee, ids=[alerte_id])
+        if nombre == 0 and not Alerte.query.get(alerte_id):
+            return jsonify({'error': 'Alerte non trouvée'}), 404
+        db.session.commit()
+        
+        if nombre:
+            cache_statistiques.invalider()
+            bus_evenements.publier_lot(evenements)
+        return jsonify({'status': 'success', 'message': 'Alerte marquée comme lue', 'nombre': nombre})
+        
+    except Exception as e:
+        logger.error(f"Erreur API marquer alerte lue: {e}")
+        db.session.rollback()
+        return jsonify({'error': "Erreur lors de la mise à jour de l'alerte"}), 500
+
+@app.route('/api/alertes/marquer_lues', methods=['POST'])
+@login_required
+def api_marquer_alertes_lues():
+    """API d'acquittement groupé : par liste d'ids, équipement, client et/ou antériorité (critères cumulés)
+
+    Corps JSON : {"ids": [...], "equipement_id": n, "client_id": n, "type": "...",
+    "depuis": "ISO 8601", "avant": "ISO 8601"}, les filtres de la page des alertes.
+    Les dates avec fuseau sont converties en UTC. Au moins un critère est requis ;
+    la réponse donne le nombre d'alertes marquées.
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Objet JSON attendu'}), 400
+        
+        ids = data.get('ids')
+        try:
+            if ids is not None:
+                if not isinstance(ids, list) or len(ids) > MAX_IDS_PAR_DEMANDE:
+                    return jsonify({'error': f'Liste de {MAX_IDS_PAR_DEMANDE} identifiants au plus attendue'}), 400
+                ids = [int(alerte_id) for alerte_id in ids]
+            equipement_id = int(data['equipement_id']) if data.get('equipement_id') is not None else None
+            client_id = int(data['client_id']) if data.get('client_id') is not None else None
+            type_alerte = str(data['type']) if data.get('type') else None
+            depuis = _date_utc(data['depuis']) if data.get('depuis') else None
+            avant = _date_utc(data['avant']) if data.get('avant') else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Critères invalides'}), 400
+        
+        if ids is None and equipement_id is None and client_id is None and avant is None:
+            return jsonify({'error': 'Au moins un critère est requis (ids, equipement_id, client_id ou avant)'}), 400
+        
+        portee = None if current_user.role == 'admin' else current_user.client_id
+        nombre, evenements = marquer_alertes_lues(portee, ids, equipement_id, client_id, avant,
+                                                  type_alerte=type_alerte, depuis=depuis)
+        db.session.commit()
+        
+        if nombre:
+            cache_statistiques.invalider()
+            bus_evenements.publier_lot(evenements)
+        return jsonify({'status': 'success', 'nombre': nombre})
+        
+    except Exception as e:
+        logger.error(f"Erreur API marquer alertes lues: {e}")
+        db.session.rollback()
+        return jsonify({'error': 'Erreur lors de la mise à jour des alertes'}), 500
 
 # API Routes pour recevoir les pings des DVR/caméras
+def _consigne_ping():
+    return consigne_ping(app.config['PING_INTERVALLE_ATTENDU'], app.config['PING_SEUIL_SATURATION'])
+
+def reponse_saturation(consigne):
+    """Refus d'un ping quand l'ingestion est saturée : l'équipement réessaie après Retry-After"""
+    reponse = jsonify({
+        "error": "Serveur surchargé, réessayer plus tard",
+        "retry_after": consigne['retry_after'],
+        "intervalle_recommande": consigne['intervalle_recommande'],
+        "gigue": consigne['gigue']
+    })
+    reponse.status_code = 503
+    reponse.headers['Retry-After'] = str(consigne['retry_after'])
+    return reponse
+
 @app.route('/api/ping', methods=['POST'])
 def recevoir_ping():
-    """Endpoint pour recevoir les pings des équipements"""
+    """Endpoint pour recevoir les pings des équipements
+
+    La réponse donne l'intervalle recommandé avant le prochain ping et sa
+    gigue (secondes), ajustés à la charge d'ingestion.
+    """
     try:
-        data = request.get_json()
+        consigne = _consigne_ping()
+        if consigne['saturee']:
+            return reponse_saturation(consigne)
+        
+        data = request.get_json(silent=True)
         
-        if not data:
+        if not data or not isinstance(data, dict):
             return jsonify({"error": "Données JSON requises"}), 400
         
+        # Vérifié avant toute écriture : un ping refusé n'est pas enregistré
+        try:
+            data = normaliser_ping(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         adresse_ip = data.get('ip')
         equipement_id = data.get('equipement_id')
         
         if not adresse_ip and not equipement_id:
             return jsonify({"error": "IP ou ID d'équipement requis"}), 400
         
-        # Trouver l'équipement
+        # Trouver l'équipement dans l'index en mémoire
         if equipement_id:
-            equipement = Equipement.query.get(equipement_id)
+            equipement = cache_equipements.par_id(equipement_id)
         else:
-            equipement = Equipement.query.filter_by(adresse_ip=adresse_ip, actif=True).first()
+            equipement = cache_equipements.par_ip(adresse_ip)
         
-        if not equipement:
+        # Un équipement désactivé est traité comme inconnu, quel que soit le moyen de le désigner
+        if not equipement or not equipement.actif:
             logger.warning(f"Équipement non trouvé pour IP: {adresse_ip}, ID: {equipement_id}")
             return jsonify({"error": "Équipement non trouvé"}), 404
         
-        # Vérifier si l'équipement était hors ligne
-        etait_hors_ligne = not equipement.est_en_ligne
-        
-        # Mettre à jour le dernier ping
-        equipement.dernier_ping = datetime.utcnow()
-        
-        # Enregistrer dans l'historique
-        historique = HistoriquePing()
-        historique.equipement_id = equipement.id
-        historique.timestamp = datetime.utcnow()
-        historique.statut = 'success'
-        historique.reponse_ms = data.get('response_time')
-        historique.message = data.get('message', 'Ping reçu avec succès')
-        
-        db.session.add(historique)
-        
-        # Créer une alerte si l'équipement revient en ligne
-        if etait_hors_ligne:
-            alerte = Alerte()
-            alerte.equipement_id = equipement.id
-            alerte.type_alerte = 'retour_en_ligne'
-            alerte.message = f"L'équipement {equipement.nom} ({equipement.adresse_ip}) est revenu en ligne"
-            alerte.timestamp = datetime.utcnow()
-            db.session.add(alerte)
-            logger.info(f"Équipement {equipement.nom} revenu en ligne")
-        
-        db.session.commit()
+        try:
+            enregistrer_ping(equipement, data)
+        except EquipementInconnu:
+            logger.warning(f"Équipement supprimé ou désactivé: ID {equipement.id}")
+            return jsonify({"error": "Équipement non trouvé"}), 404
         
         logger.debug(f"Ping reçu pour {equipement.nom} ({equipement.adresse_ip})")
         
@@ -327,13 +446,60 @@ def recevoir_ping():
             "status": "success",
             "message": "Ping reçu",
             "equipement_id": equipement.id,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": datetime.utcnow().isoformat(),
+            "intervalle_recommande": consigne['intervalle_recommande'],
+            "gigue": consigne['gigue']
         })
         
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Erreur lors du traitement du ping: {e}")
         return jsonify({"error": "Erreur interne du serveur"}), 500
 
+@app.route('/api/ping/batch', methods=['POST'])
+def recevoir_lot_pings():
+    """Endpoint pour recevoir un lot de pings (tableau JSON ou NDJSON) depuis une passerelle"""
+    try:
+        consigne = _consigne_ping()
+        if consigne['saturee']:
+            return reponse_saturation(consigne)
+        
+        pings = parser_lot_pings(request.get_data(as_text=True), request.mimetype)
+
+        if not pings:
+            return jsonify({"error": "Au moins un ping est requis"}), 400
+
+        if len(pings) > MAX_PINGS_PAR_LOT:
+            return jsonify({"error": f"Lot limité à {MAX_PINGS_PAR_LOT} pings"}), 413
+
+        resultats = traiter_lot_pings(pings)
+        acceptes = len([r for r in resultats if r['status'] == 'success'])
+
+        return jsonify({
+            "status": "success" if acceptes == len(resultats) else "partial",
+            "total": len(resultats),
+            "acceptes": acceptes,
+            "rejetes": len(resultats) - acceptes,
+            "resultats": resultats,
+            "timestamp": datetime.utcnow().isoformat(),
+            "intervalle_recommande": consigne['intervalle_recommande'],
+            "gigue": consigne['gigue']
+        })
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Erreur lors du traitement du lot de pings: {e}")
+        return jsonify({"error": "Erreur interne du serveur"}), 500
+
+@app.route('/api/ingestion/metriques')
+@login_required
+def api_ingestion_metriques():
+    """API pour suivre le remplissage du tampon d'historique (admin seulement)"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Accès réservé aux administrateurs'}), 403
+    
+    return jsonify({'tampon_historique': tampon_historique.metriques()})
+
 # Routes d'administration (admin seulement)
 @app.route('/admin/users')
 @login_required
@@ -376,11 +542,13 @@ def approve_user(user_id):
             return redirect(url_for('admin_users'))
         
         user.statut = 'approuve'
-        db.session.commit()
         
-        # Envoyer un email de confirmation
+        # Mettre en file l'email de confirmation, enregistré avec le changement de statut
         if email_service:
-            email_service.send_account_approval_notification(user.email, user.nom_complet or user.nom_utilisateur, approved=True)
+            email_service.queue_account_approval_notification(user.email, user.nom_complet or user.nom_utilisateur, approved=True)
+        
+        db.session.commit()
+        email_outbox.reveiller()
         
         flash(f'Utilisateur {user.nom_utilisateur} approuvé avec succès.', 'success')
         
@@ -406,11 +574,13 @@ def reject_user(user_id):
             return redirect(url_for('admin_users'))
         
         user.statut = 'refuse'
-        db.session.commit()
         
-        # Envoyer un email de refus
+        # Mettre en file l'email de refus, enregistré avec le changement de statut
         if email_service:
-            email_service.send_account_approval_notification(user.email, user.nom_complet or user.nom_utilisateur, approved=False)
+            email_service.queue_account_approval_notification(user.email, user.nom_complet or user.nom_utilisateur, approved=False)
+        
+        db.session.commit()
+        email_outbox.reveiller()
         
         flash(f'Utilisateur {user.nom_utilisateur} refusé.', 'info')
         
@@ -427,33 +597,7 @@ def reject_user(user_id):
 def api_stats():
     """API pour obtenir les statistiques en temps réel"""
     try:
-        if current_user.role == 'admin':
-            total_clients = Client.query.filter_by(actif=True).count()
-            total_equipements = Equipement.query.filter_by(actif=True).count()
-            equipements = Equipement.query.filter_by(actif=True).all()
-        else:
-            total_clients = 1 if current_user.client_id else 0
-            total_equipements = Equipement.query.filter_by(client_id=current_user.client_id, actif=True).count()
-            equipements = Equipement.query.filter_by(client_id=current_user.client_id, actif=True).all()
-        
-        equipements_en_ligne = len([eq for eq in equipements if eq.est_en_ligne])
-        equipements_hors_ligne = len([eq for eq in equipements if not eq.est_en_ligne])
-        
-        if current_user.role == 'admin':
-            alertes_non_lues = Alerte.query.filter_by(lue=False).count()
-        else:
-            alertes_non_lues = db.session.query(Alerte).join(Equipement).filter(
-                Equipement.client_id == current_user.client_id,
-                Alerte.lue == False
-            ).count()
-        
-        return jsonify({
-            'total_clients': total_clients,
-            'total_equipements': total_equipements,
-            'equipements_en_ligne': equipements_en_ligne,
-            'equipements_hors_ligne': equipements_hors_ligne,
-            'alertes_non_lues': alertes_non_lues
-        })
+        return jsonify(cache_statistiques.obtenir(current_user.role == 'admin', current_user.client_id))
         
     except Exception as e:
         logger.error(f"Erreur dans api_stats: {e}")
@@ -462,8 +606,15 @@ def api_stats():
 @app.route('/api/equipements/status')
 @login_required
 def api_equipements_status():
-    """API pour obtenir le statut des équipements en temps réel"""
+    """API pour obtenir le statut des équipements en temps réel
+
+    Avec `since` (vide au premier appel), seuls les équipements modifiés après
+    le curseur sont renvoyés, avec le curseur à passer à l'appel suivant.
+    """
     try:
+        if 'since' in request.args:
+            return changements_equipements(request.args['since'], request.args.get('limit', CHANGEMENTS_PAR_APPEL, type=int))
+        
         if current_user.role == 'admin':
             equipements = Equipement.query.filter_by(actif=True).all()
         else:
@@ -487,6 +638,239 @@ def api_equipements_status():
         logger.error(f"Erreur dans api_equipements_status: {e}")
         return jsonify({'error': 'Erreur lors du chargement du statut des équipements'}), 500
 
+def changements_equipements(jeton, limite):
+    """Équipements modifiés après le curseur `jeton`, par (date_modification, id) croissants"""
+    limite = max(1, min(limite, CHANGEMENTS_PAR_APPEL))
+    horizon = datetime.utcnow() - MARGE_CHANGEMENTS
+    
+    requete = db.session.query(
+        Equipement.id,
+        Equipement.nom,
+        Equipement.adresse_ip,
+        Equipement.client_id,
+        Equipement.actif,
+        Equipement.etat,
+        Equipement.etat_depuis,
+        Equipement.dernier_ping,
+        Equipement.date_modification
+    ).filter(Equipement.date_modification <= horizon)
+    
+    if current_user.role != 'admin':
+        requete = requete.filter(Equipement.client_id == current_user.client_id)
+    
+    if jeton:
+        try:
+            horodatage, identifiant, _ = decoder_curseur(jeton)
+        except CurseurInvalide:
+            return jsonify({'error': 'Curseur invalide'}), 400
+        requete = requete.filter(tuple_(Equipement.date_modification, Equipement.id) > tuple_(horodatage, identifiant))
+    else:
+        # Premier appel : état complet des équipements actifs (les désactivés ne sont signalés qu'ensuite)
+        requete = requete.filter(Equipement.actif == True)
+    
+    lignes = requete.order_by(Equipement.date_modification, Equipement.id).limit(limite + 1).all()
+    encore = len(lignes) > limite
+    lignes = lignes[:limite]
+    
+    if lignes:
+        curseur = encoder_curseur(lignes[-1].date_modification, lignes[-1].id, 'suivant')
+    else:
+        curseur = jeton or None
+    
+    return jsonify({
+        'equipements': [{
+            'id': ligne.id,
+            'nom': ligne.nom,
+            'adresse_ip': ligne.adresse_ip,
+            'client_id': ligne.client_id,
+            'actif': ligne.actif,
+            'etat': ligne.etat,
+            'etat_depuis': ligne.etat_depuis.isoformat() if ligne.etat_depuis else None,
+            'dernier_ping': ligne.dernier_ping.isoformat() if ligne.dernier_ping else None
+        } for ligne in lignes],
+        'next_cursor': curseur,
+        'has_more': encore
+    })
+
+def instantane_tableau_de_bord(client_id, rendu):
+    """État courant à appliquer par une page rendue à `rendu` qui ne peut pas rejouer les événements manqués
+
+    Compteurs du tableau de bord, compteurs par client et état des équipements
+    qui ont changé d'état (ou ont été désactivés) depuis le rendu. Retourne
+    None s'ils sont trop nombreux (la page est alors rechargée).
+    """
+    depuis = rendu - MARGE_CHANGEMENTS
+    requete_equipements = db.session.query(
+        Equipement.id, Equipement.client_id, Equipement.actif, Equipement.etat
+    ).filter(or_(
+        Equipement.etat_depuis >= depuis,
+        and_(Equipement.actif == False, Equipement.date_modification >= depuis)
+    ))
+    requete_clients = db.session.query(StatutClient.client_id, StatutClient.nb_total, StatutClient.nb_en_ligne)
+    if client_id is not None:
+        requete_equipements = requete_equipements.filter(Equipement.client_id == client_id)
+        requete_clients = requete_clients.filter(StatutClient.client_id == client_id)
+    
+    equipements = requete_equipements.limit(CHANGEMENTS_PAR_APPEL + 1).all()
+    if len(equipements) > CHANGEMENTS_PAR_APPEL:
+        return None
+    
+    return {
+        'stats': cache_statistiques.obtenir(client_id is None, client_id),
+        'clients': [{
+            'client_id': statut.client_id,
+            'nb_total': statut.nb_total,
+            'nb_en_ligne': statut.nb_en_ligne
+        } for statut in requete_clients],
+        'equipements': [{
+            'equipement_id': equipement.id,
+            'client_id': equipement.client_id,
+            'etat': equipement.etat if equipement.actif else 'inactif'
+        } for equipement in equipements]
+    }
+
+@app.route('/api/stream/status')
+@login_required
+def api_stream_status():
+    """Flux SSE des changements d'état et des alertes, limité au client de l'utilisateur
+
+    Quand les événements manqués ne peuvent pas être rejoués (reconnexion sur
+    un autre worker sans relais Redis), le flux commence par un instantané de
+    l'état courant plutôt que de faire recharger la page.
+    """
+    client_id = None if current_user.role == 'admin' else current_user.client_id
+    dernier_id = request.headers.get('Last-Event-ID') or request.args.get('depuis')
+    
+    abonne = bus_evenements.abonner(client_id, dernier_id)
+    if abonne is None:
+        return jsonify({'error': 'Trop de connexions temps réel ouvertes'}), 503, {'Retry-After': '30'}
+    
+    if abonne.rattrapage is None and request.args.get('rendu'):
+        try:
+            abonne.instantane = instantane_tableau_de_bord(client_id, _date_utc(request.args['rendu']))
+        except ValueError:
+            pass
+        except Exception as e:
+            logger.error(f"Erreur lors de la préparation de l'instantané du tableau de bord: {e}")
+            db.session.rollback()
+    
+    reponse = Response(
+        bus_evenements.flux_sse(abonne, app.config['EVENEMENTS_DUREE_FLUX']),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Le générateur peut être fermé avant sa première itération
+    reponse.call_on_close(lambda: bus_evenements.desabonner(abonne))
+    return reponse
+
+@app.route('/api/equipements/<int:equipement_id>/agregats')
+@login_required
+def api_agregats_equipement(equipement_id):
+    """API des agrégats de disponibilité et de temps de réponse d'un équipement (7 derniers jours par défaut)"""
+    try:
+        equipement = Equipement.query.get(equipement_id)
+        if not equipement or (current_user.role != 'admin' and equipement.client_id != current_user.client_id):
+            return jsonify({'error': 'Équipement non trouvé'}), 404
+        
+        try:
+            fin = _date_utc(request.args['fin']) if 'fin' in request.args else datetime.utcnow()
+            debut = _date_utc(request.args['debut']) if 'debut' in request.args else fin - timedelta(days=7)
+        except ValueError:
+            return jsonify({'error': 'Dates invalides (format ISO 8601 attendu)'}), 400
+        
+        return jsonify({
+            'equipement_id': equipement.id,
+            'debut': debut.isoformat(),
+            'fin': fin.isoformat(),
+            'agregats': lire_agregats(equipement.id, debut, fin)
+        })
+        
+    except Exception as e:
+        logger.error(f"Erreur dans api_agregats_equipement: {e}")
+        return jsonify({'error': 'Erreur lors du chargement des agrégats'}), 500
+
+@app.route('/api/rapports/disponibilite')
+@login_required
+def api_rapport_disponibilite():
+    """Rapport de disponibilité (SLA) d'un client, le mois précédent par défaut"""
+    try:
+        if current_user.role == 'admin':
+            client_id = request.args.get('client_id', type=int)
+            if not client_id:
+                return jsonify({'error': 'Paramètre client_id requis'}), 400
+        else:
+            client_id = current_user.client_id
+        
+        try:
+            debut, fin = mois_precedent()
+            if 'debut' in request.args:
+                debut = _date_utc(request.args['debut'])
+            if 'fin' in request.args:
+                fin = _date_utc(request.args['fin'])
+        except ValueError:
+            return jsonify({'error': 'Dates invalides (format ISO 8601 attendu)'}), 400
+        if debut >= fin:
+            return jsonify({'error': 'La date de début doit précéder la date de fin'}), 400
+        
+        rapport = rapport_disponibilite(client_id, debut, fin, app.config['PING_INTERVALLE_ATTENDU'])
+        if rapport is None:
+            return jsonify({'error': 'Client non trouvé'}), 404
+        return jsonify(rapport)
+        
+    except Exception as e:
+        logger.error(f"Erreur dans api_rapport_disponibilite: {e}")
+        return jsonify({'error': 'Erreur lors du calcul du rapport'}), 500
+
+@app.route('/api/export/historique')
+@login_required
+def api_export_historique():
+    """Export en flux de l'historique des pings (30 derniers jours par défaut)"""
+    return reponse_export('historique', lignes_historique, COLONNES_HISTORIQUE)
+
+@app.route('/api/export/alertes')
+@login_required
+def api_export_alertes():
+    """Export en flux des alertes (30 derniers jours par défaut)"""
+    return reponse_export('alertes', lignes_alertes, COLONNES_ALERTES)
+
+def reponse_export(nom, lire_lignes, colonnes):
+    """Réponse en flux d'un export filtré par client, équipement et dates (format=csv|ndjson, gzip=1)"""
+    try:
+        format_export = request.args.get('format', 'csv')
+        if format_export not in FORMATS:
+            return jsonify({'error': 'Format invalide (csv ou ndjson)'}), 400
+        
+        client_id = request.args.get('client_id', type=int) if current_user.role == 'admin' else current_user.client_id
+        equipement_id = request.args.get('equipement_id', type=int)
+        if equipement_id:
+            equipement = Equipement.query.get(equipement_id)
+            if not equipement or (current_user.role != 'admin' and equipement.client_id != current_user.client_id):
+                return jsonify({'error': 'Équipement non trouvé'}), 404
+        
+        try:
+            fin = _date_utc(request.args['fin']) if 'fin' in request.args else datetime.utcnow()
+            debut = _date_utc(request.args['debut']) if 'debut' in request.args else fin - timedelta(days=30)
+        except ValueError:
+            return jsonify({'error': 'Dates invalides (format ISO 8601 attendu)'}), 400
+        if debut >= fin:
+            return jsonify({'error': 'La date de début doit précéder la date de fin'}), 400
+        
+        gzip = request.args.get('gzip') == '1'
+        mimetype, extension = FORMATS[format_export]
+        nom_fichier = f"{nom}_{debut:%Y%m%d}_{fin:%Y%m%d}.{extension}{'.gz' if gzip else ''}"
+        
+        # Les lignes sont lues et envoyées au fil de l'eau, dans le contexte de la requête
+        lignes = lire_lignes(client_id, equipement_id, debut, fin)
+        return Response(
+            stream_with_context(generer_export(lignes, colonnes, format_export, gzip)),
+            mimetype='application/gzip' if gzip else mimetype,
+            headers={'Content-Disposition': f'attachment; filename="{nom_fichier}"', 'X-Accel-Buffering': 'no'}
+        )
+        
+    except Exception as e:
+        logger.error(f"Erreur lors de l'export {nom}: {e}")
+        return jsonify({'error': "Erreur lors de l'export"}), 500
+
 # Routes pour la création et modification de clients et équipements
 @app.route('/clients/add', methods=['GET', 'POST'])
 @login_required
@@ -627,7 +1011,10 @@ def add_equipement():
             nouvel_equipement.client_id = client_id
             
             db.session.add(nouvel_equipement)
+            db.session.flush()
+            recalculer_statuts_clients([client_id])
             db.session.commit()
+            cache_equipements.invalider()
             
             flash(f'Équipement "{nom}" ajouté avec succès.', 'success')
             logger.info(f'Nouvel équipement créé: {nom} ({adresse_ip}) par {current_user.nom_utilisateur}')
@@ -660,12 +1047,16 @@ def edit_equipement(equipement_id):
         equipement.port = request.form.get('port', equipement.port, type=int)
         
         # Seuls les admins peuvent changer le client
+        ancien_client_id = equipement.client_id
         if current_user.role == 'admin':
             new_client_id = request.form.get('client_id', type=int)
             if new_client_id:
                 equipement.client_id = new_client_id
         
+        db.session.flush()
+        recalculer_statuts_clients({ancien_client_id, equipement.client_id})
         db.session.commit()
+        cache_equipements.invalider()
         flash(f'Équipement "{equipement.nom}" modifié avec succès.', 'success')
         logger.info(f'Équipement {equipement.nom} modifié par {current_user.nom_utilisateur}')
         
@@ -692,7 +1083,10 @@ def delete_equipement(equipement_id):
             return redirect(url_for('equipements'))
         
         equipement.actif = False  # Suppression logique
+        db.session.flush()
+        recalculer_statuts_clients([equipement.client_id])
         db.session.commit()
+        cache_equipements.invalider()
         flash(f'Équipement "{equipement.nom}" supprimé avec succès.', 'success')
         logger.info(f'Équipement {equipement.nom} supprimé par {current_user.nom_utilisateur}')
         
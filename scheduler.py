@@ -2,99 +2,295 @@ import logging
 from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
+from sqlalchemy import func, insert, or_, select, update
 from app import db
-from models import Equipement, Alerte
+from models import Client, Equipement, Alerte, HistoriquePing, Incident, NotificationEnAttente
 from email_service import email_service
+from email_outbox import email_outbox
+from statuts_clients import ajuster_statuts_clients, recalculer_statuts_clients
+from statistiques import cache_statistiques
+from partitions_historique import maintenir_partitions, purger_archives_expirees, supprimer_partitions_expirees
+from retention import purger_par_lots
+from agregats import calculer_agregats
+from rapports import mois_precedent, rapport_disponibilite
+from sketch_latence import sketches_latence
+from evenements import bus_evenements
 
 logger = logging.getLogger(__name__)
 
-def verifier_equipements_hors_ligne():
-    """Vérifie périodiquement les équipements hors ligne et génère des alertes"""
+def passer_equipements_hors_ligne(maintenant, timeout, equipement_ids=None):
+    """Passe à l'état 'hors_ligne' les équipements sans ping depuis le timeout
+
+    Un UPDATE ... RETURNING par état de départ : une ligne n'est retournée qu'à
+    la requête qui l'a effectivement modifiée, même si plusieurs processus
+    vérifient le même équipement. Retourne les événements 'etat' à publier
+    après le commit.
+    """
+    sortants = []
+    for precedent in ('en_ligne', 'jamais_vu'):
+        condition = [
+            Equipement.actif == True,
+            Equipement.etat == precedent,
+            Equipement.dernier_ping != None,
+            Equipement.dernier_ping <= timeout
+        ]
+        if equipement_ids is not None:
+            condition.append(Equipement.id.in_(equipement_ids))
+        
+        lignes = db.session.execute(
+            update(Equipement)
+            .where(*condition)
+            .values(etat='hors_ligne', etat_depuis=maintenant)
+            .returning(Equipement.id, Equipement.client_id, Equipement.dernier_ping)
+            .execution_options(synchronize_session=False)
+        ).all()
+        sortants.extend((equipement, precedent) for equipement in lignes)
+    
+    sorties_par_client = {}
+    for equipement, precedent in sortants:
+        if precedent == 'en_ligne':
+            sorties_par_client[equipement.client_id] = sorties_par_client.get(equipement.client_id, 0) + 1
+    
+    # Ouvrir un incident par équipement, daté de l'expiration de son dernier ping
+    if sortants:
+        db.session.execute(insert(Incident), [{
+            'equipement_id': equipement.id,
+            'debut': equipement.dernier_ping + timedelta(minutes=2)
+        } for equipement, precedent in sortants])
+    
+    ajuster_statuts_clients({client_id: -nombre for client_id, nombre in sorties_par_client.items()})
+    
+    if sortants:
+        logger.info(f"{len(sortants)} équipements passés hors ligne")
+    return [('etat', equipement.client_id, {
+        'equipement_id': equipement.id,
+        'client_id': equipement.client_id,
+        'etat': 'hors_ligne',
+        'precedent': precedent,
+        'depuis': maintenant.isoformat()
+    }) for equipement, precedent in sortants]
+
+def verifier_equipements_hors_ligne(equipement_ids=None):
+    """Vérifie les équipements hors ligne et génère des alertes
+
+    Sans argument, tout le parc est balayé (rattrapage périodique : alertes
+    répétées, équipements jamais vus). Avec `equipement_ids` (échéances
+    atteintes dans detecteur_hors_ligne), seuls les équipements que cet appel
+    fait passer hors ligne reçoivent une alerte.
+    """
     from app import app
     
     with app.app_context():
         try:
+            maintenant = datetime.utcnow()
+            
             # Définir le seuil de timeout (2 minutes)
-            timeout = datetime.utcnow() - timedelta(minutes=2)
+            timeout = maintenant - timedelta(minutes=2)
             
-            # Trouver tous les équipements actifs
-            equipements = Equipement.query.filter_by(actif=True).all()
+            # Persister les transitions vers 'hors_ligne' et les reporter sur les compteurs par client
+            transitions = passer_equipements_hors_ligne(maintenant, timeout, equipement_ids)
             
-            for equipement in equipements:
-                # Vérifier si l'équipement était en ligne mais est maintenant hors ligne
-                etait_en_ligne = True
-                if equipement.dernier_ping is None or equipement.dernier_ping <= timeout:
-                    etait_en_ligne = False
-                
-                # Vérifier s'il y a déjà une alerte récente pour cet équipement
-                alerte_recente = Alerte.query.filter_by(
-                    equipement_id=equipement.id,
-                    type_alerte='hors_ligne'
-                ).filter(
-                    Alerte.timestamp > datetime.utcnow() - timedelta(hours=1)
-                ).first()
-                
-                # Si l'équipement est hors ligne et qu'il n'y a pas d'alerte récente
-                if not etait_en_ligne and not alerte_recente:
-                    # Créer une nouvelle alerte
-                    alerte = Alerte()
-                    alerte.equipement_id = equipement.id
-                    alerte.type_alerte = 'hors_ligne'
-                    alerte.message = f"L'équipement {equipement.nom} ({equipement.adresse_ip}) du client {equipement.client.nom} est hors ligne depuis plus de 2 minutes"
-                    alerte.timestamp = datetime.utcnow()
-                    
-                    # Envoyer email d'alerte au client
-                    if equipement.client.email:
-                        email_service.send_equipment_offline_alert(
-                            client_email=equipement.client.email,
-                            client_name=equipement.client.nom,
-                            equipment_name=equipement.nom,
-                            equipment_type=equipement.type_equipement,
-                            equipment_ip=equipement.adresse_ip
-                        )
-                        logger.info(f"Email d'alerte envoyé à {equipement.client.email} pour l'équipement {equipement.nom}")
-                    
-                    db.session.add(alerte)
-                    logger.warning(f"Alerte générée: {equipement.nom} hors ligne")
+            # Alerte 'hors_ligne' de moins d'une heure pour l'équipement
+            alerte_recente = db.session.query(Alerte.id).filter(
+                Alerte.equipement_id == Equipement.id,
+                Alerte.type_alerte == 'hors_ligne',
+                Alerte.timestamp > maintenant - timedelta(hours=1)
+            ).exists()
+            
+            # Une seule requête (anti-jointure) : équipements actifs hors ligne sans alerte récente
+            requete = db.session.query(
+                Equipement.id,
+                Equipement.nom,
+                Equipement.type_equipement,
+                Equipement.adresse_ip,
+                Equipement.client_id,
+                Client.nom.label('client_nom'),
+                Client.email.label('client_email')
+            ).join(Client, Equipement.client_id == Client.id).filter(
+                Equipement.actif == True,
+                or_(Equipement.dernier_ping == None, Equipement.dernier_ping <= timeout),
+                ~alerte_recente
+            )
+            if equipement_ids is not None:
+                requete = requete.filter(Equipement.id.in_([donnees['equipement_id'] for _, _, donnees in transitions]))
+            equipements_hors_ligne = requete.all() if equipement_ids is None or transitions else []
+            
+            if not equipements_hors_ligne:
+                db.session.commit()
+                if transitions:
+                    cache_statistiques.invalider()
+                    bus_evenements.publier_lot(transitions)
+                logger.debug("Vérification des équipements hors ligne terminée")
+                return
+            
+            # Créer toutes les alertes en une seule insertion
+            alertes = [{
+                'equipement_id': equipement.id,
+                'type_alerte': 'hors_ligne',
+                'message': f"L'équipement {equipement.nom} ({equipement.adresse_ip}) du client {equipement.client_nom} est hors ligne depuis plus de 2 minutes",
+                'timestamp': maintenant,
+                'lue': False
+            } for equipement in equipements_hors_ligne]
+            db.session.execute(insert(Alerte), alertes)
+            
+            # Les emails sont regroupés par client puis envoyés par envoyer_recapitulatifs_alertes
+            notifications = [{
+                'client_id': equipement.client_id,
+                'equipement_id': equipement.id,
+                'date_creation': maintenant
+            } for equipement in equipements_hors_ligne if equipement.client_email]
+            if notifications:
+                db.session.execute(insert(NotificationEnAttente), notifications)
             
             db.session.commit()
+            cache_statistiques.invalider()
+            bus_evenements.publier_lot(transitions + [('alerte', equipement.client_id, {
+                'equipement_id': equipement.id,
+                'equipement_nom': equipement.nom,
+                'type_alerte': alerte['type_alerte'],
+                'message': alerte['message'],
+                'timestamp': maintenant.isoformat()
+            }) for equipement, alerte in zip(equipements_hors_ligne, alertes)])
+            logger.warning(f"Alertes générées: {len(equipements_hors_ligne)} équipements hors ligne")
+            
             logger.debug("Vérification des équipements hors ligne terminée")
             
         except Exception as e:
             logger.error(f"Erreur lors de la vérification des équipements: {e}")
             db.session.rollback()
 
-def nettoyer_historique():
-    """Nettoie l'historique ancien pour éviter l'accumulation excessive de données"""
+def envoyer_recapitulatifs_alertes():
+    """Regroupe les équipements hors ligne par client et met en file un seul email par client
+
+    Un client est notifié dès que son plus ancien événement en attente a
+    dépassé la fenêtre de regroupement (ALERTE_DIGEST_FENETRE secondes).
+    """
     from app import app
     
     with app.app_context():
         try:
-            # Supprimer les entrées d'historique plus anciennes que 30 jours
-            limite = datetime.utcnow() - timedelta(days=30)
+            limite = datetime.utcnow() - timedelta(seconds=app.config.get('ALERTE_DIGEST_FENETRE', 300))
+            
+            clients_dus = select(NotificationEnAttente.client_id).group_by(
+                NotificationEnAttente.client_id
+            ).having(func.min(NotificationEnAttente.date_creation) <= limite)
+            
+            notifications = db.session.query(
+                NotificationEnAttente.id,
+                NotificationEnAttente.client_id,
+                NotificationEnAttente.date_creation,
+                Client.nom.label('client_nom'),
+                Client.email.label('client_email'),
+                Equipement.id.label('equipement_id'),
+                Equipement.nom,
+                Equipement.type_equipement,
+                Equipement.adresse_ip
+            ).join(Client, NotificationEnAttente.client_id == Client.id).join(
+                Equipement, NotificationEnAttente.equipement_id == Equipement.id
+            ).filter(
+                NotificationEnAttente.client_id.in_(clients_dus)
+            ).order_by(NotificationEnAttente.client_id, NotificationEnAttente.date_creation).all()
             
-            from models import HistoriquePing
+            if not notifications:
+                return
             
-            # Compter les entrées à supprimer
-            nb_a_supprimer = HistoriquePing.query.filter(
-                HistoriquePing.timestamp < limite
-            ).count()
+            par_client = {}
+            for notification in notifications:
+                par_client.setdefault(notification.client_id, []).append(notification)
             
-            if nb_a_supprimer > 0:
-                # Supprimer les entrées anciennes
-                HistoriquePing.query.filter(
-                    HistoriquePing.timestamp < limite
-                ).delete()
+            for client_notifications in par_client.values():
+                premiere = client_notifications[0]
                 
-                db.session.commit()
-                logger.info(f"Historique nettoyé: {nb_a_supprimer} entrées supprimées")
+                # Un même équipement n'apparaît qu'une fois dans le récapitulatif
+                equipements = {}
+                for notification in client_notifications:
+                    equipements.setdefault(notification.equipement_id, notification)
+                
+                if len(equipements) == 1:
+                    email_service.queue_equipment_offline_alert(
+                        client_email=premiere.client_email,
+                        client_name=premiere.client_nom,
+                        equipment_name=premiere.nom,
+                        equipment_type=premiere.type_equipement,
+                        equipment_ip=premiere.adresse_ip
+                    )
+                else:
+                    email_service.queue_equipment_offline_digest(
+                        client_email=premiere.client_email,
+                        client_name=premiere.client_nom,
+                        equipments=[{
+                            'name': notification.nom,
+                            'type': notification.type_equipement,
+                            'ip': notification.adresse_ip,
+                            'since': notification.date_creation
+                        } for notification in equipements.values()]
+                    )
+                logger.info(f"Récapitulatif d'alerte mis en file pour {premiere.client_email}: {len(equipements)} équipement(s)")
+            
+            db.session.query(NotificationEnAttente).filter(
+                NotificationEnAttente.id.in_([notification.id for notification in notifications])
+            ).delete(synchronize_session=False)
+            
+            db.session.commit()
+            email_outbox.reveiller()
+            
+        except Exception as e:
+            logger.error(f"Erreur lors de l'envoi des récapitulatifs d'alertes: {e}")
+            db.session.rollback()
+
+def maintenir_partitions_historique():
+    """Prépare les partitions mensuelles de l'historique (création à l'avance ou archivage du mois écoulé)"""
+    from app import app
+    
+    with app.app_context():
+        try:
+            maintenir_partitions()
+        except Exception as e:
+            logger.error(f"Erreur lors de la maintenance des partitions d'historique: {e}")
+
+def _purger(tache, modele, filtres, limite):
+    """Purge par lots avec les réglages RETENTION_* de l'application"""
+    from app import app
+    
+    return purger_par_lots(
+        tache, modele, filtres, limite,
+        taille_lot=app.config['RETENTION_LOT'],
+        pause=app.config['RETENTION_PAUSE'],
+        budget=app.config['RETENTION_BUDGET']
+    )
+
+def nettoyer_historique():
+    """Supprime l'historique de plus de 30 jours : partitions entières puis lignes restantes par lots"""
+    from app import app
+    
+    with app.app_context():
+        try:
+            limite = datetime.utcnow() - timedelta(days=30)
+            
+            # Suppression de partitions entières : ni verrou prolongé ni DELETE massif
+            supprimees = supprimer_partitions_expirees(limite)
+            if supprimees:
+                logger.info(f"Historique nettoyé: {len(supprimees)} partitions supprimées ({', '.join(supprimees)})")
+            
+            # Lignes expirées de la table courante ou des partitions conservées (partition par défaut, mois entamé)
+            nb_supprimees = _purger(
+                'historique_pings', HistoriquePing,
+                lambda limite: [HistoriquePing.timestamp < limite],
+                limite
+            )
+            # Lignes expirées des archives mensuelles encore conservées (SQLite)
+            nb_supprimees += purger_archives_expirees(
+                limite, taille_lot=app.config['RETENTION_LOT'], pause=app.config['RETENTION_PAUSE']
+            )
+            if nb_supprimees:
+                logger.info(f"Historique nettoyé: {nb_supprimees} entrées supprimées")
             
         except Exception as e:
             logger.error(f"Erreur lors du nettoyage de l'historique: {e}")
             db.session.rollback()
 
 def nettoyer_alertes():
-    """Nettoie les alertes anciennes déjà lues"""
+    """Nettoie par lots les alertes anciennes déjà lues"""
     from app import app
     
     with app.app_context():
@@ -102,38 +298,153 @@ def nettoyer_alertes():
             # Supprimer les alertes lues plus anciennes que 7 jours
             limite = datetime.utcnow() - timedelta(days=7)
             
-            nb_a_supprimer = Alerte.query.filter(
-                Alerte.timestamp < limite,
-                Alerte.lue == True
-            ).count()
-            
-            if nb_a_supprimer > 0:
-                Alerte.query.filter(
-                    Alerte.timestamp < limite,
-                    Alerte.lue == True
-                ).delete()
-                
-                db.session.commit()
-                logger.info(f"Alertes nettoyées: {nb_a_supprimer} alertes supprimées")
+            nb_supprimees = _purger(
+                'alertes', Alerte,
+                lambda limite: [Alerte.timestamp < limite, Alerte.lue == True],
+                limite
+            )
+            if nb_supprimees:
+                logger.info(f"Alertes nettoyées: {nb_supprimees} alertes supprimées")
             
         except Exception as e:
             logger.error(f"Erreur lors du nettoyage des alertes: {e}")
             db.session.rollback()
 
+def calculer_agregats_horaires():
+    """Agrège les heures révolues de l'historique (disponibilité et temps de réponse)"""
+    from app import app
+    
+    with app.app_context():
+        try:
+            calculer_agregats(intervalle_attendu=app.config['PING_INTERVALLE_ATTENDU'])
+        except Exception as e:
+            logger.error(f"Erreur lors du calcul des agrégats: {e}")
+            db.session.rollback()
+
+def enregistrer_sketches_latence():
+    """Écrit les sketches de temps de réponse accumulés par ce processus depuis la dernière écriture"""
+    from app import app
+    
+    with app.app_context():
+        try:
+            sketches_latence.enregistrer()
+        except Exception as e:
+            logger.error(f"Erreur lors de l'écriture des sketches de latence: {e}")
+
+def envoyer_rapports_mensuels():
+    """Envoie à chaque client actif son rapport de disponibilité du mois écoulé"""
+    from app import app
+    
+    with app.app_context():
+        try:
+            debut, fin = mois_precedent()
+            clients = db.session.query(Client.id, Client.nom, Client.email).filter(
+                Client.actif == True,
+                Client.email != None
+            ).all()
+            
+            for client in clients:
+                rapport = rapport_disponibilite(client.id, debut, fin, app.config['PING_INTERVALLE_ATTENDU'])
+                if rapport and rapport['equipements']:
+                    email_service.queue_availability_report(client.email, client.nom, rapport)
+            
+            db.session.commit()
+            email_outbox.reveiller()
+            logger.info(f"Rapports de disponibilité du {debut.date()} au {fin.date()} mis en file pour {len(clients)} clients")
+            
+        except Exception as e:
+            logger.error(f"Erreur lors de l'envoi des rapports mensuels: {e}")
+            db.session.rollback()
+
+def recalculer_compteurs_clients():
+    """Recalcule les compteurs par client pour corriger une éventuelle dérive des mises à jour incrémentales"""
+    from app import app
+    
+    with app.app_context():
+        try:
+            recalculer_statuts_clients()
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Erreur lors du recalcul des compteurs clients: {e}")
+            db.session.rollback()
+
 def init_scheduler(app):
     """Initialise le planificateur de tâches"""
     try:
         scheduler = BackgroundScheduler()
         
-        # Vérifier les équipements hors ligne toutes les minutes
+        # Balayer les équipements hors ligne (toutes les minutes sans le détecteur d'échéances)
         scheduler.add_job(
             func=verifier_equipements_hors_ligne,
-            trigger=IntervalTrigger(minutes=1),
+            trigger=IntervalTrigger(seconds=app.config['HORS_LIGNE_BALAYAGE']),
             id='verifier_equipements',
             name='Vérifier équipements hors ligne',
             replace_existing=True
         )
         
+        # Envoyer les récapitulatifs d'alertes par client toutes les 30 secondes
+        scheduler.add_job(
+            func=envoyer_recapitulatifs_alertes,
+            trigger=IntervalTrigger(seconds=30),
+            id='envoyer_recapitulatifs_alertes',
+            name='Envoyer récapitulatifs d\'alertes',
+            replace_existing=True
+        )
+        
+        # Recalculer les compteurs par client au démarrage puis toutes les heures
+        scheduler.add_job(
+            func=recalculer_compteurs_clients,
+            trigger=IntervalTrigger(hours=1),
+            next_run_time=datetime.now(),
+            id='recalculer_compteurs_clients',
+            name='Recalculer compteurs clients',
+            replace_existing=True
+        )
+        
+        # Agréger les heures révolues au démarrage puis toutes les heures (5 minutes après l'heure pleine)
+        scheduler.add_job(
+            func=calculer_agregats_horaires,
+            trigger='cron',
+            minute=5,
+            next_run_time=datetime.now(),
+            id='calculer_agregats_horaires',
+            name='Calculer agrégats horaires',
+            replace_existing=True
+        )
+        
+        # Écrire les sketches de temps de réponse toutes les minutes
+        scheduler.add_job(
+            func=enregistrer_sketches_latence,
+            trigger=IntervalTrigger(minutes=1),
+            id='enregistrer_sketches_latence',
+            name='Enregistrer sketches de latence',
+            replace_existing=True
+        )
+        
+        # Envoyer les rapports de disponibilité le 1er du mois à 6h (agrégats du mois écoulé complets)
+        scheduler.add_job(
+            func=envoyer_rapports_mensuels,
+            trigger='cron',
+            day=1,
+            hour=6,
+            minute=0,
+            id='envoyer_rapports_mensuels',
+            name='Envoyer rapports de disponibilité',
+            replace_existing=True
+        )
+        
+        # Préparer les partitions d'historique au démarrage puis tous les jours à 0h05
+        scheduler.add_job(
+            func=maintenir_partitions_historique,
+            trigger='cron',
+            hour=0,
+            minute=5,
+            next_run_time=datetime.now(),
+            id='maintenir_partitions_historique',
+            name='Maintenir partitions historique',
+            replace_existing=True
+        )
+        
         # Nettoyer l'historique tous les jours à 2h du matin
         scheduler.add_job(
             func=nettoyer_historique,
@@ -162,7 +473,9 @@ def init_scheduler(app):
         logger.info("Planificateur de tâches initialisé avec succès")
         
         # Arrêter le planificateur proprement lors de l'arrêt de l'application
+        # (puis écrire les derniers sketches : atexit exécute les fonctions en ordre inverse)
         import atexit
+        atexit.register(enregistrer_sketches_latence)
         atexit.register(lambda: scheduler.shutdown())
         
     except Exception as e:
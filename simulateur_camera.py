@@ -32,7 +32,11 @@ class SimulateurCamera:
         print(f"   Équipement ID: {self.equipement_id}")
     
     def envoyer_ping(self):
-        """Envoie un ping vers le serveur de monitoring"""
+        """Envoie un ping vers le serveur de monitoring
+        
+        Returns:
+            Délai (secondes) avant le prochain ping demandé par le serveur, ou None
+        """
         try:
             # Temps de réponse simulé (comme une vraie caméra)
             response_time = round(random.uniform(20.0, 80.0), 1)
@@ -58,6 +62,15 @@ class SimulateurCamera:
             if response.status_code == 200:
                 result = response.json()
                 print(f"   ✅ Succès ({response_time}ms) - Statut: {result.get('equipement', {}).get('statut', 'Inconnu')}")
+                
+                # Intervalle recommandé par le serveur selon sa charge, avec une gigue aléatoire
+                if result.get('intervalle_recommande'):
+                    gigue = result.get('gigue', 0)
+                    return max(1, result['intervalle_recommande'] + random.uniform(-gigue, gigue))
+            elif response.status_code == 503:
+                retry_after = int(response.headers.get('Retry-After', 30))
+                print(f"   ⏳ Serveur surchargé, nouvel essai dans {retry_after}s")
+                return retry_after
             else:
                 print(f"   ❌ Erreur HTTP {response.status_code}: {response.text}")
                 
@@ -67,13 +80,15 @@ class SimulateurCamera:
             print(f"   ⏱️ Timeout - serveur trop lent")
         except Exception as e:
             print(f"   ❌ Erreur: {e}")
+        return None
     
     def demarrer_simulation(self, intervalle_secondes=60):
         """
         Démarre la simulation en boucle infinie
         
         Args:
-            intervalle_secondes: Délai entre chaque ping (défaut: 60s comme une vraie caméra)
+            intervalle_secondes: Délai entre chaque ping (défaut: 60s comme une vraie caméra),
+                remplacé par l'intervalle recommandé par le serveur quand il en donne un
         """
         print(f"\n🚀 Démarrage de la simulation (ping toutes les {intervalle_secondes}s)")
         print("   Appuyez sur Ctrl+C pour arrêter")
@@ -81,12 +96,12 @@ class SimulateurCamera:
         
         try:
             # Premier ping immédiat
-            self.envoyer_ping()
+            delai = self.envoyer_ping()
             
             # Boucle principale
             while self.actif:
-                time.sleep(intervalle_secondes)
-                self.envoyer_ping()
+                time.sleep(delai or intervalle_secondes)
+                delai = self.envoyer_ping()
                 
         except KeyboardInterrupt:
             print(f"\n⏹️ Simulation arrêtée par l'utilisateur")
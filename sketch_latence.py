@@ -0,0 +1,172 @@
+"""
+Sketches de quantiles (type DDSketch) des temps de réponse, fusionnables et de taille bornée
+"""
+import json
+import logging
+import math
+import threading
+from datetime import datetime
+from sqlalchemy import insert
+from app import db
+from models import SketchLatence
+
+logger = logging.getLogger(__name__)
+
+# Erreur relative garantie sur chaque quantile (1 %)
+PRECISION = 0.01
+GAMMA = (1 + PRECISION) / (1 - PRECISION)
+LOG_GAMMA = math.log(GAMMA)
+
+# Nombre maximal de classes d'un sketch : au-delà, les plus basses sont regroupées
+CLASSES_MAX = 512
+
+
+class DDSketch:
+    """Histogramme à classes logarithmiques : une valeur x est comptée dans la classe ceil(log_gamma(x))
+
+    Toute valeur renvoyée par quantile() est à moins de PRECISION (relatif)
+    de la vraie valeur. Deux sketches se fusionnent en additionnant leurs
+    classes, ce qui permet de reconstituer n'importe quelle fenêtre.
+    """
+
+    __slots__ = ('classes', 'zeros', 'nombre', 'minimum', 'maximum')
+
+    def __init__(self):
+        self.classes = {}
+        self.zeros = 0
+        self.nombre = 0
+        self.minimum = None
+        self.maximum = None
+
+    def ajouter(self, valeur, nombre=1):
+        if valeur <= 0:
+            self.zeros += nombre
+        else:
+            index = math.ceil(math.log(valeur) / LOG_GAMMA)
+            self.classes[index] = self.classes.get(index, 0) + nombre
+            if len(self.classes) > CLASSES_MAX:
+                self._regrouper()
+
+        self.nombre += nombre
+        self.minimum = valeur if self.minimum is None else min(self.minimum, valeur)
+        self.maximum = valeur if self.maximum is None else max(self.maximum, valeur)
+
+    def fusionner(self, autre):
+        for index, nombre in autre.classes.items():
+            self.classes[index] = self.classes.get(index, 0) + nombre
+        self.zeros += autre.zeros
+        self.nombre += autre.nombre
+        if autre.minimum is not None:
+            self.minimum = autre.minimum if self.minimum is None else min(self.minimum, autre.minimum)
+            self.maximum = autre.maximum if self.maximum is None else max(self.maximum, autre.maximum)
+        if len(self.classes) > CLASSES_MAX:
+            self._regrouper()
+        return self
+
+    def _regrouper(self):
+        # Les classes les plus basses sont fusionnées : les quantiles élevés restent exacts à PRECISION près
+        indices = sorted(self.classes)
+        surplus = indices[:len(indices) - CLASSES_MAX + 1]
+        cible = surplus[-1]
+        self.classes[cible] = sum(self.classes.pop(index) for index in surplus[:-1]) + self.classes[cible]
+
+    def quantile(self, q):
+        if not self.nombre:
+            return None
+
+        rang = q * (self.nombre - 1)
+        cumul = self.zeros
+        if rang < cumul:
+            return 0
+        for index in sorted(self.classes):
+            cumul += self.classes[index]
+            if rang < cumul:
+                valeur = 2 * GAMMA ** index / (GAMMA + 1)
+                return round(min(max(valeur, self.minimum), self.maximum), 1)
+        return self.maximum
+
+    def serialiser(self):
+        """Forme compacte : classes denses à partir de la plus basse"""
+        donnees = {'n': self.nombre, 'z': self.zeros, 'min': self.minimum, 'max': self.maximum}
+        if self.classes:
+            premier = min(self.classes)
+            donnees['o'] = premier
+            donnees['c'] = [self.classes.get(index, 0) for index in range(premier, max(self.classes) + 1)]
+        return json.dumps(donnees, separators=(',', ':'))
+
+    @classmethod
+    def charger(cls, texte):
+        sketch = cls()
+        if not texte:
+            return sketch
+        donnees = json.loads(texte)
+        sketch.nombre = donnees['n']
+        sketch.zeros = donnees['z']
+        sketch.minimum = donnees['min']
+        sketch.maximum = donnees['max']
+        premier = donnees.get('o', 0)
+        sketch.classes = {premier + decalage: nombre for decalage, nombre in enumerate(donnees.get('c', [])) if nombre}
+        return sketch
+
+
+def fusionner_sketches(textes):
+    """Fusionne des sketches sérialisés en un seul DDSketch"""
+    total = DDSketch()
+    for texte in textes:
+        if texte:
+            total.fusionner(DDSketch.charger(texte))
+    return total
+
+
+class SketchesEnCours:
+    """Sketches de l'heure en cours par équipement, alimentés à chaque ping
+
+    Ils sont écrits périodiquement dans sketches_latence (une ligne par
+    équipement, heure et écriture) puis consolidés par le calcul des agrégats
+    horaires. La mémoire est bornée : un sketch de CLASSES_MAX classes au plus
+    par équipement et par heure non encore écrite.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sketches = {}
+
+    def ajouter(self, equipement_id, timestamp, reponse_ms):
+        if reponse_ms is None:
+            return
+        cle = (equipement_id, timestamp.replace(minute=0, second=0, microsecond=0))
+        with self._lock:
+            sketch = self._sketches.get(cle)
+            if sketch is None:
+                sketch = self._sketches[cle] = DDSketch()
+            sketch.ajouter(reponse_ms)
+
+    def enregistrer(self):
+        """Écrit les sketches accumulés depuis le dernier appel et retourne le nombre de lignes"""
+        with self._lock:
+            sketches, self._sketches = self._sketches, {}
+        if not sketches:
+            return 0
+
+        try:
+            db.session.execute(insert(SketchLatence), [{
+                'equipement_id': equipement_id,
+                'heure': heure,
+                'sketch': sketch.serialiser(),
+                'date_creation': datetime.utcnow(),
+            } for (equipement_id, heure), sketch in sketches.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Remettre les sketches pour la prochaine écriture
+            with self._lock:
+                for cle, sketch in sketches.items():
+                    if cle in self._sketches:
+                        sketch.fusionner(self._sketches[cle])
+                    self._sketches[cle] = sketch
+            raise
+        return len(sketches)
+
+
+# Instance globale des sketches en cours
+sketches_latence = SketchesEnCours()
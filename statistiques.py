@@ -0,0 +1,158 @@
+"""
+Statistiques du tableau de bord calculées en une seule requête SQL et mises en cache
+"""
+import logging
+import threading
+import time
+from sqlalchemy import case, func, literal, select
+from sqlalchemy.orm import aliased
+from app import db
+from models import Alerte, Client, Equipement
+from cache_partage import CacheMemoire, creer_backend
+
+logger = logging.getLogger(__name__)
+
+# Attente maximale (secondes) du calcul d'une clé par un autre worker avant de la calculer soi-même
+ATTENTE_CALCUL = 2
+
+
+def calculer_statistiques(admin, client_id=None):
+    """Calcule les cinq compteurs du tableau de bord avec une seule requête à agrégation conditionnelle
+
+    Pour un administrateur les compteurs sont globaux, sinon ils sont limités
+    aux équipements et alertes du client. Les équipements en ligne sont
+    comptés d'après leur état persisté, comme les compteurs par client.
+    """
+    filtres_equipements = [Equipement.actif == True]
+    equipement_alerte = aliased(Equipement)
+    alertes_non_lues = select(func.count(Alerte.id)).where(Alerte.lue == False)
+
+    if admin:
+        total_clients = select(func.count(Client.id)).where(Client.actif == True).scalar_subquery()
+    else:
+        total_clients = literal(1 if client_id else 0)
+        filtres_equipements.append(Equipement.client_id == client_id)
+        alertes_non_lues = alertes_non_lues.join(
+            equipement_alerte, Alerte.equipement_id == equipement_alerte.id
+        ).where(equipement_alerte.client_id == client_id)
+
+    requete = select(
+        total_clients.label('total_clients'),
+        func.count(Equipement.id).label('total_equipements'),
+        func.coalesce(func.sum(case((Equipement.etat == 'en_ligne', 1), else_=0)), 0).label('equipements_en_ligne'),
+        alertes_non_lues.scalar_subquery().label('alertes_non_lues')
+    ).select_from(Equipement).where(*filtres_equipements)
+
+    ligne = db.session.execute(requete).one()
+
+    return {
+        'total_clients': ligne.total_clients,
+        'total_equipements': ligne.total_equipements,
+        'equipements_en_ligne': ligne.equipements_en_ligne,
+        'equipements_hors_ligne': ligne.total_equipements - ligne.equipements_en_ligne,
+        'alertes_non_lues': ligne.alertes_non_lues
+    }
+
+
+def compter_alertes_non_lues(client_id=None):
+    """Nombre d'alertes non lues par type, lu sur l'index partiel des alertes non lues"""
+    requete = db.session.query(Alerte.type_alerte, func.count(Alerte.id)).filter(Alerte.lue == False)
+    if client_id is not None:
+        requete = requete.join(Equipement, Alerte.equipement_id == Equipement.id).filter(
+            Equipement.client_id == client_id
+        )
+    return dict(requete.group_by(Alerte.type_alerte).all())
+
+
+class CacheStatistiques:
+    """Cache à courte durée de vie des statistiques, par rôle et par client
+
+    Les lecteurs simultanés d'une même clé attendent le calcul en cours au
+    lieu de le relancer (verrou par clé, réservation partagée entre workers).
+    Une invalidation (changement d'état d'un équipement) change la
+    génération du cache, ce qui rend toutes les entrées obsolètes.
+    """
+
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self.backend = CacheMemoire()
+        self._lock = threading.Lock()
+        self._calculs = {}
+
+    def configurer(self, app):
+        self.ttl = app.config.get('STATS_CACHE_TTL', self.ttl)
+        self.backend = creer_backend(app.config.get('STATS_CACHE_URL'))
+        logger.info(f"Cache des statistiques: {self.backend.__class__.__name__} (TTL {self.ttl}s)")
+
+    def _cle(self, admin, client_id):
+        generation = self.backend.generation()
+        portee = 'admin' if admin else f'client:{client_id}'
+        return f'stats:{generation}:{portee}'
+
+    def obtenir(self, admin, client_id=None):
+        """Retourne les statistiques en cache ou les calcule une seule fois pour tous les lecteurs"""
+        try:
+            cle = self._cle(admin, client_id)
+            stats = self.backend.lire(cle)
+        except Exception as e:
+            logger.error(f"Cache des statistiques indisponible: {e}")
+            return calculer_statistiques(admin, client_id)
+        if stats is not None:
+            return stats
+
+        # Le verrou d'une clé reste enregistré tant qu'un lecteur l'attend : les lecteurs
+        # arrivés pendant le calcul attendent le même verrou au lieu d'en créer un autre
+        with self._lock:
+            calcul = self._calculs.setdefault(cle, [threading.Lock(), 0])
+            calcul[1] += 1
+        try:
+            with calcul[0]:
+                return self._calculer(cle, admin, client_id)
+        finally:
+            with self._lock:
+                calcul[1] -= 1
+                if calcul[1] == 0:
+                    del self._calculs[cle]
+
+    def _calculer(self, cle, admin, client_id):
+        """Calcule les statistiques d'une clé, sous le verrou du processus et la réservation partagée"""
+        try:
+            stats = self.backend.lire(cle)
+            if stats is not None:
+                return stats
+
+            # Autre worker en train de calculer la même clé : attendre son résultat
+            echeance = time.monotonic() + ATTENTE_CALCUL
+            reserve = self.backend.reserver(cle, ATTENTE_CALCUL)
+            while not reserve:
+                if time.monotonic() >= echeance:
+                    break
+                time.sleep(0.05)
+                stats = self.backend.lire(cle)
+                if stats is not None:
+                    return stats
+                reserve = self.backend.reserver(cle, ATTENTE_CALCUL)
+        except Exception as e:
+            logger.error(f"Cache des statistiques indisponible: {e}")
+            return calculer_statistiques(admin, client_id)
+
+        try:
+            stats = calculer_statistiques(admin, client_id)
+            self.backend.ecrire(cle, stats, self.ttl)
+            return stats
+        finally:
+            try:
+                if reserve:
+                    self.backend.liberer(cle)
+            except Exception as e:
+                logger.error(f"Erreur lors de la libération du calcul des statistiques: {e}")
+
+    def invalider(self):
+        try:
+            self.backend.incrementer_generation()
+        except Exception as e:
+            logger.error(f"Erreur lors de l'invalidation du cache des statistiques: {e}")
+
+
+# Instance globale du cache des statistiques
+cache_statistiques = CacheStatistiques()
@@ -0,0 +1,76 @@
+"""
+Maintenance des compteurs d'équipements en ligne / hors ligne par client
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import and_, bindparam, case, func, insert, select, update
+from app import db
+from models import Client, Equipement, StatutClient
+
+logger = logging.getLogger(__name__)
+
+
+def recalculer_statuts_clients(client_ids=None):
+    """Recalcule les compteurs des clients (tous par défaut) avec une seule requête groupée
+
+    Les lignes sont écrites dans la session, le commit revient à l'appelant.
+    """
+    maintenant = datetime.utcnow()
+
+    requete = db.session.query(
+        Client.id,
+        func.count(Equipement.id),
+        func.coalesce(func.sum(case((Equipement.etat == 'en_ligne', 1), else_=0)), 0)
+    ).outerjoin(
+        Equipement, and_(Equipement.client_id == Client.id, Equipement.actif == True)
+    ).group_by(Client.id)
+
+    if client_ids is not None:
+        client_ids = [client_id for client_id in client_ids if client_id]
+        if not client_ids:
+            return
+        requete = requete.filter(Client.id.in_(client_ids))
+
+    lignes = [{
+        'client_id': client_id,
+        'nb_total': nb_total,
+        'nb_en_ligne': nb_en_ligne,
+        'date_maj': maintenant
+    } for client_id, nb_total, nb_en_ligne in requete.all()]
+
+    if not lignes:
+        return
+
+    existants = set(db.session.scalars(
+        select(StatutClient.client_id).where(StatutClient.client_id.in_([ligne['client_id'] for ligne in lignes]))
+    ))
+
+    a_mettre_a_jour = [ligne for ligne in lignes if ligne['client_id'] in existants]
+    a_creer = [ligne for ligne in lignes if ligne['client_id'] not in existants]
+
+    if a_mettre_a_jour:
+        db.session.execute(update(StatutClient), a_mettre_a_jour)
+    if a_creer:
+        db.session.execute(insert(StatutClient), a_creer)
+
+    logger.debug(f"Compteurs recalculés pour {len(lignes)} clients")
+
+
+def ajuster_statuts_clients(variations):
+    """Applique aux compteurs des clients les transitions d'état ({client_id: variation de nb_en_ligne})"""
+    variations = {client_id: variation for client_id, variation in variations.items() if variation}
+    if not variations:
+        return
+
+    table = StatutClient.__table__
+    db.session.execute(
+        update(table)
+        .where(table.c.client_id == bindparam('b_client_id'))
+        .values(nb_en_ligne=table.c.nb_en_ligne + bindparam('b_variation'), date_maj=bindparam('b_date_maj')),
+        [{
+            'b_client_id': client_id,
+            'b_variation': variation,
+            'b_date_maj': datetime.utcnow()
+        } for client_id, variation in variations.items()]
+    )
+
@@ -0,0 +1,197 @@
+"""
+Tampon d'écriture différée pour l'historique des pings
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import insert, text
+from app import db
+from models import HistoriquePing
+
+logger = logging.getLogger(__name__)
+
+
+class TamponHistorique:
+    """File bornée de lignes HistoriquePing écrites en lot par un thread d'arrière-plan
+
+    Le ping est acquitté dès que sa ligne est dans la file. Le thread écrit un
+    lot dès que `taille_lot` lignes sont en attente ou que `intervalle`
+    secondes se sont écoulées. Quand la file est pleine, `ajouter` retourne
+    False et l'appelant écrit la ligne lui-même (contre-pression).
+    """
+
+    def __init__(self, capacite=10000, taille_lot=500, intervalle=1.0, tentatives=3):
+        self.capacite = capacite
+        self.taille_lot = taille_lot
+        self.intervalle = intervalle
+        self.tentatives = tentatives
+        self._file = queue.Queue(maxsize=capacite)
+        self._arret = threading.Event()
+        self._thread = None
+        self._app = None
+        self._lock = threading.Lock()
+        self._compteurs = {
+            'recues': 0,
+            'ecrites': 0,
+            'rejetees': 0,
+            'perdues': 0,
+            'lots': 0,
+        }
+        self._derniere_ecriture = None
+        self._duree_derniere_ecriture_ms = None
+
+    @property
+    def actif(self):
+        return self._thread is not None and self._thread.is_alive() and not self._arret.is_set()
+
+    def demarrer(self, app):
+        """Démarre le thread d'écriture et enregistre la vidange à l'arrêt du processus"""
+        if self._thread is not None:
+            return
+
+        self._app = app
+        self.capacite = app.config.get('HISTORIQUE_TAMPON_CAPACITE', self.capacite)
+        self.taille_lot = app.config.get('HISTORIQUE_TAMPON_LOT', self.taille_lot)
+        self.intervalle = app.config.get('HISTORIQUE_TAMPON_INTERVALLE', self.intervalle)
+        self._file = queue.Queue(maxsize=self.capacite)
+        self._thread = threading.Thread(target=self._boucle, name='tampon-historique', daemon=True)
+        self._thread.start()
+        atexit.register(self.arreter)
+
+        logger.info(f"Tampon d'historique démarré (capacité {self.capacite}, lot {self.taille_lot}, intervalle {self.intervalle}s)")
+
+    def arreter(self, timeout=30):
+        """Arrête le thread après avoir écrit toutes les lignes en attente"""
+        if self._thread is None:
+            return
+
+        self._arret.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Vidange du tampon d'historique incomplète: {self._file.qsize()} lignes non écrites")
+        else:
+            logger.info("Tampon d'historique vidé et arrêté")
+        self._thread = None
+
+    def _compter(self, cle, nombre=1):
+        with self._lock:
+            self._compteurs[cle] += nombre
+
+    def ajouter(self, ligne):
+        """Place une ligne dans la file, retourne False si le tampon est inactif ou plein"""
+        if not self.actif:
+            return False
+
+        try:
+            self._file.put_nowait(ligne)
+        except queue.Full:
+            self._compter('rejetees')
+            logger.debug("Tampon d'historique plein, écriture synchrone")
+            return False
+
+        self._compter('recues')
+        return True
+
+    def ajouter_lot(self, lignes):
+        """Place des lignes dans la file et retourne celles qui n'ont pas pu l'être"""
+        refusees = []
+        for ligne in lignes:
+            if not self.ajouter(ligne):
+                refusees.append(ligne)
+        return refusees
+
+    def _boucle(self):
+        while True:
+            lot = []
+            echeance = time.monotonic() + self.intervalle
+
+            while len(lot) < self.taille_lot:
+                restant = echeance - time.monotonic()
+                if restant <= 0:
+                    break
+                try:
+                    lot.append(self._file.get(timeout=restant))
+                except queue.Empty:
+                    break
+
+            if lot:
+                self._ecrire(lot)
+
+            if self._arret.is_set() and self._file.empty():
+                break
+
+    def _ecrire(self, lot):
+        debut = time.monotonic()
+        ecrites = self._inserer(lot)
+        if not ecrites:
+            return
+
+        with self._lock:
+            self._compteurs['ecrites'] += ecrites
+            self._compteurs['lots'] += 1
+            self._derniere_ecriture = datetime.utcnow()
+            self._duree_derniere_ecriture_ms = round((time.monotonic() - debut) * 1000, 1)
+
+        logger.debug(f"Lot de {ecrites} lignes d'historique écrit")
+
+    def _inserer(self, lot):
+        """Insère un lot et retourne le nombre de lignes écrites
+
+        Base injoignable : le lot est réessayé `tentatives` fois puis perdu.
+        Base joignable : une ligne refusée ne doit pas faire perdre les autres,
+        elle est isolée en réessayant chaque moitié du lot.
+        """
+        for tentative in range(1, self.tentatives + 1):
+            with self._app.app_context():
+                try:
+                    db.session.execute(insert(HistoriquePing), lot)
+                    db.session.commit()
+                    return len(lot)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Erreur lors de l'écriture d'un lot de {len(lot)} lignes d'historique (tentative {tentative}/{self.tentatives}): {e}")
+                    joignable = self._base_joignable()
+            if joignable:
+                break
+            time.sleep(tentative * 0.5)
+        else:
+            self._compter('perdues', len(lot))
+            return 0
+
+        if len(lot) == 1:
+            logger.error(f"Ligne d'historique refusée par la base, abandonnée: {lot[0]}")
+            self._compter('perdues')
+            return 0
+
+        milieu = len(lot) // 2
+        return self._inserer(lot[:milieu]) + self._inserer(lot[milieu:])
+
+    def _base_joignable(self):
+        try:
+            db.session.execute(text('SELECT 1'))
+            return True
+        except Exception:
+            db.session.rollback()
+            return False
+
+    def metriques(self):
+        """Retourne l'état du tampon et ses compteurs de contre-pression"""
+        profondeur = self._file.qsize()
+        with self._lock:
+            return {
+                'actif': self.actif,
+                'profondeur': profondeur,
+                'capacite': self.capacite,
+                'taux_remplissage': round(profondeur / self.capacite, 3) if self.capacite else 0,
+                'en_attente': self._compteurs['recues'] - self._compteurs['ecrites'] - self._compteurs['perdues'],
+                **self._compteurs,
+                'derniere_ecriture': self._derniere_ecriture.isoformat() if self._derniere_ecriture else None,
+                'duree_derniere_ecriture_ms': self._duree_derniere_ecriture_ms,
+            }
+
+
+# Instance globale du tampon d'historique
+tampon_historique = TamponHistorique()
@@ -0,0 +1,70 @@
+"""
+Configuration commune des tests : base SQLite jetable, sans tâche d'arrière-plan
+"""
+import os
+import sys
+import tempfile
+
+# Avant l'import de app : APP_INIT=0 ne démarre ni planificateur, ni tampon, ni détecteur
+DOSSIER_TESTS = tempfile.mkdtemp(prefix='camera-monitor-tests-')
+CHEMIN_BASE = os.path.join(DOSSIER_TESTS, 'tests.db')
+os.environ['APP_INIT'] = '0'
+os.environ['DATABASE_URL'] = f'sqlite:///{CHEMIN_BASE}'
+os.environ['EMAIL_BACKEND'] = 'stub'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from app import app as application, db, init_connexions
+from models import Client, Equipement, User
+from migrations import appliquer_migrations
+from cache_equipements import cache_equipements
+from statistiques import cache_statistiques
+
+init_connexions()
+
+
+@pytest.fixture
+def app():
+    """Application sur une base neuve (tables du modèle et migrations), dans un contexte d'application"""
+    with application.app_context():
+        db.session.remove()
+        db.engine.dispose()
+        if os.path.exists(CHEMIN_BASE):
+            os.remove(CHEMIN_BASE)
+        db.create_all()
+        appliquer_migrations()
+        cache_equipements.invalider()
+        cache_statistiques.invalider()
+        yield application
+        db.session.remove()
+
+
+@pytest.fixture
+def client_http(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def equipements(app):
+    """Un client et trois équipements actifs, retourne leurs identifiants"""
+    client = Client(nom='Client test', email='client@example.com')
+    db.session.add(client)
+    db.session.flush()
+    liste = [
+        Equipement(nom=f'DVR {i}', type_equipement='DVR', adresse_ip=f'10.0.0.{i}', client_id=client.id)
+        for i in range(1, 4)
+    ]
+    db.session.add_all(liste)
+    db.session.commit()
+    return [equipement.id for equipement in liste]
+
+
+@pytest.fixture
+def client_admin(client_http):
+    """Client HTTP connecté en administrateur"""
+    utilisateur = User(nom_utilisateur='admin', email='admin@example.com', role='admin', statut='approuve')
+    utilisateur.set_password('secret')
+    db.session.add(utilisateur)
+    db.session.commit()
+    client_http.post('/login', data={'nom_utilisateur': 'admin', 'mot_de_passe': 'secret'})
+    return client_http
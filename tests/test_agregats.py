@@ -0,0 +1,44 @@
+"""
+Agrégats horaires : progression du calcul d'une heure à la suivante
+"""
+from datetime import datetime, timedelta
+from app import db
+from models import AgregatHoraire, Equipement, HistoriquePing, PositionAgregats
+from agregats import calculer_agregats
+
+MAINTENANT = datetime(2026, 3, 10, 12, 30)
+
+
+def _ping(equipement_id, timestamp):
+    db.session.add(HistoriquePing(equipement_id=equipement_id, timestamp=timestamp, statut='success', reponse_ms=10))
+
+
+def test_heures_calculees_une_seule_fois(app, equipements):
+    db.session.query(Equipement).update({'date_creation': datetime(2026, 1, 1)})
+    _ping(equipements[0], MAINTENANT - timedelta(hours=3))
+    db.session.commit()
+
+    assert calculer_agregats(MAINTENANT) == 3
+    assert calculer_agregats(MAINTENANT) == 0
+    assert db.session.get(PositionAgregats, 'horaire').heure == datetime(2026, 3, 10, 11)
+    assert AgregatHoraire.query.filter_by(equipement_id=equipements[0]).count() == 3
+
+
+def test_position_avance_sans_equipement_actif(app, equipements):
+    _ping(equipements[0], MAINTENANT - timedelta(hours=5))
+    db.session.query(Equipement).update({'actif': False})
+    db.session.commit()
+
+    assert calculer_agregats(MAINTENANT, heures_max=2) == 2
+    assert calculer_agregats(MAINTENANT, heures_max=2) == 2
+    assert calculer_agregats(MAINTENANT, heures_max=2) == 1
+    assert calculer_agregats(MAINTENANT, heures_max=2) == 0
+    assert AgregatHoraire.query.count() == 0
+
+
+def test_reprise_apres_le_dernier_agregat_sans_position(app, equipements):
+    db.session.add(AgregatHoraire(equipement_id=equipements[0], heure=datetime(2026, 3, 10, 9),
+                                  nb_pings=0, nb_attendus=60, secondes_en_ligne=0))
+    db.session.commit()
+
+    assert calculer_agregats(MAINTENANT) == 2
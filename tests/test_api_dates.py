@@ -0,0 +1,41 @@
+"""
+Dates des API en UTC naïf, comme les horodatages en base, quel que soit le fuseau donné
+"""
+from app import db
+from models import Equipement
+
+
+def test_agregats_dates_avec_fuseau(client_admin, equipements):
+    reponse = client_admin.get(f'/api/equipements/{equipements[0]}/agregats', query_string={
+        'debut': '2026-03-01T00:00:00Z', 'fin': '2026-03-08T02:00:00+02:00'
+    })
+
+    assert reponse.status_code == 200
+    assert (reponse.get_json()['debut'], reponse.get_json()['fin']) == ('2026-03-01T00:00:00', '2026-03-08T00:00:00')
+    assert client_admin.get(f'/api/equipements/{equipements[0]}/agregats?debut=hier').status_code == 400
+
+
+def test_rapport_dates_avec_fuseau(client_admin, equipements):
+    client_id = db.session.get(Equipement, equipements[0]).client_id
+    reponse = client_admin.get('/api/rapports/disponibilite', query_string={
+        'client_id': client_id, 'debut': '2026-03-01T00:00:00Z', 'fin': '2026-04-01T00:00:00+00:00'
+    })
+
+    assert reponse.status_code == 200
+    parametres = {'client_id': client_id, 'debut': '2026-03-01', 'fin': '2026-02-01T12:00:00-05:00'}
+    assert client_admin.get('/api/rapports/disponibilite', query_string=parametres).status_code == 400
+    parametres['fin'] = 'mars'
+    assert client_admin.get('/api/rapports/disponibilite', query_string=parametres).status_code == 400
+
+
+def test_export_dates_avec_fuseau(client_admin, equipements):
+    client_admin.post('/api/ping', json={'equipement_id': equipements[0]})
+
+    reponse = client_admin.get('/api/export/historique', query_string={
+        'format': 'ndjson', 'debut': '2000-01-01T00:00:00+02:00', 'fin': '2999-01-01T00:00:00Z'
+    })
+
+    assert reponse.status_code == 200
+    assert 'historique_19991231_29990101.ndjson' in reponse.headers['Content-Disposition']
+    assert len(reponse.get_data(as_text=True).splitlines()) == 1
+    assert client_admin.get('/api/export/alertes?fin=demain').status_code == 400
@@ -0,0 +1,75 @@
+"""
+Détecteur hors ligne : tas d'échéances, report paresseux et vérification à l'échéance
+"""
+import threading
+from datetime import datetime, timedelta
+from app import db
+from models import Equipement
+from detecteur_hors_ligne import DetecteurHorsLigne
+
+T0 = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def _detecteur_sans_thread():
+    detecteur = DetecteurHorsLigne(delai=timedelta(minutes=2))
+    # signaler() ignore les pings tant que le détecteur n'est pas démarré
+    detecteur._thread = threading.current_thread()
+    return detecteur
+
+
+def test_echeances_extraites_dans_l_ordre():
+    detecteur = _detecteur_sans_thread()
+    detecteur.signaler(1, T0)
+    detecteur.signaler(2, T0 + timedelta(seconds=10))
+    detecteur.signaler(3, T0 - timedelta(seconds=30))
+
+    assert detecteur._extraire_echus(T0 + timedelta(seconds=60)) == []
+    assert detecteur._extraire_echus(T0 + timedelta(minutes=2)) == [3, 1]
+    assert detecteur._extraire_echus(T0 + timedelta(minutes=3)) == [2]
+    assert detecteur._tas == [] and detecteur._echeances == {}
+
+
+def test_ping_repousse_l_echeance_sans_deplacer_l_entree():
+    detecteur = _detecteur_sans_thread()
+    detecteur.signaler(1, T0)
+    detecteur.signaler(1, T0 + timedelta(seconds=60))
+    # Un ping plus ancien (arrivé en retard) ne raccourcit pas l'échéance
+    detecteur.signaler(1, T0 + timedelta(seconds=30))
+
+    assert len(detecteur._tas) == 1
+    assert detecteur._extraire_echus(T0 + timedelta(minutes=2)) == []
+    assert detecteur._tas == [(T0 + timedelta(minutes=3), 1)]
+    assert detecteur._extraire_echus(T0 + timedelta(minutes=3)) == [1]
+
+
+def test_non_demarre_ignore_les_pings():
+    detecteur = DetecteurHorsLigne()
+    detecteur.signaler(1, T0)
+
+    assert detecteur._tas == []
+
+
+def test_verification_a_l_echeance(app, equipements):
+    db.session.query(Equipement).filter_by(id=equipements[0]).update({
+        'dernier_ping': datetime.utcnow(), 'etat': 'en_ligne'
+    })
+    db.session.commit()
+
+    verifies = []
+    appele = threading.Event()
+
+    def verifier(equipement_ids):
+        verifies.append(list(equipement_ids))
+        appele.set()
+
+    detecteur = DetecteurHorsLigne(delai=timedelta(milliseconds=300))
+    detecteur.demarrer(app, verifier)
+    try:
+        # Échéance chargée au démarrage pour l'équipement en ligne, les autres n'ont jamais pingé
+        assert list(detecteur._echeances) == [equipements[0]]
+        assert appele.wait(5)
+        assert verifies == [[equipements[0]]]
+        assert detecteur._echeances == {}
+    finally:
+        detecteur.arreter()
+        detecteur._thread.join(5)
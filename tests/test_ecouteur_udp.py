@@ -0,0 +1,140 @@
+"""
+Écouteur UDP : décodage des datagrammes, numéros de séquence et écriture par lots
+"""
+import asyncio
+import math
+import socket
+import struct
+import pytest
+import ingestion
+from models import Equipement, HistoriquePing
+from app import db
+from ecouteur_udp import EcouteurUDP, FORMAT_BINAIRE, decoder_battement, encoder_battement
+
+
+@pytest.mark.parametrize('donnees, attendu', [
+    (b'12 5', (12, 5, None)),
+    (b'12,5,3.5', (12, 5, 3.5)),
+    (b'  4294967295 4294967295 \n', (4294967295, 4294967295, None)),
+])
+def test_decodage_texte(donnees, attendu):
+    assert decoder_battement(donnees) == attendu
+
+
+@pytest.mark.parametrize('donnees', [
+    b'',
+    b'12',
+    b'12 5 3.5 9',
+    b'abc 5',
+    b'0 5',
+    b'-3 5',
+    b'12 -1',
+    b'4294967296 1',
+    b'9' * 5000 + b' 1',
+    b'12 5 inf',
+    b'12 5 nan',
+    '12 5 é'.encode('utf-8'),
+    b'\xff\xfe',
+])
+def test_datagramme_invalide(donnees):
+    assert decoder_battement(donnees) is None
+
+
+def test_decodage_binaire():
+    assert decoder_battement(encoder_battement(42, 7, 12.34)) == (42, 7, 12.3)
+    assert decoder_battement(encoder_battement(42, 2 ** 32 + 3)) == (42, 3, None)
+    # Version inconnue, taille incorrecte, identifiant nul
+    assert decoder_battement(FORMAT_BINAIRE.pack(2, 42, 1, 1.0)) is None
+    assert decoder_battement(encoder_battement(42, 7)[:-1]) is None
+    assert decoder_battement(struct.pack('!BIIf', 1, 0, 1, math.nan)) is None
+
+
+def test_sequences_suivies_pour_les_equipements_acceptes(app):
+    ecouteur = EcouteurUDP(app, taille_lot=1000)
+    try:
+        # Équipement pas encore accepté : ses doublons passent, la base tranchera
+        ecouteur.datagram_received(b'7 1', None)
+        ecouteur.datagram_received(b'7 1', None)
+        assert len(ecouteur._en_attente) == 2 and ecouteur._sequences == {}
+
+        ecouteur._compter_lot(ecouteur._en_attente, [True, False])
+        assert ecouteur._sequences == {}
+
+        ecouteur._compter_lot([{'equipement_id': 5, 'sequence': 10}], [True])
+        ecouteur._en_attente.clear()
+        for sequence in (10, 11, 3, 200, 11):
+            ecouteur.datagram_received(f'5 {sequence}'.encode(), None)
+
+        # 10 et 3 (en retard de moins de la fenêtre) sont des doublons, 200 signale un redémarrage
+        assert [battement['sequence'] for battement in ecouteur._en_attente] == [11, 200, 11]
+        assert ecouteur._compteurs['doublons'] == 2
+    finally:
+        ecouteur._executeur.shutdown()
+
+
+def test_file_d_attente_bornee(app):
+    ecouteur = EcouteurUDP(app, taille_lot=1000, en_attente_max=2)
+    try:
+        for equipement_id in (1, 2, 3):
+            ecouteur.datagram_received(f'{equipement_id} 1'.encode(), None)
+        ecouteur.datagram_received(b'n importe quoi', None)
+
+        assert len(ecouteur._en_attente) == 2
+        assert (ecouteur._compteurs['abandonnes'], ecouteur._compteurs['invalides']) == (1, 1)
+    finally:
+        ecouteur._executeur.shutdown()
+
+
+def test_ligne_fautive_ne_fait_pas_perdre_le_lot(app, equipements, monkeypatch):
+    traiter_lot_pings = ingestion.traiter_lot_pings
+
+    def traiter_sauf_fautif(lot):
+        if any(battement['equipement_id'] == equipements[1] for battement in lot):
+            raise ValueError('ligne fautive')
+        return traiter_lot_pings(lot)
+
+    monkeypatch.setattr(ingestion, 'traiter_lot_pings', traiter_sauf_fautif)
+    ecouteur = EcouteurUDP(app)
+    try:
+        lot = [{'equipement_id': equipement_id, 'sequence': 1, 'response_time': None, 'message': 'Battement UDP'}
+               for equipement_id in (equipements[0], equipements[1], equipements[2], 999)]
+
+        assert ecouteur._enregistrer(lot) == [True, False, True, False]
+        assert sorted(ligne.equipement_id for ligne in HistoriquePing.query.all()) == [equipements[0], equipements[2]]
+    finally:
+        ecouteur._executeur.shutdown()
+
+
+def test_reception_et_enregistrement(app, equipements):
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        transport, ecouteur = await loop.create_datagram_endpoint(
+            lambda: EcouteurUDP(app, intervalle=0.01), local_addr=('127.0.0.1', 0)
+        )
+        port = transport.get_extra_info('sockname')[1]
+        arret = asyncio.Event()
+        tache = asyncio.create_task(ecouteur.executer(arret))
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as envoi:
+            envoi.sendto(encoder_battement(equipements[0], 1, 8.5), ('127.0.0.1', port))
+            envoi.sendto(f'{equipements[1]} 1 12'.encode(), ('127.0.0.1', port))
+            envoi.sendto(b'999 1', ('127.0.0.1', port))
+            envoi.sendto(b'pas un battement', ('127.0.0.1', port))
+
+        for _ in range(200):
+            await asyncio.sleep(0.01)
+            if ecouteur._compteurs['enregistres'] + ecouteur._compteurs['refuses'] == 3:
+                break
+        arret.set()
+        await tache
+        transport.close()
+        return ecouteur
+
+    ecouteur = asyncio.run(scenario())
+
+    assert {cle: ecouteur._compteurs[cle] for cle in ('recus', 'invalides', 'enregistres', 'refuses')} == {
+        'recus': 4, 'invalides': 1, 'enregistres': 2, 'refuses': 1
+    }
+    assert set(ecouteur._sequences) == {equipements[0], equipements[1]}
+    db.session.expire_all()
+    assert db.session.get(Equipement, equipements[0]).etat == 'en_ligne'
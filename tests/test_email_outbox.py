@@ -0,0 +1,138 @@
+"""
+File d'envoi des emails : envoi, nouvelles tentatives espacées et abandon, avec l'expéditeur local
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import pytest
+from app import db
+from models import EmailSortant
+from email_service import email_service
+from email_outbox import ExpediteurStub, OutboxEmail
+
+
+@pytest.fixture
+def outbox(app):
+    """File d'envoi sans thread de distribution : chaque passage est déclenché par le test"""
+    file_envoi = OutboxEmail(concurrence=2, tentatives_max=3, delai_base=30, delai_max=50)
+    file_envoi._app = app
+    file_envoi._pool = ThreadPoolExecutor(max_workers=file_envoi.concurrence)
+    yield file_envoi
+    file_envoi._pool.shutdown(wait=True)
+
+
+def _mettre_en_file(*destinataires):
+    emails = [email_service.queue_email(destinataire, 'Alerte', '<p>DVR hors ligne</p>') for destinataire in destinataires]
+    db.session.commit()
+    return [email.id for email in emails]
+
+
+def _email(email_id):
+    db.session.expire_all()
+    return db.session.get(EmailSortant, email_id)
+
+
+def _rendre_du(email_id):
+    """Avance l'horloge de la file : la prochaine tentative devient échue"""
+    db.session.query(EmailSortant).filter_by(id=email_id).update(
+        {'prochaine_tentative': datetime.utcnow() - timedelta(seconds=1)}
+    )
+    db.session.commit()
+
+
+def _delai_programme(email, avant):
+    return (email.prochaine_tentative - avant).total_seconds()
+
+
+def test_envoi_reussi(outbox):
+    outbox.expediteur = ExpediteurStub()
+    ids = _mettre_en_file('a@example.com', 'b@example.com')
+
+    assert outbox.traiter_lot() == 2
+    assert outbox.traiter_lot() == 0
+
+    assert sorted(envoi['destinataire'] for envoi in outbox.expediteur.envoyes) == ['a@example.com', 'b@example.com']
+    for email_id in ids:
+        email = _email(email_id)
+        assert (email.statut, email.tentatives, email.derniere_erreur) == ('envoye', 1, None)
+        assert email.date_envoi is not None
+
+
+def test_nouvelles_tentatives_avec_delai_exponentiel(outbox):
+    outbox.expediteur = ExpediteurStub(echecs=2)
+    email_id, = _mettre_en_file('a@example.com')
+
+    avant = datetime.utcnow()
+    assert outbox.traiter_lot() == 1
+    email = _email(email_id)
+    assert (email.statut, email.tentatives) == ('en_attente', 1)
+    assert email.derniere_erreur == "Échec simulé par l'expéditeur local"
+    assert 30 <= _delai_programme(email, avant) < 35
+
+    # Pas encore échu : aucun nouvel envoi
+    assert outbox.traiter_lot() == 0
+
+    _rendre_du(email_id)
+    avant = datetime.utcnow()
+    assert outbox.traiter_lot() == 1
+    email = _email(email_id)
+    assert (email.statut, email.tentatives) == ('en_attente', 2)
+    # 30 * 2 = 60 s, plafonné par delai_max
+    assert 50 <= _delai_programme(email, avant) < 55
+
+    _rendre_du(email_id)
+    assert outbox.traiter_lot() == 1
+    email = _email(email_id)
+    assert (email.statut, email.tentatives, email.derniere_erreur) == ('envoye', 3, None)
+    assert len(outbox.expediteur.envoyes) == 1
+
+
+def test_abandon_apres_la_derniere_tentative(outbox):
+    outbox.expediteur = ExpediteurStub(echecs=10)
+    email_id, = _mettre_en_file('a@example.com')
+
+    for tentative in range(1, outbox.tentatives_max + 1):
+        assert outbox.traiter_lot() == 1
+        assert _email(email_id).tentatives == tentative
+        _rendre_du(email_id)
+
+    email = _email(email_id)
+    assert email.statut == 'echec'
+    assert email.derniere_erreur == "Échec simulé par l'expéditeur local"
+    assert email.date_envoi is None
+    assert outbox.traiter_lot() == 0
+    assert outbox.expediteur.envoyes == []
+
+
+def test_reservation_expiree_reprise(outbox):
+    outbox.expediteur = ExpediteurStub()
+    en_cours, reserve = _mettre_en_file('a@example.com', 'b@example.com')
+    # Envois interrompus : l'un a une réservation expirée, l'autre est encore réservé
+    db.session.query(EmailSortant).filter(EmailSortant.id.in_([en_cours, reserve])).update(
+        {'statut': 'en_cours'}, synchronize_session=False
+    )
+    db.session.query(EmailSortant).filter_by(id=reserve).update(
+        {'prochaine_tentative': datetime.utcnow() + timedelta(minutes=5)}
+    )
+    db.session.commit()
+    _rendre_du(en_cours)
+
+    assert outbox.traiter_lot() == 1
+    assert (_email(en_cours).statut, _email(reserve).statut) == ('envoye', 'en_cours')
+
+
+def test_distribution_en_arriere_plan(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'EMAIL_OUTBOX_CONCURRENCE', 2)
+    file_envoi = OutboxEmail(intervalle=0.05)
+    email_id, = _mettre_en_file('a@example.com')
+
+    file_envoi.demarrer(app)
+    assert isinstance(file_envoi.expediteur, ExpediteurStub)
+    file_envoi.reveiller()
+    for _ in range(100):
+        if file_envoi.expediteur.envoyes:
+            break
+        file_envoi._arret.wait(0.05)
+    file_envoi.arreter()
+
+    assert [envoi['destinataire'] for envoi in file_envoi.expediteur.envoyes] == ['a@example.com']
+    assert _email(email_id).statut == 'envoye'
@@ -0,0 +1,102 @@
+"""
+Flux SSE : reprise après Last-Event-ID, instantané et resynchronisation
+"""
+import json
+from datetime import datetime
+from evenements import BusEvenements, bus_evenements
+
+
+def _evenements(flux):
+    """Découpe un flux SSE en [(id, type, données)], sans les commentaires ni la consigne retry"""
+    resultat = []
+    for bloc in ''.join(flux).split('\n\n'):
+        champs = dict(ligne.split(': ', 1) for ligne in bloc.split('\n') if ': ' in ligne and not ligne.startswith(':'))
+        if 'event' in champs:
+            resultat.append((champs.get('id'), champs['event'], json.loads(champs['data'])))
+    return resultat
+
+
+def _publier_etats(bus, *clients):
+    for numero, client_id in enumerate(clients, 1):
+        bus.publier('etat', client_id, {'equipement_id': numero, 'client_id': client_id, 'etat': 'en_ligne'})
+
+
+def test_reprise_apres_dernier_id_filtree_par_client():
+    bus = BusEvenements()
+    _publier_etats(bus, 1, 2, 1, 1)
+
+    abonne = bus.abonner(1, f'{bus.instance}-1')
+    evenements = _evenements(bus.flux_sse(abonne, duree_max=0))
+
+    assert [(identifiant, donnees['equipement_id']) for identifiant, _, donnees in evenements] == [
+        (f'{bus.instance}-3', 3), (f'{bus.instance}-4', 4)
+    ]
+    assert abonne.depuis == f'{bus.instance}-4'
+
+
+def test_identifiant_trop_ancien_ou_etranger_sans_rattrapage():
+    bus = BusEvenements(historique=3)
+    _publier_etats(bus, 1, 1, 1, 1, 1)
+
+    assert bus.abonner(None, f'{bus.instance}-1').rattrapage is None
+    assert bus.abonner(None, 'autreworker-4').rattrapage is None
+    assert bus.abonner(None, f'{bus.instance}-abc').rattrapage is None
+    assert len(bus.abonner(None, f'{bus.instance}-2').rattrapage) == 3
+
+
+def test_instantane_a_la_place_du_rattrapage():
+    bus = BusEvenements()
+    _publier_etats(bus, 1)
+
+    abonne = bus.abonner(None, 'autreworker-12')
+    abonne.instantane = {'equipements': []}
+    assert _evenements(bus.flux_sse(abonne, duree_max=0)) == [
+        (f'{bus.instance}-1', 'instantane', {'equipements': []})
+    ]
+
+    sans_instantane = bus.abonner(None, 'autreworker-12')
+    assert _evenements(bus.flux_sse(sans_instantane, duree_max=0)) == [(None, 'resynchroniser', {})]
+
+
+def test_lecteur_lent_resynchronise():
+    bus = BusEvenements(capacite_abonne=2)
+    abonne = bus.abonner(None)
+    _publier_etats(bus, 1, 1, 1)
+
+    evenements = _evenements(bus.flux_sse(abonne, duree_max=1))
+
+    assert evenements[-1] == (None, 'resynchroniser', {})
+    assert not bus._abonnes
+
+
+def test_nombre_maximal_de_connexions():
+    bus = BusEvenements(abonnes_max=1)
+    abonne = bus.abonner(None)
+
+    assert bus.abonner(None) is None
+    bus.desabonner(abonne)
+    assert bus.abonner(None) is not None
+
+
+def test_route_reprise_last_event_id(app, client_admin, equipements, monkeypatch):
+    monkeypatch.setitem(app.config, 'EVENEMENTS_DUREE_FLUX', 0)
+    premier = bus_evenements.dernier_id()
+    _publier_etats(bus_evenements, 1, 2)
+
+    reponse = client_admin.get('/api/stream/status', headers={'Last-Event-ID': premier})
+
+    assert reponse.mimetype == 'text/event-stream'
+    assert [type_evenement for _, type_evenement, _ in _evenements(reponse.get_data(as_text=True))] == ['etat', 'etat']
+
+
+def test_route_instantane_pour_identifiant_etranger(app, client_admin, equipements, monkeypatch):
+    monkeypatch.setitem(app.config, 'EVENEMENTS_DUREE_FLUX', 0)
+
+    reponse = client_admin.get('/api/stream/status', query_string={
+        'rendu': datetime.utcnow().isoformat()
+    }, headers={'Last-Event-ID': 'autreworker-7'})
+
+    (identifiant, type_evenement, donnees), = _evenements(reponse.get_data(as_text=True))
+    assert type_evenement == 'instantane'
+    assert identifiant.startswith(bus_evenements.instance)
+    assert donnees['stats']['total_equipements'] == len(equipements)
@@ -0,0 +1,137 @@
+"""
+Validation et enregistrement des lots de pings (/api/ping/batch)
+"""
+import json
+import ingestion
+from app import db
+from models import Equipement, HistoriquePing
+from ingestion import parser_lot_pings, traiter_lot_pings, MAX_PINGS_PAR_LOT
+from cache_equipements import cache_equipements
+
+
+def test_identifiants_invalides_refuses_par_element(app, equipements):
+    resultats = traiter_lot_pings([
+        {'equipement_id': 10 ** 30},
+        {'equipement_id': -3},
+        {'equipement_id': 'abc'},
+        {'equipement_id': equipements[0], 'response_time': 12},
+        {},
+        [equipements[1]],
+    ])
+
+    assert [resultat['code'] for resultat in resultats if resultat['status'] == 'error'] == [400, 400, 400, 400, 400]
+    assert resultats[3] == {'index': 3, 'status': 'success', 'equipement_id': equipements[0]}
+    assert db.session.get(Equipement, equipements[0]).etat == 'en_ligne'
+
+
+def test_equipement_inconnu_refuse(app, equipements):
+    resultats = traiter_lot_pings([{'equipement_id': 999}, {'ip': '192.168.99.99'}])
+
+    assert [resultat['code'] for resultat in resultats] == [404, 404]
+    assert HistoriquePing.query.count() == 0
+
+
+def test_equipement_desactive_apres_mise_en_cache(app, equipements):
+    # L'index en mémoire connaît l'équipement actif ; la base est modifiée sans l'invalider (autre processus)
+    assert cache_equipements.par_id(equipements[1]).actif
+    db.session.query(Equipement).filter_by(id=equipements[1]).update({'actif': False})
+    db.session.commit()
+
+    resultats = traiter_lot_pings([{'equipement_id': equipements[1]}, {'equipement_id': equipements[2]}])
+
+    assert resultats[0]['code'] == 404
+    assert resultats[1]['status'] == 'success'
+    assert [ligne.equipement_id for ligne in HistoriquePing.query.all()] == [equipements[2]]
+    assert db.session.get(Equipement, equipements[1]).etat == 'jamais_vu'
+
+
+def test_equipement_present_deux_fois_dans_le_lot(app, equipements):
+    resultats = traiter_lot_pings([{'equipement_id': equipements[0]}, {'ip': '10.0.0.1'}])
+
+    assert all(resultat['status'] == 'success' for resultat in resultats)
+    assert HistoriquePing.query.count() == 2
+
+
+def test_parser_ndjson_lignes_invalides():
+    corps = '{"equipement_id": 1}\n\nnon json\n{"ip": "10.0.0.2"}\n'
+
+    assert parser_lot_pings(corps, 'application/x-ndjson') == [
+        {'equipement_id': 1}, 'Ligne JSON invalide', {'ip': '10.0.0.2'}
+    ]
+    assert parser_lot_pings('{"pings": [{"equipement_id": 1}]}') == [{'equipement_id': 1}]
+
+
+def test_api_lot_partiel(client_http, equipements):
+    reponse = client_http.post('/api/ping/batch', json=[
+        {'equipement_id': equipements[0]},
+        {'equipement_id': 10 ** 30},
+    ])
+
+    donnees = reponse.get_json()
+    assert reponse.status_code == 200
+    assert (donnees['status'], donnees['acceptes'], donnees['rejetes']) == ('partial', 1, 1)
+    assert donnees['resultats'][1]['error'] == "ID d'équipement invalide"
+
+
+def test_api_lot_trop_grand(client_http, equipements):
+    corps = json.dumps([{'equipement_id': equipements[0]}] * (MAX_PINGS_PAR_LOT + 1))
+
+    reponse = client_http.post('/api/ping/batch', data=corps, content_type='application/json')
+
+    assert reponse.status_code == 413
+
+
+def test_api_ping_identifiant_hors_limites(client_http, equipements):
+    assert client_http.post('/api/ping', json={'equipement_id': 10 ** 30}).status_code == 404
+
+
+def test_temps_de_reponse_valide_avant_ecriture(app, equipements):
+    resultats = traiter_lot_pings([
+        {'equipement_id': equipements[0], 'response_time': 'abc'},
+        {'equipement_id': equipements[1], 'response_time': '12.5'},
+        {'equipement_id': equipements[2], 'response_time': float('inf')},
+        {'equipement_id': equipements[2], 'response_time': -1},
+        {'equipement_id': equipements[2], 'response_time': True},
+    ])
+
+    assert [resultat.get('code') for resultat in resultats] == [400, None, 400, 400, 400]
+    assert [(ligne.equipement_id, ligne.reponse_ms) for ligne in HistoriquePing.query.all()] == [(equipements[1], 12.5)]
+
+
+def test_api_ping_temps_de_reponse_invalide(client_http, equipements):
+    reponse = client_http.post('/api/ping', json={'equipement_id': equipements[0], 'response_time': 'abc'})
+
+    assert reponse.status_code == 400
+    assert HistoriquePing.query.count() == 0
+
+
+def test_suivi_apres_commit_sans_effet_sur_la_reponse(client_http, equipements, monkeypatch):
+    def echec(*args):
+        raise RuntimeError('suivi indisponible')
+
+    monkeypatch.setattr(ingestion.sketches_latence, 'ajouter', echec)
+
+    assert client_http.post('/api/ping', json={'equipement_id': equipements[0], 'response_time': 5}).status_code == 200
+    reponse = client_http.post('/api/ping/batch', json=[{'equipement_id': equipements[1], 'response_time': 5}])
+    assert reponse.status_code == 200 and reponse.get_json()['acceptes'] == 1
+    assert HistoriquePing.query.count() == 2
+
+
+def test_champs_invalides_refuses_par_element(app, equipements):
+    resultats = traiter_lot_pings([
+        {'equipement_id': equipements[0], 'message': {'texte': 'ok'}},
+        {'ip': ['10.0.0.1']},
+        {'equipement_id': equipements[1], 'message': 'Passerelle site A'},
+    ])
+
+    assert [(resultat['status'], resultat.get('error')) for resultat in resultats] == [
+        ('error', 'Message invalide'), ('error', 'Adresse IP invalide'), ('success', None)
+    ]
+    assert [ligne.message for ligne in HistoriquePing.query.all()] == ['Passerelle site A']
+
+
+def test_api_ping_corps_invalide(client_http, equipements):
+    assert client_http.post('/api/ping', json=[{'equipement_id': equipements[0]}]).status_code == 400
+    assert client_http.post('/api/ping', data='{', content_type='application/json').status_code == 400
+    assert client_http.post('/api/ping', json={'equipement_id': equipements[0], 'message': 3}).status_code == 400
+    assert HistoriquePing.query.count() == 0
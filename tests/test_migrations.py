@@ -0,0 +1,57 @@
+"""
+Migrations versionnées : réapplication sans effet et mise à niveau d'une base existante
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import inspect, text
+from app import db
+from models import Equipement
+from migrations import MIGRATIONS, appliquer_migrations
+
+
+def _versions():
+    return [ligne[0] for ligne in db.session.execute(text('SELECT version FROM schema_version ORDER BY version'))]
+
+
+def _index(table):
+    return {index['name'] for index in inspect(db.engine).get_indexes(table)}
+
+
+def test_deuxieme_application_sans_effet(app):
+    index_avant = _index('equipements') | _index('alertes') | _index('historique_pings')
+
+    appliquer_migrations()
+
+    assert _versions() == [version for version, _, _ in MIGRATIONS]
+    assert _index('equipements') | _index('alertes') | _index('historique_pings') == index_avant
+    assert {'ix_equipements_etat', 'ix_alertes_non_lues'} <= index_avant
+
+
+def test_migrations_reappliquees_sur_schema_a_jour(app):
+    # Schéma déjà créé par create_all : chaque migration doit tolérer ce qu'elle trouve
+    db.session.execute(text('DELETE FROM schema_version'))
+    db.session.commit()
+
+    appliquer_migrations()
+
+    assert _versions() == [version for version, _, _ in MIGRATIONS]
+
+
+def test_etat_deduit_du_dernier_ping_a_la_mise_a_niveau(app, equipements):
+    maintenant = datetime.utcnow()
+    for equipement_id, dernier_ping in zip(equipements, [maintenant, maintenant - timedelta(hours=1), None]):
+        db.session.query(Equipement).filter_by(id=equipement_id).update({'dernier_ping': dernier_ping})
+    db.session.commit()
+
+    # Base antérieure à la migration 6 : ni colonne d'état, ni index
+    db.session.execute(text('DROP INDEX ix_equipements_etat'))
+    db.session.execute(text('ALTER TABLE equipements DROP COLUMN etat'))
+    db.session.execute(text('ALTER TABLE equipements DROP COLUMN etat_depuis'))
+    db.session.execute(text('DELETE FROM schema_version WHERE version = 6'))
+    db.session.commit()
+
+    appliquer_migrations()
+
+    etats = dict(db.session.execute(text('SELECT id, etat FROM equipements')).all())
+    assert [etats[equipement_id] for equipement_id in equipements] == ['en_ligne', 'hors_ligne', 'jamais_vu']
+    assert 'ix_equipements_etat' in _index('equipements')
+    assert _versions()[-1] == 6
@@ -0,0 +1,41 @@
+"""
+Archives mensuelles de l'historique (SQLite) : lecture par fenêtre et rétention
+"""
+from datetime import datetime
+from sqlalchemy import text
+from app import db
+from models import HistoriquePing
+from partitions_historique import entite_historique, maintenir_partitions, purger_archives_expirees
+
+
+def _archiver(equipement_id, *timestamps, maintenant):
+    for timestamp in timestamps:
+        db.session.add(HistoriquePing(equipement_id=equipement_id, timestamp=timestamp, statut='success'))
+    db.session.commit()
+    maintenir_partitions(maintenant)
+
+
+def _compter(nom):
+    return db.session.execute(text(f'SELECT COUNT(*) FROM {nom}')).scalar()
+
+
+def test_fenetre_limitee_aux_archives_concernees(app, equipements):
+    _archiver(equipements[0], datetime(2026, 1, 10), maintenant=datetime(2026, 2, 2))
+    _archiver(equipements[0], datetime(2026, 2, 10), maintenant=datetime(2026, 3, 2))
+
+    def archives(**fenetre):
+        requete = str(db.session.query(entite_historique(**fenetre).id).statement)
+        return sorted(nom for nom in ('historique_pings_2026_01', 'historique_pings_2026_02') if nom in requete)
+
+    assert archives() == ['historique_pings_2026_01', 'historique_pings_2026_02']
+    assert archives(depuis=datetime(2026, 2, 1)) == ['historique_pings_2026_02']
+    assert archives(jusqua=datetime(2026, 1, 31)) == ['historique_pings_2026_01']
+    assert entite_historique(depuis=datetime(2026, 3, 1)) is HistoriquePing
+
+
+def test_lignes_expirees_supprimees_des_archives_conservees(app, equipements):
+    _archiver(equipements[0], *[datetime(2026, 1, jour) for jour in range(1, 31)], maintenant=datetime(2026, 2, 2))
+
+    assert purger_archives_expirees(datetime(2026, 1, 21), taille_lot=4, pause=0) == 20
+    assert _compter('historique_pings_2026_01') == 10
+    assert purger_archives_expirees(datetime(2026, 1, 21), taille_lot=4, pause=0) == 0
@@ -0,0 +1,87 @@
+"""
+Tampon d'écriture différée de l'historique : vidange et contre-pression
+"""
+import threading
+from datetime import datetime
+from models import HistoriquePing
+from tampon_historique import TamponHistorique
+
+
+def _ligne(equipement_id):
+    return {'equipement_id': equipement_id, 'timestamp': datetime.utcnow(), 'statut': 'success',
+            'reponse_ms': 10, 'message': 'test'}
+
+
+def _configurer(app, monkeypatch, capacite, taille_lot):
+    monkeypatch.setitem(app.config, 'HISTORIQUE_TAMPON_CAPACITE', capacite)
+    monkeypatch.setitem(app.config, 'HISTORIQUE_TAMPON_LOT', taille_lot)
+    monkeypatch.setitem(app.config, 'HISTORIQUE_TAMPON_INTERVALLE', 0.05)
+
+
+def test_inactif_refuse_les_lignes(app, equipements):
+    tampon = TamponHistorique()
+
+    assert tampon.ajouter(_ligne(equipements[0])) is False
+    assert len(tampon.ajouter_lot([_ligne(equipements[0]), _ligne(equipements[1])])) == 2
+    assert tampon.metriques()['recues'] == 0
+
+
+def test_arret_vide_toutes_les_lignes(app, equipements, monkeypatch):
+    _configurer(app, monkeypatch, capacite=1000, taille_lot=7)
+    tampon = TamponHistorique()
+    tampon.demarrer(app)
+
+    assert tampon.ajouter_lot([_ligne(equipements[i % 3]) for i in range(50)]) == []
+    tampon.arreter()
+
+    metriques = tampon.metriques()
+    assert (metriques['recues'], metriques['ecrites'], metriques['en_attente']) == (50, 50, 0)
+    assert metriques['lots'] >= 50 // 7
+    assert HistoriquePing.query.count() == 50
+
+
+def test_file_pleine_rejette_sans_perdre(app, equipements, monkeypatch):
+    _configurer(app, monkeypatch, capacite=2, taille_lot=1)
+    tampon = TamponHistorique()
+
+    # Écriture bloquée tant que le test ne la libère pas : la file se remplit derrière elle
+    ecriture_commencee = threading.Event()
+    liberer = threading.Event()
+    ecrire = tampon._ecrire
+
+    def ecrire_bloquee(lot):
+        ecriture_commencee.set()
+        liberer.wait(5)
+        ecrire(lot)
+
+    monkeypatch.setattr(tampon, '_ecrire', ecrire_bloquee)
+    tampon.demarrer(app)
+
+    assert tampon.ajouter(_ligne(equipements[0]))
+    assert ecriture_commencee.wait(5)
+    refusees = tampon.ajouter_lot([_ligne(equipements[1]) for _ in range(3)])
+
+    assert len(refusees) == 1
+    assert tampon.metriques()['taux_remplissage'] == 1.0
+
+    liberer.set()
+    tampon.arreter()
+
+    metriques = tampon.metriques()
+    assert (metriques['recues'], metriques['rejetees'], metriques['ecrites'], metriques['perdues']) == (3, 1, 3, 0)
+    assert HistoriquePing.query.count() == 3
+
+
+def test_ligne_refusee_isolee_sans_perdre_le_lot(app, equipements, monkeypatch):
+    _configurer(app, monkeypatch, capacite=100, taille_lot=10)
+    tampon = TamponHistorique()
+    tampon.demarrer(app)
+
+    lignes = [_ligne(equipements[0]) for _ in range(5)]
+    lignes.insert(3, dict(_ligne(equipements[1]), message={'texte': 'pas une chaîne'}))
+    assert tampon.ajouter_lot(lignes) == []
+    tampon.arreter()
+
+    metriques = tampon.metriques()
+    assert (metriques['ecrites'], metriques['perdues'], metriques['en_attente']) == (5, 1, 0)
+    assert HistoriquePing.query.count() == 5